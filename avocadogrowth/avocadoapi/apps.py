@@ -1,6 +1,18 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AvocadoapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "avocadoapi"
+
+    def ready(self):
+        # pylint: disable=import-outside-toplevel
+        from . import signals
+        from .repositories.stacks import StackRepository
+
+        snapshot = getattr(settings, "STACKS_TRIE_SNAPSHOT", None)
+        if snapshot and os.path.exists(snapshot):
+            StackRepository.load_trie_snapshot(snapshot)
@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Mentor, Stacks, User
+from ...repositories.mentors import MentorRepository
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares multi-stack mentor lookups through SQL joins and through the in-memory index, on "
+        "generated mentors that are rolled back afterwards"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mentors", type=int, default=10000, help="Number of generated mentors")
+        parser.add_argument("--stacks", type=int, default=50, help="Number of generated stacks")
+        parser.add_argument("--stacks-per-mentor", type=int, default=8, help="Stacks known by each mentor")
+        parser.add_argument("--tags", type=int, default=3, help="Stacks required by each lookup")
+        parser.add_argument("--queries", type=int, default=200, help="Number of lookups")
+
+    def handle(self, *args, **options):
+        # pylint: disable=too-many-locals
+        generator = random.Random(0)
+        stacks_per_mentor = min(options["stacks_per_mentor"], options["stacks"])
+        tags = min(options["tags"], options["stacks"])
+        with transaction.atomic():
+            stacks = Stacks.objects.bulk_create(
+                Stacks(tag=f"benchmark-{index}", normalized_tag=f"benchmark-{index}")
+                for index in range(options["stacks"])
+            )
+            users = User.objects.bulk_create(
+                User(email=f"benchmark-{index}@avocado.test") for index in range(options["mentors"])
+            )
+            mentors = Mentor.objects.bulk_create(
+                Mentor(user=user, is_available=generator.random() < 0.5) for user in users
+            )
+            Mentor.stacks.through.objects.bulk_create(
+                Mentor.stacks.through(mentor_id=mentor.pk, stacks_id=stack.pk)
+                for mentor in mentors
+                for stack in generator.sample(stacks, stacks_per_mentor)
+            )
+            queries = [generator.sample(stacks, tags) for _ in range(options["queries"])]
+
+            start = time.perf_counter()
+            sql_results = [self.sql_mentor_ids(query) for query in queries]
+            sql_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            MentorRepository.build_index()
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            index_results = [MentorRepository.get_mentor_ids_by_stacks(query) for query in queries]
+            index_time = time.perf_counter() - start
+
+            transaction.set_rollback(True)
+        MentorRepository.index_loaded = False
+
+        if sql_results != index_results:
+            self.stderr.write("The SQL and index lookups returned different mentors")
+        count = len(queries)
+        self.stdout.write(f"SQL joins:    {sql_time / count * 1e6:10.1f} us per lookup")
+        self.stdout.write(f"Bitmap index: {index_time / count * 1e6:10.1f} us per lookup")
+        self.stdout.write(f"Index built in {build_time * 1e3:.1f} ms")
+
+    @staticmethod
+    def sql_mentor_ids(stacks):
+        """
+        Returns the sorted ids of the available mentors knowing every stack, joining once per stack.
+        """
+        mentors = Mentor.objects.filter(is_available=True)
+        for stack in stacks:
+            mentors = mentors.filter(stacks=stack)
+        return list(mentors.order_by("pk").values_list("pk", flat=True))
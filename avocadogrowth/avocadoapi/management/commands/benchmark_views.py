@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from django.contrib import messages
+from django.contrib.auth import authenticate, login
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.shortcuts import redirect
+from django.test import AsyncClient
+from django.test.utils import override_settings
+from django.urls import include, path
+
+from ...models import User
+
+BENCHMARK_EMAIL = "benchmark-views@avocado.test"
+BENCHMARK_PASSWORD = "benchmark-password"
+
+
+def sync_login_user(request):
+    """
+    Sync version of views.login_user, as it was before the views were made async
+    """
+    if request.method != "POST":
+        return HttpResponse("Method not allowed", status=405)
+    user = authenticate(request, email=request.POST.get("email"), password=request.POST.get("password"))
+    if user is not None:
+        login(request, user)
+        messages.success(request, "Login successful")
+        return redirect("dashboard")
+    return HttpResponse("Invalid credentials", status=401)
+
+
+def sync_dashboard(request):
+    """
+    Sync version of views.dashboard, as it was before the views were made async
+    """
+    if request.user.is_authenticated:
+        return HttpResponse(f"Welcome, {request.user.username if request.user.username else request.user.email}!")
+    return redirect("login")
+
+
+# The benchmark serves both versions side by side, the app's urls resolving "login" and "dashboard"
+urlpatterns = [
+    path("api/", include("avocadoapi.urls")),
+    path("sync/login/", sync_login_user),
+    path("sync/dashboard/", sync_dashboard),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares requests/sec and latency of the async login and dashboard views with their sync "
+        "versions, under concurrent requests sent through the ASGI handler"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Requests sent to each view")
+        parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at once")
+
+    def handle(self, *args, **options):
+        # Password hashing costs the same in both versions and would hide the difference, so the
+        # benchmark user gets a cheap hasher. The test client sends requests to "testserver".
+        with override_settings(
+            ROOT_URLCONF=__name__,
+            ALLOWED_HOSTS=["testserver"],
+            PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+        ):
+            User.objects.filter(email=BENCHMARK_EMAIL).delete()
+            User.objects.create_user(email=BENCHMARK_EMAIL, password=BENCHMARK_PASSWORD)
+            try:
+                results = async_to_sync(self.run_benchmarks)(options["requests"], max(options["concurrency"], 1))
+            finally:
+                User.objects.filter(email=BENCHMARK_EMAIL).delete()
+        for name, (rate, p50, p99) in results.items():
+            self.stdout.write(f"{name:16} {rate:8.1f} req/s   p50 {p50 * 1e3:7.2f} ms   p99 {p99 * 1e3:7.2f} ms")
+
+    async def run_benchmarks(self, requests, concurrency):
+        """
+        Returns the (requests/sec, p50, p99) of each view, by name
+        """
+        results = {}
+        for version, prefix in (("sync", "/sync/"), ("async", "/api/")):
+            results[f"{version} login"] = await self.run_benchmark(
+                f"{prefix}login/", requests, concurrency, logged_in=False
+            )
+            results[f"{version} dashboard"] = await self.run_benchmark(
+                f"{prefix}dashboard/", requests, concurrency, logged_in=True
+            )
+        return results
+
+    @staticmethod
+    async def run_benchmark(url, requests, concurrency, logged_in):
+        """
+        Sends requests to url from concurrency clients, each with its own session, and returns the
+        (requests/sec, p50, p99) of the run: with logged_in, GET requests from clients logged in
+        beforehand, else POST requests of the benchmark credentials.
+        """
+        user = await User.objects.aget(email=BENCHMARK_EMAIL)
+        clients = [AsyncClient() for _ in range(concurrency)]
+        if logged_in:
+            for client in clients:
+                await client.aforce_login(user)
+        latencies = []
+        remaining = iter(range(requests))
+
+        async def worker(client):
+            for _ in remaining:
+                start = time.perf_counter()
+                if logged_in:
+                    response = await client.get(url)
+                else:
+                    response = await client.post(url, {"email": BENCHMARK_EMAIL, "password": BENCHMARK_PASSWORD})
+                latencies.append(time.perf_counter() - start)
+                if response.status_code not in (200, 302):
+                    raise RuntimeError(f"{url} returned {response.status_code}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for client in clients))
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        return (
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        )
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...repositories.stacks import StackRepository
+
+
+class Command(BaseCommand):
+    help = "Builds the stacks autocomplete trie from the database and writes it to a snapshot file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", nargs="?", help="Snapshot file, defaults to settings.STACKS_TRIE_SNAPSHOT")
+
+    def handle(self, *args, **options):
+        path = options["path"] or getattr(settings, "STACKS_TRIE_SNAPSHOT", None)
+        if not path:
+            raise CommandError("No path given and STACKS_TRIE_SNAPSHOT is not set")
+        StackRepository.create_trie()
+        StackRepository.save_trie_snapshot(path)
+        self.stdout.write(f"Stacks trie written to {path}")
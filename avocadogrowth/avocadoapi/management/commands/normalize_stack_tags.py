@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ...repositories.mentors import MentorRepository
+from ...repositories.stacks import StackRepository
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the normalized tag of every stack and merges the stacks whose tags normalize to the same "
+        "one into the oldest of them. Run it once on databases created before Stacks.normalized_tag"
+    )
+
+    def handle(self, *args, **options):
+        merged = StackRepository.normalize_tags()
+        MentorRepository.bulk_changed([])
+        self.stdout.write(f"Merged {merged} duplicate stacks")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ...repositories.stacks import StackRepository
+
+
+class Command(BaseCommand):
+    help = (
+        "Recounts the mentors and learners using each stack tag and publishes the counts as the "
+        "autocomplete weights of every process. Run it periodically, e.g. every few minutes from cron"
+    )
+
+    def handle(self, *args, **options):
+        published = StackRepository.publish_trie_weights()
+        self.stdout.write(f"Published the weights of {published} stack tags")
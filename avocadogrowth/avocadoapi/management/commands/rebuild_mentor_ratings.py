@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...repositories.mentors import MentorRepository
+
+
+class Command(BaseCommand):
+    help = "Recomputes the rating sum, count, average and score of every mentor from their comments"
+
+    def handle(self, *args, **options):
+        updated = MentorRepository.rebuild_ratings()
+        self.stdout.write(f"Rebuilt the ratings of {updated} mentors")
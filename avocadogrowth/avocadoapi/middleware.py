@@ -0,0 +1,32 @@
+"""
+Middlewares of the Avocado API
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .repositories.identity_map import identity_map_scope
+
+
+class IdentityMapMiddleware:
+    """
+    Gives every request its own repository identity map (see repositories/identity_map.py), so a
+    row looked up several times by primary key or unique field during a request is queried once.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with identity_map_scope():
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with identity_map_scope():
+            return await self.get_response(request)
@@ -1,10 +1,14 @@
 """
 Models for the Avocado API
 """
+from copy import deepcopy
+
 from django.db import models
+from django.db.models.fields.files import FieldFile
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 from django.contrib.auth.base_user import BaseUserManager
+from .utils.normalization import normalize_tag
 
 AUTH_USER_MODEL = settings.AUTH_USER_MODEL
 
@@ -22,7 +26,8 @@ class UserManager(BaseUserManager):
         user.set_password(kwargs["password"])
         kwargs.pop("password")
         for key, value in kwargs.items():
-            setattr(user, key, value)
+            if key != "email":
+                setattr(user, key, value)
         user.save(using=self._db)
         return user
 
@@ -35,18 +40,115 @@ class UserManager(BaseUserManager):
         return user
 
 
-class Stacks(models.Model):
+class TrackedModel(models.Model):
+    """
+    Abstract model remembering the field values loaded from the database, so that save() only
+    writes the fields changed since (plus auto_now fields), and skips the query when none changed.
+    New instances, instances whose primary key was cleared or changed and saves given update_fields
+    are saved as usual.
+
+    A save skipped because no field changed returns before Model.save: it sends neither pre_save
+    nor post_save, and auto_now fields keep their value. Receivers only see the saves that write a
+    row; code needing the signals anyway passes the update_fields to write.
+    """
+    class Meta:
+        # pylint: disable=too-few-public-methods
+        abstract = True
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        # pylint: disable=missing-function-docstring
+        instance = super().from_db(db, field_names, values)
+        instance.remember_fields()
+        return instance
+
+    def remember_fields(self, fields=None):
+        """
+        Records the current values of the given fields (all the loaded fields by default) as saved
+        """
+        if not hasattr(self, "loaded_values"):
+            self.loaded_values = {}  # pylint: disable=attribute-defined-outside-init
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred or (fields is not None and not {field.name, field.attname} & {*fields}):
+                continue
+            self.loaded_values[field.attname] = self.field_snapshot(getattr(self, field.attname))
+
+    @staticmethod
+    def field_snapshot(value):
+        """
+        Returns a copy of a field value that changes made in place to the value do not reach: the
+        name of files, a deep copy of JSON values
+        """
+        if isinstance(value, FieldFile):
+            return value.name
+        return deepcopy(value) if isinstance(value, (dict, list)) else value
+
+    def get_dirty_fields(self):
+        """
+        Returns the names of the fields changed since they were loaded or saved
+        """
+        loaded_values = getattr(self, "loaded_values", {})
+        dirty_fields = []
+        for field in self._meta.concrete_fields:
+            if field.primary_key or field.attname not in loaded_values:
+                continue
+            if self.field_snapshot(getattr(self, field.attname)) != loaded_values[field.attname]:
+                dirty_fields.append(field.name)
+        return dirty_fields
+
+    def is_loaded_row(self):
+        """
+        Tells whether the instance still stands for the row it was loaded from: a primary key
+        cleared or changed since (copying a row, saving it again after delete()) makes it a new row
+        """
+        loaded_values = getattr(self, "loaded_values", None)
+        if self._state.adding or loaded_values is None or self.pk is None:
+            return False
+        return loaded_values.get(self._meta.pk.attname) == self.pk
+
+    def save(self, *args, **kwargs):
+        # pylint: disable=missing-function-docstring
+        if kwargs.get("update_fields") is None and self.is_loaded_row():
+            dirty_fields = self.get_dirty_fields()
+            if not dirty_fields:
+                return
+            auto_now_fields = [field.name for field in self._meta.concrete_fields if getattr(field, "auto_now", False)]
+            kwargs["update_fields"] = {*dirty_fields, *auto_now_fields}
+        super().save(*args, **kwargs)
+        self.remember_fields(kwargs.get("update_fields"))
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        # pylint: disable=missing-function-docstring
+        # from_queryset only exists since Django 5.1, so it is passed on when given
+        kwargs = {} if from_queryset is None else {"from_queryset": from_queryset}
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self.remember_fields(fields)
+
+
+class Stacks(TrackedModel):
     """
     Model for Stacks
     """
     id = models.AutoField(primary_key=True)
     tag = models.CharField(max_length=30, unique=True)
+    # Nullable so that the column can be added to a table of existing stacks, whose tags may normalize
+    # to the same one: manage.py normalize_stack_tags fills it and merges the duplicates
+    normalized_tag = models.CharField(max_length=60, unique=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # pylint: disable=missing-function-docstring
+        self.normalized_tag = normalize_tag(self.tag)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "tag" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "normalized_tag"}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.tag
 
 
-class User(AbstractUser):
+class User(TrackedModel, AbstractUser):
     """
     Custom User model for Avocado API
     """
@@ -80,7 +182,7 @@ class User(AbstractUser):
 
     def get_requests(self):
         # pylint: disable=missing-function-docstring
-        return Requests.objects.filter(from_user=self)
+        return Requests.objects.filter(from_user=self).order_by("-created_at", "-id")
 
     def get_stacks(self):
         # pylint: disable=missing-function-docstring
@@ -90,26 +192,43 @@ class User(AbstractUser):
         return self.username if self.username else self.email
 
 
-class Mentor(models.Model):
+class Mentor(TrackedModel):
     """
     Model for Mentor
     """
     user = models.OneToOneField(AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True)
     description = models.TextField()
+    # Average rating of the comments received, kept with its sum and count by the signals (see
+    # MentorRepository.count_rating), and the smoothed score enabled by settings.MENTOR_RATING_PRIOR
     rating = models.FloatField(null=True, blank=True)
+    rating_sum = models.FloatField(default=0)
+    rating_count = models.IntegerField(default=0)
+    score = models.FloatField(null=True, blank=True)
     is_available = models.BooleanField(default=False)
     history = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     stacks = models.ManyToManyField(Stacks)
+    # Requests received by status, maintained by the signals (see MentorRepository.count_request)
+    pending_requests = models.IntegerField(default=0)
+    accepted_requests = models.IntegerField(default=0)
+    rejected_requests = models.IntegerField(default=0)
+
+    class Meta:
+        # pylint: disable=too-few-public-methods
+        indexes = [
+            models.Index(fields=["is_available", "rating"], name="mentor_available_rating_idx"),
+            models.Index(fields=["is_available", "score"], name="mentor_available_score_idx"),
+            models.Index(fields=["rating"], name="mentor_rating_idx"),
+        ]
 
     def get_comments(self):
         # pylint: disable=missing-function-docstring
-        return Comments.objects.filter(to_user=self)
+        return Comments.objects.filter(to_user=self).order_by("-created_at", "-id")
 
     def get_requests(self):
         # pylint: disable=missing-function-docstring
-        return Requests.objects.filter(to_mentor=self)
+        return Requests.objects.filter(to_mentor_id=self.user_id).order_by("-created_at", "-id")
 
     def get_stacks(self):
         # pylint: disable=missing-function-docstring
@@ -119,7 +238,7 @@ class Mentor(models.Model):
         return self.user.username if self.user.username else self.user.email
 
 
-class Comments(models.Model):
+class Comments(TrackedModel):
     """
     Model for Comments
     """
@@ -131,11 +250,18 @@ class Comments(models.Model):
     to_user = models.ForeignKey(Mentor, on_delete=models.CASCADE, related_name="mentor_commented")
     stacks = models.ManyToManyField(Stacks)
 
+    class Meta:
+        # pylint: disable=too-few-public-methods
+        # Comment feeds are read newest first by (created_at, id)
+        indexes = [
+            models.Index(fields=["to_user", "created_at", "id"], name="comment_feed_idx"),
+        ]
+
     def __str__(self):
-        return f"Comment by {self.from_user.email} to {self.to_user.email}"
+        return f"Comment by {self.from_user.email} to {self.to_user.user.email}"
 
 
-class Requests(models.Model):
+class Requests(TrackedModel):
     """
     Model for Requests
     """
@@ -152,5 +278,14 @@ class Requests(models.Model):
     stacks = models.ManyToManyField(Stacks)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES)
 
+    class Meta:
+        # pylint: disable=too-few-public-methods
+        # Inboxes and outboxes are read newest first by (created_at, id), with or without a status
+        indexes = [
+            models.Index(fields=["to_mentor", "status", "created_at", "id"], name="request_inbox_status_idx"),
+            models.Index(fields=["to_mentor", "created_at", "id"], name="request_inbox_idx"),
+            models.Index(fields=["from_user", "created_at", "id"], name="request_outbox_idx"),
+        ]
+
     def __str__(self):
         return f"Request from {self.from_user.email} to {self.to_mentor.email}"
@@ -1,44 +1,308 @@
 """
 Abstract class for repository pattern
 """
+from contextvars import ContextVar
+from functools import partial
+
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .identity_map import find, forget, lookup_key, remember, track
+from .row_cache import acached_get, bump_generation, cached_get, invalidate
+
+# Number of rows written per statement by the bulk operations
+BULK_BATCH_SIZE = 1000
+
+# Rows deleted by the bulk_delete in progress, by model then primary key, or None outside bulk_delete
+bulk_deleted_rows = ContextVar("bulk_deleted_rows", default=None)
+
+
+def defer_to_bulk_delete(sender, instance):
+    """
+    Returns True if instance is being deleted by a bulk_delete and its model has a repository, after
+    recording it for the bulk_changed call of that repository. Delete receivers keeping derived data
+    then leave it to bulk_changed instead of updating it row by row.
+    """
+    rows = bulk_deleted_rows.get()
+    if rows is None or sender not in BaseRepository.repositories:
+        return False
+    rows.setdefault(sender, {})[instance.pk] = instance
+    return True
+
+
+def invalidate_cached_rows(sender, instance, signal, **kwargs):
+    """
+    Receiver dropping the cached copies of saved and deleted rows (see BaseRepository.cached_fields)
+    """
+    # pylint: disable=unused-argument
+    if signal is post_delete and defer_to_bulk_delete(sender, instance):
+        return
+    BaseRepository.repositories[sender].invalidate(instance)
 
 
 class BaseRepository:
+    """
+    Base repository, giving every repository single row and bulk operations on its model.
+
+    Bulk operations (bulk_create, bulk_update, upsert) write batches of rows in one transaction but
+    do not call save() nor send the model signals. Repositories keeping derived data override the
+    hooks:
+    - build: Returns an unsaved instance from a dict of fields, as create would save it
+    - prepare_bulk: Completes instances, and the fields to write, before they are written
+    - bulk_changed: Called with the written instances once a transaction containing bulk operations
+      is committed
+    bulk_delete deletes batches with QuerySet.delete, which follows the cascades and sends
+    post_delete for every row of the models having receivers. The receivers keeping derived data
+    skip the rows of models having a repository (see defer_to_bulk_delete), and the bulk_changed of
+    each of these repositories is called once with its deleted rows, cascades included.
+
+    Within an identity_map_scope (see identity_map.py), get, all, filter and create go through the
+    request's identity map: a row is loaded at most once per request by primary key or unique field.
+
+    Repositories setting cached_fields (a tuple of unique field names, possibly empty) also keep the
+    rows they get by primary key or by one of these fields in a cache shared across requests (see
+    row_cache.py). Saves and deletes invalidate it through post_save and post_delete receivers,
+    connected to the models of these repositories only: a receiver of every model would stop Django
+    from deleting the rows of any other model without loading them. Bulk operations invalidate it
+    through bulk_changed; QuerySet.update does neither, and its changes are seen once the rows expire.
+
+    aget, afilter, acreate, aupdate and adelete are the same operations for async views, built on the
+    async ORM (aget, acreate, asave, adelete, async for).
+    """
+    # pylint: disable=too-many-public-methods
     model = None
+    cached_fields = None
+    repositories = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.model is not None:
+            BaseRepository.repositories[cls.model] = cls
+            if cls.cached_fields is not None:
+                uid = f"row_cache:{cls.model._meta.label}"  # pylint: disable=protected-access
+                post_save.connect(invalidate_cached_rows, sender=cls.model, dispatch_uid=uid)
+                post_delete.connect(invalidate_cached_rows, sender=cls.model, dispatch_uid=uid)
 
     @classmethod
     def get(cls, **kwargs):
+        # pylint: disable=missing-function-docstring
+        instance = find(cls.model, kwargs)
+        if instance is not None:
+            return instance
+        key = lookup_key(cls.model, kwargs) if cls.cached_fields is not None else None
+        attnames = cls.cached_attnames()
+        if key is not None and (len(key) == 2 or key[1] in attnames):
+            attname = "pk" if len(key) == 2 else key[1]
+            instance = cached_get(cls.model, attname, key[-1], partial(cls.get_from_database, **kwargs))
+        else:
+            instance = cls.get_from_database(**kwargs)
+        return remember(instance) if instance is not None else None
+
+    @classmethod
+    def get_from_database(cls, **kwargs):
         # pylint: disable=missing-function-docstring
         try:
             return cls.model.objects.get(**kwargs)
         except ObjectDoesNotExist:
             return None
 
+    @classmethod
+    async def aget(cls, **kwargs):
+        # pylint: disable=missing-function-docstring
+        instance = find(cls.model, kwargs)
+        if instance is not None:
+            return instance
+        key = lookup_key(cls.model, kwargs) if cls.cached_fields is not None else None
+        attnames = cls.cached_attnames()
+        if key is not None and (len(key) == 2 or key[1] in attnames):
+            attname = "pk" if len(key) == 2 else key[1]
+            query = partial(cls.aget_from_database, **kwargs)
+            instance = await acached_get(cls.model, attname, key[-1], query)
+        else:
+            instance = await cls.aget_from_database(**kwargs)
+        return remember(instance) if instance is not None else None
+
+    @classmethod
+    async def aget_from_database(cls, **kwargs):
+        # pylint: disable=missing-function-docstring
+        try:
+            return await cls.model.objects.aget(**kwargs)
+        except ObjectDoesNotExist:
+            return None
+
+    @classmethod
+    def cached_attnames(cls):
+        """
+        Returns the column names of cached_fields
+        """
+        # pylint: disable=protected-access
+        return [cls.model._meta.get_field(name).attname for name in cls.cached_fields or ()]
+
+    @classmethod
+    def invalidate(cls, instance):
+        """
+        Drops the cached copies of instance, if the repository caches rows
+        """
+        if cls.cached_fields is not None:
+            invalidate(instance, cls.cached_attnames())
+
     @classmethod
     def all(cls):
         # pylint: disable=missing-function-docstring
-        return cls.model.objects.all()
+        return track(cls.model.objects.all())
 
     @classmethod
     def filter(cls, **kwargs):
         # pylint: disable=missing-function-docstring
-        return cls.model.objects.filter(**kwargs)
+        return track(cls.model.objects.filter(**kwargs))
+
+    @classmethod
+    async def afilter(cls, **kwargs):
+        """
+        Returns the list of instances matching the given filters
+        """
+        return [instance async for instance in cls.filter(**kwargs)]
 
     @classmethod
     def create(cls, **kwargs):
         # pylint: disable=missing-function-docstring
-        return cls.model.objects.create(**kwargs)
+        return remember(cls.model.objects.create(**kwargs))
 
     @classmethod
-    def update(cls, instance, **kwargs):
+    async def acreate(cls, **kwargs):
         # pylint: disable=missing-function-docstring
+        return remember(await cls.model.objects.acreate(**kwargs))
+
+    @classmethod
+    def update(cls, instance, **kwargs):
+        """
+        Sets the given fields of instance and saves it. Models tracking their loaded values (see
+        models.TrackedModel) only write the fields that actually changed.
+        """
+        forget(instance)
         for key, value in kwargs.items():
             setattr(instance, key, value)
         instance.save()
-        return instance
+        return remember(instance)
+
+    @classmethod
+    async def aupdate(cls, instance, **kwargs):
+        # pylint: disable=missing-function-docstring
+        forget(instance)
+        for key, value in kwargs.items():
+            setattr(instance, key, value)
+        await instance.asave()
+        return remember(instance)
 
     @classmethod
     def delete(cls, instance):
         # pylint: disable=missing-function-docstring
+        forget(instance)
         instance.delete()
+
+    @classmethod
+    async def adelete(cls, instance):
+        # pylint: disable=missing-function-docstring
+        forget(instance)
+        await instance.adelete()
+
+    @classmethod
+    def build(cls, fields):
+        # pylint: disable=missing-function-docstring,not-callable
+        return cls.model(**fields)
+
+    @classmethod
+    def prepare_bulk(cls, instances, fields=None):
+        # pylint: disable=missing-function-docstring,unused-argument
+        return fields
+
+    @classmethod
+    def bulk_changed(cls, instances):
+        # pylint: disable=missing-function-docstring,unused-argument
+        if cls.cached_fields is not None:
+            bump_generation(cls.model)
+
+    @classmethod
+    def bulk_create(cls, rows, batch_size=BULK_BATCH_SIZE, ignore_conflicts=False):
+        """
+        Creates instances, or dicts of fields, with one INSERT per batch_size rows in one transaction.
+        Returns the created instances.
+        """
+        # pylint: disable=isinstance-second-argument-not-valid-type
+        instances = [row if isinstance(row, cls.model) else cls.build(row) for row in rows]
+        cls.prepare_bulk(instances)
+        with transaction.atomic():
+            created = cls.model.objects.bulk_create(
+                instances, batch_size=batch_size, ignore_conflicts=ignore_conflicts
+            )
+            transaction.on_commit(partial(cls.bulk_changed, created))
+        return created
+
+    @classmethod
+    def bulk_update(cls, instances, fields, batch_size=BULK_BATCH_SIZE):
+        """
+        Writes the given fields of instances, with one UPDATE per batch_size rows in one transaction.
+        Returns the number of rows updated.
+        """
+        instances = list(instances)
+        fields = cls.prepare_bulk(instances, fields)
+        with transaction.atomic():
+            count = cls.model.objects.bulk_update(instances, fields, batch_size=batch_size)
+            transaction.on_commit(partial(cls.bulk_changed, instances))
+        return count
+
+    @classmethod
+    def bulk_delete(cls, ids, batch_size=BULK_BATCH_SIZE):
+        """
+        Deletes the rows with the given primary keys, batch_size at a time in one transaction.
+        Returns the number of rows deleted, cascades included.
+        Once committed, calls bulk_changed of every repository whose rows were deleted, with them.
+        """
+        ids = list(ids)
+        count = 0
+        rows = {}
+        token = bulk_deleted_rows.set(rows)
+        try:
+            with transaction.atomic():
+                for start in range(0, len(ids), batch_size):
+                    deleted, _ = cls.model.objects.filter(pk__in=ids[start:start + batch_size]).delete()
+                    count += deleted
+                for model, instances in rows.items():
+                    repository = BaseRepository.repositories[model]
+                    transaction.on_commit(partial(repository.bulk_changed, list(instances.values())))
+        finally:
+            bulk_deleted_rows.reset(token)
+        return count
+
+    @classmethod
+    def upsert(cls, rows, unique_fields, update_fields, batch_size=BULK_BATCH_SIZE):
+        """
+        Inserts instances, or dicts of fields, updating update_fields of the rows already existing
+        with the same unique_fields, with one INSERT ... ON CONFLICT per batch_size rows.
+        """
+        # pylint: disable=isinstance-second-argument-not-valid-type
+        instances = [row if isinstance(row, cls.model) else cls.build(row) for row in rows]
+        update_fields = cls.prepare_bulk(instances, update_fields)
+        with transaction.atomic():
+            upserted = cls.model.objects.bulk_create(
+                instances,
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=unique_fields,
+                update_fields=update_fields,
+            )
+            transaction.on_commit(partial(cls.bulk_changed, upserted))
+        return upserted
+
+    @classmethod
+    def iter_all(cls, chunk_size=BULK_BATCH_SIZE):
+        """
+        Yields every instance in primary key order, loading chunk_size rows per query. Each query
+        starts after the last primary key seen, so memory stays bounded and no row is skipped.
+        """
+        queryset = cls.model.objects.order_by("pk")
+        chunk = list(queryset[:chunk_size])
+        while chunk:
+            yield from chunk
+            chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size])
@@ -0,0 +1,60 @@
+from ..models import Comments
+from ..utils.keyset import keyset_page
+from .base import BaseRepository
+from .mentors import MentorRepository
+
+COMMENTS_PAGE_SIZE = 50
+
+
+class CommentRepository(BaseRepository):
+    """
+    Repository of the comments left to mentors.
+
+    The comment feed of a mentor is paginated with cursors (see utils.keyset), newest first, over
+    the (to_user, created_at, id) index of Comments. Each page comes with its authors, mentor and
+    stacks: two queries per page, whatever its size.
+
+    Saving and deleting comments updates the ratings of mentors (see signals.py); bulk operations,
+    bulk_delete included, rebuild the ones of the mentors of the written or deleted comments once
+    instead.
+    """
+
+    model = Comments
+
+    @classmethod
+    def bulk_changed(cls, instances):
+        # pylint: disable=missing-function-docstring
+        super().bulk_changed(instances)
+        MentorRepository.rebuild_ratings(mentor_ids=cls.mentor_ids(instances))
+
+    @staticmethod
+    def mentor_ids(instances):
+        """
+        Returns the ids of the mentors of the given comments, and of the mentors they were loaded
+        with, whose ratings change when a bulk_update moves comments to another mentor
+        """
+        mentor_ids = set()
+        for instance in instances:
+            mentor_ids.add(instance.to_user_id)
+            mentor_ids.add(getattr(instance, "loaded_values", {}).get("to_user_id"))
+        mentor_ids.discard(None)
+        return mentor_ids
+
+    @classmethod
+    def get_comments_by_mentor(cls, mentor):
+        """
+        Returns the comments left to mentor (a Mentor or its user), newest first
+        """
+        # A mentor's primary key is the one of its user
+        return cls.filter(to_user_id=mentor.pk).order_by("-created_at", "-id")
+
+    @classmethod
+    def get_feed(cls, mentor, cursor=None, page_size=COMMENTS_PAGE_SIZE):
+        """
+        Returns a KeysetPage of the comments left to mentor (a Mentor or its user) with their author,
+        mentor and stacks, following cursor, the next_cursor of the previous page
+        """
+        comments_qs = (
+            cls.get_comments_by_mentor(mentor).select_related("from_user", "to_user__user").prefetch_related("stacks")
+        )
+        return keyset_page(comments_qs, "created_at", page_size, cursor=cursor)
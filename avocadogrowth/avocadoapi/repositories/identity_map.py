@@ -0,0 +1,142 @@
+"""
+Request scoped identity map used by the repositories.
+
+Within an identity_map_scope (opened for every request by middleware.IdentityMapMiddleware), each
+row loaded through a repository is kept in memory: later lookups of the same primary key or unique
+field return the same instance without querying, and foreign keys pointing to a row already in
+the map are filled from it. Outside a scope, repositories always query the database.
+"""
+
+# pylint: disable=protected-access
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.core.exceptions import ValidationError
+from django.db.models.query import ModelIterable
+
+identity_map = ContextVar("identity_map", default=None)
+
+
+@contextmanager
+def identity_map_scope():
+    """
+    Activates a new, empty identity map until the block exits.
+    """
+    token = identity_map.set({})
+    try:
+        yield
+    finally:
+        identity_map.reset(token)
+
+
+def lookup_key(model, kwargs):
+    """
+    Returns the identity map key of a lookup on a single primary key or unique field, such as
+    pk=1, email="john@doe.com" or user=<User>, or None for any other lookup.
+    """
+    if len(kwargs) != 1:
+        return None
+    name, value = next(iter(kwargs.items()))
+    field = (
+        model._meta.pk
+        if name == "pk"
+        else next((field for field in model._meta.concrete_fields if name in (field.name, field.attname)), None)
+    )
+    if field is None or not field.unique:
+        return None
+    if isinstance(value, field.related_model or ()):
+        value = value.pk
+    try:
+        value = (field.target_field if field.is_relation else field).to_python(value)
+    except ValidationError:
+        return None
+    if field.primary_key:
+        return (model._meta.label, value)
+    return (model._meta.label, field.attname, value)
+
+
+def find(model, kwargs):
+    """
+    Returns the instance of the active identity map matching a single field lookup, or None.
+    """
+    instances = identity_map.get()
+    key = lookup_key(model, kwargs) if instances is not None else None
+    if key is None:
+        return None
+    if len(key) == 3:
+        key = instances.get(key)
+    return instances.get(key)
+
+
+def remember(instance):
+    """
+    Adds instance to the active identity map and returns the instance the map holds for its row:
+    the first one loaded in the scope, given the related objects instance loaded that it lacks
+    (select_related and prefetch_related caches). Foreign keys of a new instance are filled from
+    the map.
+    """
+    instances = identity_map.get()
+    if instances is None or instance.pk is None:
+        return instance
+    meta = instance._meta
+    key = (meta.label, instance.pk)
+    if key in instances:
+        known = instances[key]
+        if known is not instance:
+            for name, related in instance._state.fields_cache.items():
+                known._state.fields_cache.setdefault(name, related)
+            prefetched = instance.__dict__.get("_prefetched_objects_cache")
+            if prefetched:
+                known.__dict__.setdefault("_prefetched_objects_cache", {})
+                for name, related in prefetched.items():
+                    known._prefetched_objects_cache.setdefault(name, related)
+        return known
+    instances[key] = instance
+    deferred = instance.get_deferred_fields()
+    for field in meta.concrete_fields:
+        if field.attname in deferred:
+            continue
+        value = getattr(instance, field.attname)
+        if field.unique and not field.primary_key and value is not None:
+            instances[(meta.label, field.attname, value)] = key
+        if field.many_to_one or field.one_to_one:
+            related = instances.get((field.related_model._meta.label, value))
+            if related is not None and not field.is_cached(instance):
+                field.set_cached_value(instance, related)
+    return instance
+
+
+def forget(instance):
+    """
+    Removes instance from the active identity map, e.g. once it is deleted.
+    """
+    instances = identity_map.get()
+    if instances is None:
+        return
+    meta = instance._meta
+    instances.pop((meta.label, instance.pk), None)
+    deferred = instance.get_deferred_fields()
+    for field in meta.concrete_fields:
+        if field.unique and not field.primary_key and field.attname not in deferred:
+            instances.pop((meta.label, field.attname, getattr(instance, field.attname)), None)
+
+
+class IdentityMapIterable(ModelIterable):
+    """
+    Yields the instances of a queryset through the active identity map.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __iter__(self):
+        for instance in super().__iter__():
+            yield remember(instance)
+
+
+def track(queryset):
+    """
+    Makes queryset return its instances through the identity map, if one is active.
+    """
+    if identity_map.get() is not None and queryset._iterable_class is ModelIterable:
+        queryset._iterable_class = IdentityMapIterable
+    return queryset
@@ -1,31 +1,444 @@
 """
 This module contains the repository class for the Mentor model.
 """
-from ..models import Mentor
+import threading
+from functools import partial
+from itertools import chain
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, ExpressionWrapper, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+
+from ..models import Comments, Mentor, Requests, User
+from ..utils.bitmap_index import BitmapIndex
+from ..utils.normalization import normalize_tag
 from .base import BaseRepository
+from .identity_map import forget
+from .row_cache import bump_generation
+from .stacks import StackRepository
+
+# Number of mentors returned per page by get_mentor_by_stack
+MENTORS_PAGE_SIZE = 20
+# Number of mentors returned by get_matching_mentors
+MATCHING_MENTORS_LIMIT = 10
+# Shared version of the stack -> mentors index, incremented by every change
+MENTOR_INDEX_VERSION_KEY = "mentors:index:version"
+# Number of mentors returned by get_best_rated_mentors
+BEST_RATED_MENTORS_LIMIT = 10
+# Key of the available mentors in MentorRepository.stack_index, next to the stack ids
+AVAILABLE_KEY = "available"
+# Counter of Mentor kept for each request status
+REQUEST_COUNTERS = {"P": "pending_requests", "A": "accepted_requests", "R": "rejected_requests"}
 
 
 class MentorRepository(BaseRepository):
+    """
+    Repository class for the Mentor model.
+
+    Besides SQL queries, mentors can be looked up by stacks through an in-memory inverted index:
+    stack_index maps each stack id to a bitmap of the mentors knowing it, and AVAILABLE_KEY to the
+    bitmap of the available mentors (see utils/bitmap_index.py). Mentors knowing several stacks are
+    then a few bitwise ANDs instead of one join per stack.
+
+    The index is built from the database on first use. add_stack(s), remove_stack, set_stacks,
+    set_available, create and update apply their change once the transaction is committed and
+    increment a version shared through the cache; a process whose index is not at the shared
+    version rebuilds it. Deleted mentors, cascades included, are removed by a post_delete receiver
+    (see unindex_mentor). Bulk operations, bulk_delete included, make every process rebuild it (see
+    bulk_changed). Other changes made without the repository are only seen after the next build_index.
+
+    Mentors also count the requests they received by status (see REQUEST_COUNTERS), so loads are
+    read without counting requests: count_request keeps them up to date and recount_requests
+    recomputes them from the requests table.
+    Likewise their rating is the average of the ratings of their comments, kept with its sum and
+    count by count_rating and recomputed by rebuild_ratings, so reading it costs no AVG().
+    """
+    # pylint: disable=too-many-public-methods
     model = Mentor
+    cached_fields = ()
+    stack_index = BitmapIndex()
+    index_version = 0
+    index_loaded = False
+    index_lock = threading.RLock()
+
+    @classmethod
+    def get_mentor_by_stack(cls, stack, page=1, page_size=MENTORS_PAGE_SIZE, prefetch_stacks=False):
+        """
+        Returns a lazy queryset over one page of the available mentors of a stack, best rated first and
+        unrated mentors last.
+        Availability is filtered in SQL using the (is_available, rating) index and each mentor comes
+        with its user; prefetch_stacks also loads the stacks of the page in a single extra query.
+        """
+        if page < 1:
+            raise ValueError(f"Page {page} not found")
+        mentors_qs = (
+            cls.model.objects.filter(stacks__normalized_tag=normalize_tag(stack), is_available=True)
+            .select_related("user")
+            .order_by(F("rating").desc(nulls_last=True), "pk")
+        )
+        if prefetch_stacks:
+            mentors_qs = mentors_qs.prefetch_related("stacks")
+        start = (page - 1) * page_size
+        return mentors_qs[start:start + page_size]
+
+    @classmethod
+    async def aget_mentor_by_stack(cls, stack, page=1, page_size=MENTORS_PAGE_SIZE, prefetch_stacks=False):
+        """
+        Async version of get_mentor_by_stack, returning the page as a list
+        """
+        mentors_qs = cls.get_mentor_by_stack(stack, page=page, page_size=page_size, prefetch_stacks=prefetch_stacks)
+        return [mentor async for mentor in mentors_qs]
+
+    @classmethod
+    def get_matching_mentors(cls, user, limit=MATCHING_MENTORS_LIMIT):
+        """
+        Returns the limit available mentors best matching the learning stacks of user, in one query.
+        Mentors are ranked by number of stacks in common (overlap), then rating, then history (number
+        of mentorships), then load (number of current mentees, fewest first), then pending requests
+        (fewest first). The user is never matched with themselves.
+        """
+        load = (
+            User.mentors.through.objects.filter(mentor_id=OuterRef("pk"))
+            .values("mentor_id")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return (
+            cls.model.objects.filter(is_available=True, stacks__in=user.learning_stacks.values("pk"))
+            .exclude(user=user)
+            .annotate(
+                overlap=Count("stacks"),
+                load=Coalesce(Subquery(load, output_field=IntegerField()), Value(0)),
+            )
+            .select_related("user")
+            .order_by(
+                "-overlap", F("rating").desc(nulls_last=True), "-history", "load", "pending_requests", "pk"
+            )[:limit]
+        )
+
+    @classmethod
+    async def aget_matching_mentors(cls, user, limit=MATCHING_MENTORS_LIMIT):
+        """
+        Async version of get_matching_mentors, returning a list
+        """
+        return [mentor async for mentor in cls.get_matching_mentors(user, limit=limit)]
+
+    @classmethod
+    def count_request(cls, mentor_id, status=None, previous_status=None, mentorships=0):
+        """
+        Moves a request received by a mentor from the counter of previous_status to the counter of
+        status, either being None for created and deleted requests, and adds mentorships to its
+        history. A single UPDATE with F() expressions, so concurrent changes are never lost.
+        Returns whether the mentor was updated, i.e. whether mentor_id is a mentor.
+        """
+        deltas = {"history": mentorships}
+        for request_status, delta in ((previous_status, -1), (status, 1)):
+            field = REQUEST_COUNTERS.get(request_status)
+            if field is not None:
+                deltas[field] = deltas.get(field, 0) + delta
+        changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+        if not changes or not cls.model.objects.filter(pk=mentor_id).update(**changes):
+            return False
+        mentor = cls.model(pk=mentor_id)
+        forget(mentor)
+        cls.invalidate(mentor)
+        return True
+
+    @classmethod
+    def request_counters(cls):
+        """
+        Returns the expressions counting the requests of a mentor by status, for an UPDATE of mentors
+        """
+        counters = {}
+        for status, field in REQUEST_COUNTERS.items():
+            count = (
+                Requests.objects.filter(to_mentor=OuterRef("pk"), status=status)
+                .values("to_mentor")
+                .annotate(count=Count("pk"))
+                .values("count")
+            )
+            counters[field] = Coalesce(Subquery(count, output_field=IntegerField()), Value(0))
+        return counters
+
+    @classmethod
+    def recount_requests(cls, mentor_ids=None):
+        """
+        Recomputes the request counters of the given mentors (all by default) from the requests
+        table, in one UPDATE. Returns the number of mentors updated.
+        """
+        mentors = cls.model.objects.all() if mentor_ids is None else cls.model.objects.filter(pk__in=mentor_ids)
+        updated = mentors.update(**cls.request_counters())
+        bump_generation(cls.model)
+        return updated
+
+    @classmethod
+    def rating_fields(cls, rating_sum, rating_count):
+        """
+        Returns the expressions of rating and, if settings.MENTOR_RATING_PRIOR is set, score for
+        the given expressions of the sum and count of the ratings
+        """
+        fields = {"rating": ExpressionWrapper(rating_sum / NullIf(rating_count, 0), output_field=FloatField())}
+        prior = getattr(settings, "MENTOR_RATING_PRIOR", None)
+        if prior is not None:
+            mean, weight = prior
+            fields["score"] = ExpressionWrapper(
+                (rating_sum + Value(float(mean * weight))) / (rating_count + Value(weight)), output_field=FloatField()
+            )
+        return fields
+
+    @classmethod
+    def count_rating(cls, mentor_id, rating=None, previous_rating=None):
+        """
+        Replaces previous_rating by rating in the ratings of a mentor, either being None for comments
+        created, deleted or without rating, and updates its rating and score. A single UPDATE with
+        F() expressions, so concurrent comments are never lost.
+        """
+        delta_sum = (rating or 0) - (previous_rating or 0)
+        delta_count = (rating is not None) - (previous_rating is not None)
+        if not delta_sum and not delta_count:
+            return
+        rating_sum = F("rating_sum") + Value(float(delta_sum))
+        rating_count = F("rating_count") + Value(delta_count)
+        changes = {"rating_sum": rating_sum, "rating_count": rating_count}
+        changes.update(cls.rating_fields(rating_sum, rating_count))
+        if cls.model.objects.filter(pk=mentor_id).update(**changes):
+            mentor = cls.model(pk=mentor_id)
+            forget(mentor)
+            cls.invalidate(mentor)
+
+    @classmethod
+    def rebuild_ratings(cls, mentor_ids=None):
+        """
+        Recomputes the ratings of the given mentors (all by default) from their comments, in one
+        UPDATE. Returns the number of mentors updated.
+        """
+        mentors = cls.model.objects.all() if mentor_ids is None else cls.model.objects.filter(pk__in=mentor_ids)
+        updated = mentors.update(**cls.rating_rebuild_fields())
+        bump_generation(cls.model)
+        return updated
+
+    @classmethod
+    def rating_rebuild_fields(cls):
+        """
+        Returns the expressions recomputing the ratings of a mentor from its comments, for an UPDATE
+        of mentors
+        """
+        comments = Comments.objects.filter(to_user=OuterRef("pk"), rating__isnull=False).values("to_user")
+        rating_sum = Coalesce(
+            Subquery(comments.annotate(total=Sum("rating")).values("total"), output_field=FloatField()), Value(0.0)
+        )
+        rating_count = Coalesce(
+            Subquery(comments.annotate(count=Count("pk")).values("count"), output_field=IntegerField()), Value(0)
+        )
+        changes = {"rating_sum": rating_sum, "rating_count": rating_count, "score": None}
+        changes.update(cls.rating_fields(rating_sum, rating_count))
+        return changes
+
+    @classmethod
+    def get_best_rated_mentors(cls, limit=BEST_RATED_MENTORS_LIMIT):
+        """
+        Returns the limit available mentors with the best score, or rating if scores are disabled
+        (see settings.MENTOR_RATING_PRIOR), in the order of the rating or score indexes of Mentor
+        """
+        field = "rating" if getattr(settings, "MENTOR_RATING_PRIOR", None) is None else "score"
+        return (
+            cls.model.objects.filter(is_available=True, **{f"{field}__isnull": False})
+            .select_related("user")
+            .order_by(f"-{field}", "-pk")[:limit]
+        )
+
+    @classmethod
+    def build_index(cls):
+        """
+        Builds the stack -> mentors index, availability included, from the database
+        """
+        with cls.index_lock:
+            version = cache.get(MENTOR_INDEX_VERSION_KEY, 0)
+            stacks = cls.model.stacks.through.objects.values_list("stacks_id", "mentor_id")
+            available = cls.model.objects.filter(is_available=True).values_list("pk", flat=True)
+            cls.stack_index = BitmapIndex.from_pairs(
+                chain(stacks.iterator(), ((AVAILABLE_KEY, mentor_id) for mentor_id in available.iterator()))
+            )
+            cls.index_version = version
+            cls.index_loaded = True
 
     @classmethod
-    def get_mentor_by_stack(cls, stack):
+    def refresh_index(cls):
+        """
+        Builds the index on first use, or when another process changed it
+        """
+        if not cls.index_loaded or cache.get(MENTOR_INDEX_VERSION_KEY, 0) != cls.index_version:
+            cls.build_index()
+
+    @classmethod
+    def publish_index_change(cls, change):
+        """
+        Increments the shared index version once the transaction is committed, and applies change
+        (a function without arguments updating the index) if the index of this process is up to date
+        """
+        def publish():
+            with cls.index_lock:
+                cache.add(MENTOR_INDEX_VERSION_KEY, 0, timeout=None)
+                version = cache.incr(MENTOR_INDEX_VERSION_KEY)
+                if cls.index_loaded and version == cls.index_version + 1:
+                    change()
+                    cls.index_version = version
+
+        transaction.on_commit(publish)
+
+    @classmethod
+    def bulk_changed(cls, instances):
+        """
+        Bulk operations send no index change: bumps the index version so every process rebuilds it
+        """
+        super().bulk_changed(instances)
+        cache.add(MENTOR_INDEX_VERSION_KEY, 0, timeout=None)
+        cache.incr(MENTOR_INDEX_VERSION_KEY)
+
+    @classmethod
+    def index_availability(cls, mentor_id, available):
+        """
+        Sets the bit of a mentor in the availability bitmap
+        """
+        if available:
+            cls.stack_index.add(AVAILABLE_KEY, mentor_id)
+        else:
+            cls.stack_index.discard(AVAILABLE_KEY, mentor_id)
+
+    @classmethod
+    def get_mentor_ids_by_stacks(cls, stacks, available=True):
+        """
+        Returns the sorted ids of the mentors knowing every given stack (Stacks or ids), only the
+        available ones by default, using the in-memory index
+        """
+        cls.refresh_index()
+        keys = [getattr(stack, "pk", stack) for stack in stacks]
+        stack_index = cls.stack_index
+        return stack_index.members_of(stack_index.intersection([*keys, AVAILABLE_KEY] if available else keys))
+
+    @classmethod
+    def get_mentors_by_stacks(cls, stacks, available=True):
+        """
+        Returns a queryset of the mentors knowing every given stack, with their users, best rated first
+        and unrated mentors last
+        """
+        mentor_ids = cls.get_mentor_ids_by_stacks(stacks, available=available)
+        return (
+            cls.model.objects.filter(pk__in=mentor_ids)
+            .select_related("user")
+            .order_by(F("rating").desc(nulls_last=True), "pk")
+        )
+
+    @classmethod
+    def create(cls, **kwargs):
+        """
+        Creates a mentor, with the request counters and ratings of the requests and comments its
+        user already received
+        """
+        instance = super().create(**kwargs)
+        cls.count_existing(instance)
+        mentor_id, available = instance.pk, instance.is_available
+        cls.publish_index_change(lambda: cls.index_availability(mentor_id, available))
+        return instance
+
+    @classmethod
+    def count_existing(cls, instance):
+        """
+        Recounts the requests and rebuilds the ratings of a new mentor in one UPDATE, so that the
+        requests its user received before becoming a mentor are counted, then reloads them
+        """
+        changes = cls.request_counters()
+        changes.update(cls.rating_rebuild_fields())
+        cls.model.objects.filter(pk=instance.pk).update(**changes)
+        cls.invalidate(instance)
+        instance.refresh_from_db(fields=list(changes))
+
+    @classmethod
+    def update(cls, instance, **kwargs):
         # pylint: disable=missing-function-docstring
-        mentors_qs = cls.model.objects.filter(stacks__tag=stack).order_by("rating")
-        mentors = [mentor for mentor in mentors_qs if mentor.is_available]
-        return mentors
+        instance = super().update(instance, **kwargs)
+        if "is_available" in kwargs:
+            mentor_id, available = instance.pk, instance.is_available
+            cls.publish_index_change(lambda: cls.index_availability(mentor_id, available))
+        return instance
+
+    @classmethod
+    def unindex_mentor(cls, mentor_id):
+        """
+        Removes a deleted mentor from the index once the transaction is committed
+        """
+        cls.publish_index_change(lambda: cls.stack_index.discard_member(mentor_id))
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        """
+        Async version of create
+        """
+        instance = await super().acreate(**kwargs)
+        await sync_to_async(cls.count_existing)(instance)
+        mentor_id, available = instance.pk, instance.is_available
+        await sync_to_async(cls.publish_index_change)(lambda: cls.index_availability(mentor_id, available))
+        return instance
+
+    @classmethod
+    async def aupdate(cls, instance, **kwargs):
+        # pylint: disable=missing-function-docstring
+        instance = await super().aupdate(instance, **kwargs)
+        if "is_available" in kwargs:
+            mentor_id, available = instance.pk, instance.is_available
+            await sync_to_async(cls.publish_index_change)(lambda: cls.index_availability(mentor_id, available))
+        return instance
 
     @classmethod
     def add_stack(cls, mentor, stack):
         # pylint: disable=missing-function-docstring
         mentor.stacks.add(stack)
-        mentor.save()
+        cls.publish_index_change(lambda: cls.stack_index.add(stack.pk, mentor.pk))
 
     @classmethod
     def remove_stack(cls, mentor, stack):
         # pylint: disable=missing-function-docstring
         mentor.stacks.remove(stack)
-        mentor.save()
+        cls.publish_index_change(lambda: cls.stack_index.discard(stack.pk, mentor.pk))
+
+    @classmethod
+    def add_stacks(cls, mentor, tags, create_missing=False):
+        """
+        Adds the stacks of the given tags to mentor: one query resolves the tags (see
+        StackRepository.get_by_tags), one bulk insert writes the missing links. Returns the stacks.
+        """
+        stacks = StackRepository.get_by_tags(tags, create_missing=create_missing)
+        mentor.stacks.add(*stacks)
+        cls.publish_index_change(partial(cls.index_stacks, mentor.pk, [stack.pk for stack in stacks], []))
+        return stacks
+
+    @classmethod
+    def set_stacks(cls, mentor, tags, create_missing=False):
+        """
+        Replaces the stacks of mentor with the stacks of the given tags, deleting and inserting only
+        the links that change. Returns the stacks.
+        """
+        stacks = StackRepository.get_by_tags(tags, create_missing=create_missing)
+        previous_ids = set(mentor.stacks.values_list("pk", flat=True))
+        stack_ids = {stack.pk for stack in stacks}
+        mentor.stacks.set(stacks)
+        cls.publish_index_change(
+            partial(cls.index_stacks, mentor.pk, stack_ids - previous_ids, previous_ids - stack_ids)
+        )
+        return stacks
+
+    @classmethod
+    def index_stacks(cls, mentor_id, added_ids, removed_ids):
+        """
+        Adds and removes a mentor from the bitmaps of the given stacks
+        """
+        for stack_id in added_ids:
+            cls.stack_index.add(stack_id, mentor_id)
+        for stack_id in removed_ids:
+            cls.stack_index.discard(stack_id, mentor_id)
 
     @classmethod
     def get_stacks(cls, mentor):
@@ -38,5 +451,6 @@ class MentorRepository(BaseRepository):
         if not mentor.is_available:
             mentor.is_available = True
             mentor.save()
+            cls.publish_index_change(lambda: cls.index_availability(mentor.pk, True))
         else:
             raise ValueError("Mentor is already available")
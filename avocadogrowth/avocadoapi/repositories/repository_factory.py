@@ -1,7 +1,7 @@
 """
 Factory class to create repository objects based on the model name.
 """
-from . import mentors, stacks, users_repository, requests
+from . import comments, mentors, stacks, users_repository, requests
 
 
 class RepositoryFactory:
@@ -22,4 +22,6 @@ class RepositoryFactory:
             return users_repository.UserRepository()
         if model == "request":
             return requests.RequestRepository()
+        if model == "comment":
+            return comments.CommentRepository()
         raise ValueError(f"Model {model} not found")
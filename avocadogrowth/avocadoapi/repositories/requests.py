@@ -1,16 +1,143 @@
-from ..models import Requests
+from django.db import transaction
+
+from ..models import Mentor, Requests, User
+from ..utils.keyset import keyset_page
 from .base import BaseRepository
+from .mentors import MentorRepository
+
+REQUESTS_PAGE_SIZE = 20
+# Statuses a request can move to from each status: pending requests are accepted or rejected once
+REQUEST_TRANSITIONS = {"P": ("A", "R"), "A": (), "R": ()}
 
 
 class RequestRepository(BaseRepository):
+    """
+    Repository of mentorship requests.
+
+    Inboxes (requests received by a mentor) and outboxes (requests sent by a user) are paginated
+    with cursors (see utils.keyset), newest first, and can be filtered by status. The composite
+    indexes of Requests cover the filters and the (created_at, id) order, so every page costs the
+    same however many requests a mentor received.
+
+    Saving and deleting requests updates the request counters of mentors (see signals.py); bulk
+    operations, bulk_delete included, recount the ones of the mentors of the written or deleted
+    requests once instead.
+
+    Statuses change through accept, reject and transition, following REQUEST_TRANSITIONS: each is a
+    conditional UPDATE ... WHERE status IN (allowed previous statuses), so when several devices
+    answer a request at the same time exactly one of them wins and the others are told they lost.
+    """
+
     model = Requests
 
     @classmethod
-    def get_requests_by_user(cls, user):
+    def bulk_changed(cls, instances):
         # pylint: disable=missing-function-docstring
-        return cls.model.objects.filter(from_user=user)
+        super().bulk_changed(instances)
+        MentorRepository.recount_requests(mentor_ids=cls.mentor_ids(instances))
+
+    @staticmethod
+    def mentor_ids(instances):
+        """
+        Returns the ids of the mentors of the given requests, and of the mentors they were loaded
+        with, whose counters change when a bulk_update moves requests to another mentor
+        """
+        mentor_ids = set()
+        for instance in instances:
+            mentor_ids.add(instance.to_mentor_id)
+            mentor_ids.add(getattr(instance, "loaded_values", {}).get("to_mentor_id"))
+        mentor_ids.discard(None)
+        return mentor_ids
 
     @classmethod
-    def get_requests_by_mentor(cls, mentor):
-        # pylint: disable=missing-function-docstring
-        return cls.model.objects.filter(to_mentor=mentor)
+    def get_requests_by_user(cls, user, status=None):
+        """
+        Returns the requests sent by user, newest first
+        """
+        requests_qs = cls.filter(from_user=user)
+        if status is not None:
+            requests_qs = requests_qs.filter(status=status)
+        return requests_qs.order_by("-created_at", "-id")
+
+    @classmethod
+    def get_requests_by_mentor(cls, mentor, status=None):
+        """
+        Returns the requests received by mentor (a Mentor or its user), newest first
+        """
+        if isinstance(mentor, Mentor):
+            mentor = mentor.user_id
+        requests_qs = cls.filter(to_mentor=mentor)
+        if status is not None:
+            requests_qs = requests_qs.filter(status=status)
+        return requests_qs.order_by("-created_at", "-id")
+
+    @classmethod
+    def get_inbox(cls, mentor, status=None, cursor=None, page_size=REQUESTS_PAGE_SIZE):
+        """
+        Returns a KeysetPage of the requests received by mentor (a Mentor or its user) with their
+        sender, following cursor, the next_cursor of the previous page
+        """
+        requests_qs = cls.get_requests_by_mentor(mentor, status=status).select_related("from_user")
+        return keyset_page(requests_qs, "created_at", page_size, cursor=cursor)
+
+    @classmethod
+    def get_outbox(cls, user, status=None, cursor=None, page_size=REQUESTS_PAGE_SIZE):
+        """
+        Returns a KeysetPage of the requests sent by user with their mentor, following cursor, the
+        next_cursor of the previous page
+        """
+        requests_qs = cls.get_requests_by_user(user, status=status).select_related("to_mentor")
+        return keyset_page(requests_qs, "created_at", page_size, cursor=cursor)
+
+    @classmethod
+    def transition(cls, request, status):
+        """
+        Moves request to status if the transition is allowed from its status in the database, and
+        returns whether it did. Either way request.status is the status in the database afterwards.
+        Accepting a request also adds its mentor to the mentors of its sender and increments the
+        mentor's history, in the same transaction. Accepting a request sent to a user who is not a
+        mentor raises a ValueError and leaves the request as it is.
+        """
+        if status not in REQUEST_TRANSITIONS:
+            raise ValueError(f"Status {status} not found")
+        previous_statuses = [previous for previous, statuses in REQUEST_TRANSITIONS.items() if status in statuses]
+        won, previous_status = False, None
+        with transaction.atomic():
+            for previous_status in previous_statuses:
+                won = bool(cls.model.objects.filter(pk=request.pk, status=previous_status).update(status=status))
+                if won:
+                    break
+            if won:
+                accepted = status == "A"
+                counted = MentorRepository.count_request(
+                    request.to_mentor_id, status=status, previous_status=previous_status, mentorships=int(accepted)
+                )
+                if accepted and not counted:
+                    raise ValueError(
+                        f"Request {request.pk} is sent to user {request.to_mentor_id}, who is not a mentor"
+                    )
+                if accepted:
+                    User.mentors.through.objects.bulk_create(
+                        [User.mentors.through(user_id=request.from_user_id, mentor_id=request.to_mentor_id)],
+                        ignore_conflicts=True,
+                    )
+        if won:
+            request.status = status
+            request.remember_fields(["status"])
+        else:
+            request.refresh_from_db(fields=["status"])
+        return won
+
+    @classmethod
+    def accept(cls, request):
+        """
+        Accepts a pending request, see transition
+        """
+        return cls.transition(request, "A")
+
+    @classmethod
+    def reject(cls, request):
+        """
+        Rejects a pending request, see transition
+        """
+        return cls.transition(request, "R")
@@ -0,0 +1,215 @@
+"""
+Cross-request read-through cache of single rows, used by BaseRepository.get.
+
+A row is cached as a pickled instance under the key of the lookup that loaded it: its primary key
+or one of the unique fields listed in the repository's cached_fields. Keys are made of:
+- ROW_CACHE_VERSION, to be incremented whenever cached models change shape
+- the model label and its generation, a counter incremented by bulk operations (which send no
+  signals) to drop every cached row of the model at once
+- the field and a digest of its value
+
+Each key also has a version, a random token read before querying the row and cached with it: a
+cached row is only returned while its version is current. Saving or deleting an instance gives new
+versions to its keys, for its current values and for the values it was loaded with (see
+TrackedModel), right away and again once the transaction is committed. A caller that read a row
+before a write may still cache it after the write, but under a dead version. Rows read inside a
+transaction are never cached, since they may be rolled back.
+
+When a key is missing, a single caller per key loads the row (see STAMPEDE_*): the others wait for
+it to be cached instead of all querying the database at once.
+
+acached_get is the same read for async code, through the async methods of the cache backends.
+Async code cannot run inside atomic blocks, so it always caches the rows it reads.
+
+The cache used is settings.REPOSITORY_CACHE (an alias of settings.CACHES), None disabling it.
+"""
+
+# pylint: disable=protected-access
+import asyncio
+import time
+import uuid
+from copy import copy
+from hashlib import blake2b
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+ROW_CACHE_VERSION = 1
+GENERATION_KEY = "repository:{}:generation"
+# A loading caller holds its key's lock up to STAMPEDE_LOCK_TIMEOUT seconds; others check the cache
+# every STAMPEDE_WAIT seconds, STAMPEDE_RETRIES times, then query the database themselves
+STAMPEDE_LOCK_TIMEOUT = 5
+STAMPEDE_WAIT = 0.05
+STAMPEDE_RETRIES = 20
+
+
+def get_cache():
+    """
+    Returns the cache configured by settings.REPOSITORY_CACHE, or None if it is disabled.
+    """
+    alias = getattr(settings, "REPOSITORY_CACHE", None)
+    return caches[alias] if alias else None
+
+
+def generation(row_cache, model):
+    """
+    Returns the current generation of the cached rows of model.
+    """
+    return row_cache.get(GENERATION_KEY.format(model._meta.label), 0)
+
+
+def bump_generation(model):
+    """
+    Drops every cached row of model, by moving its keys to a new generation.
+    """
+    row_cache = get_cache()
+    if row_cache is None:
+        return
+    key = GENERATION_KEY.format(model._meta.label)
+    row_cache.add(key, 0, timeout=None)
+    row_cache.incr(key)
+
+
+def row_key(model, model_generation, attname, value):
+    """
+    Returns the cache key of the row of model whose field attname has the given value.
+    """
+    digest = blake2b(repr(value).encode(), digest_size=16).hexdigest()
+    return f"repository:{ROW_CACHE_VERSION}:{model._meta.label}:{model_generation}:{attname}:{digest}"
+
+
+def row_keys(instance, attnames, model_generation, loaded=False):
+    """
+    Returns the keys of instance for each cached field: for its current values, and with loaded
+    for the values it was loaded with too.
+    """
+    model = type(instance)
+    keys = {row_key(model, model_generation, "pk", instance.pk)}
+    loaded_values = getattr(instance, "loaded_values", {}) if loaded else {}
+    for attname in attnames:
+        values = [instance.__dict__.get(attname)]
+        if attname in loaded_values:
+            values.append(loaded_values[attname])
+        keys.update(row_key(model, model_generation, attname, value) for value in values if value is not None)
+    return keys
+
+
+def version_key(key):
+    """
+    Returns the key of the version of the row cached under key.
+    """
+    return f"{key}:version"
+
+
+def new_versions(keys):
+    """
+    Returns new versions for the given row keys, by version key.
+    """
+    return {version_key(key): uuid.uuid4().hex for key in keys}
+
+
+def current_row(values, key):
+    """
+    Returns the (version, instance) cached under key, instance being None unless it was cached
+    under the current version, given the result of get_many([key, version_key(key)]).
+    """
+    version, entry = values.get(version_key(key)), values.get(key)
+    if version is None or entry is None or entry[0] != version:
+        return version, None
+    return version, entry[1]
+
+
+def cacheable(instance):
+    """
+    Returns a copy of instance without its cached related objects, which may change independently.
+    """
+    clone = copy(instance)
+    clone._state = copy(instance._state)
+    clone._state.fields_cache = {}
+    clone.__dict__.pop("_prefetched_objects_cache", None)
+    return clone
+
+
+def cached_get(model, attname, value, query):
+    """
+    Returns the row of model whose field attname (a cached field, or "pk") has the given value,
+    from the cache or else from query(), which returns the instance or None.
+    """
+    row_cache = get_cache()
+    if row_cache is None:
+        return query()
+    key = row_key(model, generation(row_cache, model), attname, value)
+    version, instance = current_row(row_cache.get_many([key, version_key(key)]), key)
+    if instance is not None:
+        return instance
+    lock_key = f"{key}:lock"
+    timeout = getattr(settings, "REPOSITORY_CACHE_TIMEOUT", 300)
+    for _ in range(STAMPEDE_RETRIES):
+        if row_cache.add(lock_key, 1, timeout=STAMPEDE_LOCK_TIMEOUT):
+            try:
+                if version is None:
+                    versions = new_versions([key])
+                    version = versions[version_key(key)]
+                    if not row_cache.add(version_key(key), version, timeout):
+                        version = row_cache.get(version_key(key))
+                instance = query()
+                if instance is not None and version is not None and not connection.in_atomic_block:
+                    row_cache.set(key, (version, cacheable(instance)), timeout)
+                return instance
+            finally:
+                row_cache.delete(lock_key)
+        time.sleep(STAMPEDE_WAIT)
+        version, instance = current_row(row_cache.get_many([key, version_key(key)]), key)
+        if instance is not None:
+            return instance
+    return query()
+
+
+async def acached_get(model, attname, value, query):
+    """
+    Async version of cached_get, query being a coroutine function.
+    """
+    row_cache = get_cache()
+    if row_cache is None:
+        return await query()
+    model_generation = await row_cache.aget(GENERATION_KEY.format(model._meta.label), 0)
+    key = row_key(model, model_generation, attname, value)
+    version, instance = current_row(await row_cache.aget_many([key, version_key(key)]), key)
+    if instance is not None:
+        return instance
+    lock_key = f"{key}:lock"
+    timeout = getattr(settings, "REPOSITORY_CACHE_TIMEOUT", 300)
+    for _ in range(STAMPEDE_RETRIES):
+        if await row_cache.aadd(lock_key, 1, timeout=STAMPEDE_LOCK_TIMEOUT):
+            try:
+                if version is None:
+                    versions = new_versions([key])
+                    version = versions[version_key(key)]
+                    if not await row_cache.aadd(version_key(key), version, timeout):
+                        version = await row_cache.aget(version_key(key))
+                instance = await query()
+                if instance is not None and version is not None:
+                    await row_cache.aset(key, (version, cacheable(instance)), timeout)
+                return instance
+            finally:
+                await row_cache.adelete(lock_key)
+        await asyncio.sleep(STAMPEDE_WAIT)
+        version, instance = current_row(await row_cache.aget_many([key, version_key(key)]), key)
+        if instance is not None:
+            return instance
+    return await query()
+
+
+def invalidate(instance, attnames):
+    """
+    Gives new versions to the keys of instance, now and once the transaction is committed: rows
+    cached in between were read before the commit.
+    """
+    row_cache = get_cache()
+    if row_cache is None or instance.pk is None:
+        return
+    keys = row_keys(instance, attnames, generation(row_cache, type(instance)), loaded=True)
+    timeout = getattr(settings, "REPOSITORY_CACHE_TIMEOUT", 300)
+    row_cache.set_many(new_versions(keys), timeout)
+    transaction.on_commit(lambda: row_cache.set_many(new_versions(keys), timeout))
@@ -1,6 +1,82 @@
-from ..models import Stacks
+import logging
+import struct
+import threading
+import time
+import uuid
+from functools import partial
+from hashlib import blake2b
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+
+from ..models import Mentor, Stacks, User
 from .base import BaseRepository
 from ..utils.trie import Trie
+from ..utils.compact_trie import CompactTrie
+from ..utils.trie_snapshot import load_trie, save_trie
+from ..utils.normalization import fold_tag, normalize_tag
+
+logger = logging.getLogger(__name__)
+
+TRIE_ENGINES = {
+    "default": Trie,
+    "compact": CompactTrie,
+}
+
+# Number of best completions cached on each trie node for autocomplete(query, limit=...)
+AUTOCOMPLETE_TOP_K = 10
+
+# Shared journal of trie changes: the version counter and one entry per version
+TRIE_VERSION_KEY = "stacks:trie:version"
+TRIE_CHANGE_KEY = "stacks:trie:change:{}"
+TRIE_CHANGE_TIMEOUT = 24 * 60 * 60
+# Past this many missed changes, rebuilding from the database is cheaper than replaying them
+TRIE_MAX_REPLAY = 1000
+# Popularity weights published by publish_trie_weights: the (generation, number of chunks) of the
+# last publication, and its chunks of TRIE_WEIGHTS_CHUNK_SIZE tags, kept well under the 1 MB item
+# limit of memcached
+TRIE_WEIGHTS_KEY = "stacks:trie:weights"
+TRIE_WEIGHTS_CHUNK_KEY = "stacks:trie:weights:{}:{}"
+TRIE_WEIGHTS_CHUNK_SIZE = 5000
+# Autocomplete results, keyed by autocomplete_key
+AUTOCOMPLETE_CACHE_KEY = "stacks:autocomplete:{}"
+
+
+def tag_variants(tag):
+    """
+    Returns the extra trie keys of a tag: its folded spelling, so that a tag normalized to another
+    one by an alias ("Golang" -> "go") is still found by typing its own name
+    """
+    return [fold_tag(tag)]
+
+
+def build_trie(engine):
+    """
+    Returns an empty autocomplete trie of the given engine, with top completions and a prefix filter.
+    Tags are matched on their normalized form and returned as they are stored.
+    """
+    if engine not in TRIE_ENGINES:
+        raise ValueError(f"Trie engine {engine} not found")
+    return TRIE_ENGINES[engine](
+        top_k=AUTOCOMPLETE_TOP_K, prefix_filter=True, normalize=normalize_tag, variants=tag_variants
+    )
+
+
+def fuzzy_distance(query):
+    """
+    Returns the number of typos tolerated by a fuzzy autocomplete of query: none for one or two
+    characters (anything would match), one up to five characters, two above. Characters are counted
+    on the normalized query, which the trie searches and autocomplete_key identifies results by.
+    """
+    query = normalize_tag(query)
+    if len(query) <= 2:
+        return 0
+    if len(query) <= 5:
+        return 1
+    return 2
 
 
 class StackRepository(BaseRepository):
@@ -8,24 +84,424 @@ class StackRepository(BaseRepository):
     Repository class for the Stacks model.
 
     Methods:
+    - get_by_tag: Returns the stack matching a tag once normalized, e.g. "C-Sharp" for "c#"
+    - get_by_tags: Returns the stacks matching a list of tags in one query, optionally creating missing ones
+    - normalize_tags: Fills missing normalized tags and merges the stacks sharing one
+    - prepare_bulk, bulk_changed: Keep normalized tags and the trie up to date with bulk operations
+    - set_trie_engine: Replaces the trie with an empty one of the given engine ("default" or "compact")
+    - get_popularity: Returns the number of mentors and learners using each stack tag
     - create_trie: Initializes the trie with all the stack tags in the database
+    - save_trie_snapshot: Writes the trie and its version to a snapshot file
+    - load_trie_snapshot: Replaces the trie with a memory mapped snapshot file
+    - publish_trie_change: Records a tag insertion, rename or deletion for every process and applies it
+    - publish_trie_weights: Recounts the popularity of the tags and publishes it for every process
+    - check_trie_weights: Starts applying the last published weights in the background, if new
+    - apply_trie_weights: Replaces the trie with a copy weighted by published weights
+    - sync_trie: Applies the changes published since the trie was last synced
+    - refresh_trie: Creates the trie on first use, then syncs it and checks the weights every
+      STACKS_TRIE_SYNC_INTERVAL seconds
     - autocomplete: Returns a list of stack tags that match the input query
+    - search_trie: Same as autocomplete, without refreshing the trie first
+    - autocomplete_key: Returns a key identifying the results of autocomplete at the current trie version
+    - cached_autocomplete: Same as autocomplete, with the results kept in the cache
+    - aget_by_tag, arefresh_trie, aautocomplete, acached_autocomplete: Async versions for async views
+
+    The trie is kept up to date incrementally: the Stacks signals (see signals.py) publish each
+    change in a journal stored in the cache, under an increasing version number. Every process
+    remembers the version its trie is at and replays the missing entries, falling back to a full
+    create_trie only when entries have expired. Processes only see each other's changes when the
+    cache backend is shared (memcached, redis, database...).
+
+    The popularity weights ranking autocomplete(limit=...) change with every stack added to or
+    removed from a mentor or learner, which is too frequent to journal. Instead, a periodic task
+    ("manage.py publish_stack_weights") recounts them and publishes them in the cache, outside the
+    journal. Each process notices new weights when it syncs, and weights a copy of its trie in a
+    background thread, so neither the recount nor the reweighting runs in a request. Rankings lag
+    the M2M tables by the period of the task. Renamed tags keep their weight, and new tags weigh 0
+    until the next recount.
+
+    Within a process, the trie is never changed in place: writers hold trie_lock, build a new
+    version (a fresh trie or a copy of the current one) and replace cls.trie with it. Readers take
+    cls.trie once per call without locking, and always see a complete version.
     """
+    # pylint: disable=too-many-public-methods
     model = Stacks
-    trie = Trie()
+    cached_fields = ("tag", "normalized_tag")
+    trie_engine = getattr(settings, "STACKS_TRIE_ENGINE", "default")
+    trie = build_trie(trie_engine)
+    trie_version = 0
+    trie_checked_at = 0.0
+    trie_loaded = False
+    trie_lock = threading.RLock()
+    # Generation of the published weights the trie has, and the thread applying newer ones
+    trie_weights_generation = None
+    weights_lock = threading.Lock()
+    weights_thread = None
+
+    @classmethod
+    def get_by_tag(cls, tag):
+        """
+        Returns the stack whose normalized tag matches the given one, using the normalized_tag index
+        """
+        return cls.get(normalized_tag=normalize_tag(tag))
+
+    @classmethod
+    async def aget_by_tag(cls, tag):
+        """
+        Async version of get_by_tag
+        """
+        return await cls.aget(normalized_tag=normalize_tag(tag))
+
+    @classmethod
+    def get_by_tags(cls, tags, create_missing=False):
+        """
+        Returns the stacks matching the given tags once normalized, in order and without duplicates,
+        resolved with a single query. Unknown tags raise a ValueError, unless create_missing is set:
+        they are then created with one bulk insert, and published to the trie once committed.
+        """
+        wanted = {}
+        for tag in tags:
+            wanted.setdefault(normalize_tag(tag), tag)
+        stacks = {stack.normalized_tag: stack for stack in cls.filter(normalized_tag__in=wanted)}
+        missing = [tag for normalized_tag, tag in wanted.items() if normalized_tag not in stacks]
+        if missing and not create_missing:
+            raise ValueError(f"Stacks {', '.join(missing)} not found")
+        if missing:
+            created = [cls.model(tag=tag) for tag in missing]
+            cls.prepare_bulk(created)
+            cls.model.objects.bulk_create(created, ignore_conflicts=True)
+            for tag in missing:
+                transaction.on_commit(partial(cls.publish_trie_change, "insert", tag))
+            created_tags = [stack.normalized_tag for stack in created]
+            stacks.update((stack.normalized_tag, stack) for stack in cls.filter(normalized_tag__in=created_tags))
+        return [stacks[normalized_tag] for normalized_tag in wanted]
+
+    @classmethod
+    def normalize_tags(cls):
+        """
+        Fills the normalized tags of the stacks saved before the column existed, and merges the stacks
+        whose tags normalize to the same one ("Python" and "python", "Golang" and "go") into the
+        oldest of them: the links of the others to mentors, learners, comments and requests move to
+        it, then they are deleted. Returns the number of stacks merged.
+        """
+        kept = {}
+        merged = {}
+        for stack in cls.model.objects.order_by("pk"):
+            normalized_tag = normalize_tag(stack.tag)
+            if normalized_tag in kept:
+                merged[stack.pk] = kept[normalized_tag].pk
+            else:
+                kept[normalized_tag] = stack
+        changed = [stack for normalized_tag, stack in kept.items() if stack.normalized_tag != normalized_tag]
+        with transaction.atomic():
+            for relation in cls.model._meta.related_objects:  # pylint: disable=protected-access
+                if not relation.many_to_many:
+                    continue
+                through = relation.through
+                source, target = relation.field.m2m_field_name(), relation.field.m2m_reverse_field_name()
+                links = through.objects.filter(**{f"{target}__in": merged})
+                moved = [
+                    through(**{f"{source}_id": owner_id, f"{target}_id": merged[stack_id]})
+                    for owner_id, stack_id in links.values_list(f"{source}_id", f"{target}_id")
+                ]
+                through.objects.bulk_create(moved, ignore_conflicts=True)
+                links.delete()
+            cls.bulk_delete(merged)
+            cls.bulk_update(changed, ["tag"])
+        return len(merged)
+
+    @classmethod
+    def prepare_bulk(cls, instances, fields=None):
+        """
+        Sets the normalized tag that save() would set, and writes it along with the tag
+        """
+        for instance in instances:
+            instance.normalized_tag = normalize_tag(instance.tag)
+        if fields is not None and "tag" in fields:
+            fields = [*fields, "normalized_tag"]
+        return fields
+
+    @classmethod
+    def bulk_changed(cls, instances):
+        """
+        Bulk operations publish no change to the journal: bumps the trie version once without a
+        journal entry, so that every process rebuilds its trie
+        """
+        super().bulk_changed(instances)
+        with cls.trie_lock:
+            cache.add(TRIE_VERSION_KEY, 0, timeout=None)
+            cache.incr(TRIE_VERSION_KEY)
+            if cls.trie_loaded:
+                cls.create_trie()
+
+    @classmethod
+    def set_trie_engine(cls, engine):
+        """
+        Replaces the trie with an empty one of the given engine.
+        The "compact" engine stores the nodes in about 20 times less memory than the "default" one.
+        With the top completions and the prefix filter, which both engines store the same way, the
+        autocomplete trie is about 5 to 6 times smaller.
+        """
+        with cls.trie_lock:
+            cls.trie = build_trie(engine)
+            cls.trie_engine = engine
+
+    @classmethod
+    def get_popularity(cls):
+        """
+        Returns a dict mapping every stack tag to the number of mentors and learners using it.
+        Counts are grouped on each M2M table separately to avoid joining mentors with learners.
+        """
+        popularity = dict.fromkeys(cls.model.objects.order_by("id").values_list("tag", flat=True), 0)
+        for through in (Mentor.stacks.through, User.learning_stacks.through):
+            counts = through.objects.values("stacks__tag").annotate(count=Count("pk"))
+            for tag, count in counts.values_list("stacks__tag", "count"):
+                popularity[tag] += count
+        return popularity
 
     @classmethod
     def create_trie(cls):
         """
-        Initializes the trie with all the stack tags in the database
+        Initializes the trie with all the stack tags in the database, weighted by popularity
+        """
+        with cls.trie_lock:
+            version = cache.get(TRIE_VERSION_KEY, 0)
+            published = cache.get(TRIE_WEIGHTS_KEY)
+            popularity = cls.get_popularity()
+            trie = build_trie(cls.trie_engine)
+            trie.initialize(list(popularity), weights=popularity)
+            cls.trie = trie
+            cls.trie_version = version
+            cls.trie_weights_generation = published and published[0]
+            cls.trie_loaded = True
+
+    @classmethod
+    def save_trie_snapshot(cls, path):
+        """
+        Writes the trie to a snapshot file, with the journal version and weights generation it is up
+        to date with
+        """
+        save_trie(cls.trie, path, version=cls.trie_version, generation=cls.trie_weights_generation)
+
+    @classmethod
+    def load_trie_snapshot(cls, path):
+        """
+        Replaces the trie with a snapshot file written by save_trie_snapshot. The file is memory mapped
+        read-only, so workers share its pages and loading does not query the database. The changes
+        published after the snapshot was written are replayed by the next sync_trie.
+        The trie keeps the weights generation of the snapshot, and newer weights only give it private
+        weights and top completions: the nodes stay shared until a tag is inserted, renamed or
+        deleted, which copies them into the memory of the process.
+        A missing, stale or corrupt file is logged and ignored, leaving the trie to be created from
+        the database on first use. Returns whether the snapshot was loaded.
+        """
+        try:
+            trie, version, generation = load_trie(path, normalize=normalize_tag, variants=tag_variants)
+        except (OSError, ValueError, struct.error) as error:
+            logger.warning("Stacks trie snapshot %s not loaded, the trie will be created instead: %s", path, error)
+            return False
+        with cls.trie_lock:
+            cls.trie, cls.trie_version = trie, version
+            cls.trie_engine = "compact"
+            cls.trie_weights_generation = generation
+            cls.trie_checked_at = 0.0
+            cls.trie_loaded = True
+        return True
+
+    @classmethod
+    def publish_trie_change(cls, action, value):
+        """
+        Records a change in the shared journal, then syncs the trie of this process. The change is
+        the insertion ("insert") or deletion ("delete") of a tag, or the rename ("rename") of a tag
+        given as a (previous tag, tag) tuple.
+        """
+        cache.add(TRIE_VERSION_KEY, 0, timeout=None)
+        version = cache.incr(TRIE_VERSION_KEY)
+        cache.set(TRIE_CHANGE_KEY.format(version), (action, value), TRIE_CHANGE_TIMEOUT)
+        cls.sync_trie()
+
+    @classmethod
+    def publish_trie_weights(cls):
+        """
+        Recounts the popularity of every tag (see get_popularity) and publishes it as the weights of
+        the trie of every process, in chunks of TRIE_WEIGHTS_CHUNK_SIZE tags written before the key
+        pointing to them. Returns the number of tags published.
+        """
+        popularity = list(cls.get_popularity().items())
+        generation = uuid.uuid4().hex
+        starts = range(0, len(popularity), TRIE_WEIGHTS_CHUNK_SIZE)
+        chunks = {
+            TRIE_WEIGHTS_CHUNK_KEY.format(generation, index): dict(popularity[start:start + TRIE_WEIGHTS_CHUNK_SIZE])
+            for index, start in enumerate(starts)
+        }
+        cache.set_many(chunks, TRIE_CHANGE_TIMEOUT)
+        cache.set(TRIE_WEIGHTS_KEY, (generation, len(chunks)), TRIE_CHANGE_TIMEOUT)
+        return len(popularity)
+
+    @classmethod
+    def check_trie_weights(cls):
+        """
+        Starts a thread applying the last published weights, unless the trie already has them or a
+        thread is already applying weights
+        """
+        published = cache.get(TRIE_WEIGHTS_KEY)
+        if published is None or published[0] == cls.trie_weights_generation:
+            return
+        if not cls.weights_lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+            return
+        cls.weights_thread = threading.Thread(target=cls.apply_trie_weights, args=(published,), daemon=True)
+        cls.weights_thread.start()
+
+    @classmethod
+    def apply_trie_weights(cls, published):
+        """
+        Weights a copy of the trie with the published (generation, number of chunks) weights, then
+        replaces the trie with it, unless the trie changed meanwhile: the next check tries again.
+        Chunks no longer in the cache leave the weights as they are until the next publication.
+        Releases weights_lock, held by check_trie_weights.
+        """
+        try:
+            generation, count = published
+            keys = [TRIE_WEIGHTS_CHUNK_KEY.format(generation, index) for index in range(count)]
+            chunks = cache.get_many(keys)
+            if len(chunks) != len(keys):
+                cls.trie_weights_generation = generation
+                return
+            weights = {}
+            for key in keys:
+                weights.update(chunks[key])
+            trie = cls.trie
+            weighted = trie.copy()
+            weighted.set_weights(weights)
+            with cls.trie_lock:
+                if cls.trie is trie:
+                    cls.trie = weighted
+                    cls.trie_weights_generation = generation
+        finally:
+            cls.weights_lock.release()
+
+    @classmethod
+    def sync_trie(cls):
+        """
+        Applies the journal entries published since the last sync, or rebuilds the trie when some of
+        them are no longer available.
+        """
+        cls.trie_checked_at = time.monotonic()
+        if cache.get(TRIE_VERSION_KEY, 0) == cls.trie_version:
+            return
+        with cls.trie_lock:
+            version = cache.get(TRIE_VERSION_KEY, 0)
+            if version == cls.trie_version:
+                return
+            if not cls.trie_version < version <= cls.trie_version + TRIE_MAX_REPLAY:
+                cls.create_trie()
+                return
+            keys = [TRIE_CHANGE_KEY.format(number) for number in range(cls.trie_version + 1, version + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) != len(keys):
+                cls.create_trie()
+                return
+            trie = cls.trie.copy()
+            for key in keys:
+                action, value = changes[key]
+                if action == "insert":
+                    trie.insert(value)
+                elif action == "rename":
+                    previous_tag, tag = value
+                    weight = trie.weights.get(trie.normalize(previous_tag))
+                    trie.delete(previous_tag)
+                    trie.insert(tag, weight)
+                else:
+                    trie.delete(value)
+            cls.trie = trie
+            cls.trie_version = version
+
+    @classmethod
+    def refresh_trie(cls):
+        """
+        Creates the trie on first use, then syncs it and checks the published weights at most every
+        STACKS_TRIE_SYNC_INTERVAL seconds
+        """
+        if not cls.trie_loaded:
+            cls.create_trie()
+        elif time.monotonic() - cls.trie_checked_at >= getattr(settings, "STACKS_TRIE_SYNC_INTERVAL", 1):
+            cls.sync_trie()
+            cls.check_trie_weights()
+
+    @classmethod
+    def autocomplete(cls, query, limit=None, fuzzy=False):
+        """
+        Returns a list of stack tags that match the input query.
+        With a limit, returns only the limit most popular tags, most popular first.
+        With fuzzy, also returns the tags starting with a few typos of the query (see fuzzy_distance),
+        closest first.
+        """
+        cls.refresh_trie()
+        return cls.search_trie(query, limit=limit, fuzzy=fuzzy)
+
+    @classmethod
+    async def aautocomplete(cls, query, limit=None, fuzzy=False):
+        """
+        Async version of autocomplete: only creating or syncing the trie leaves the event loop
+        """
+        await cls.arefresh_trie()
+        return cls.search_trie(query, limit=limit, fuzzy=fuzzy)
+
+    @classmethod
+    async def arefresh_trie(cls):
+        """
+        Async version of refresh_trie
+        """
+        interval = getattr(settings, "STACKS_TRIE_SYNC_INTERVAL", 1)
+        if not cls.trie_loaded or time.monotonic() - cls.trie_checked_at >= interval:
+            await sync_to_async(cls.refresh_trie)()
+
+    @classmethod
+    def search_trie(cls, query, limit=None, fuzzy=False):
+        """
+        Searches the trie as it is, see autocomplete
+        """
+        trie = cls.trie
+        if fuzzy:
+            return trie.find_fuzzy(query, max_distance=fuzzy_distance(query), limit=limit)
+        if limit is not None:
+            return trie.find_top_k(query, limit)
+        return trie.find_words(query)
+
+    @classmethod
+    def autocomplete_key(cls, query, limit=None, fuzzy=False):
+        """
+        Returns a key identifying the results of autocomplete(query, limit, fuzzy) at the current trie
+        version and weights: queries normalizing to the same tag share it, and any change to the tags
+        or their weights changes it.
+        """
+        cls.refresh_trie()
+        digest = blake2b(f"{normalize_tag(query)}|{limit}|{fuzzy}".encode(), digest_size=16).hexdigest()
+        return f"{cls.trie_version}-{cls.trie_weights_generation}-{digest}"
+
+    @classmethod
+    def cached_autocomplete(cls, query, limit=None, fuzzy=False):
+        """
+        Returns autocomplete(query, limit, fuzzy), computed once per autocomplete_key and kept in the
+        cache so that every process serves repeated keystrokes without walking its trie.
         """
-        stacks = cls.model.objects.all()
-        stacks = [stack.tag for stack in stacks]
-        cls.trie.initialize(stacks)
+        key = AUTOCOMPLETE_CACHE_KEY.format(cls.autocomplete_key(query, limit, fuzzy))
+        results = cache.get(key)
+        if results is None:
+            results = cls.autocomplete(query, limit=limit, fuzzy=fuzzy)
+            cache.set(key, results)
+        return results
 
     @classmethod
-    def autocomplete(cls, query):
+    async def acached_autocomplete(cls, query, limit=None, fuzzy=False):
         """
-        Returns a list of stack tags that match the input query
+        Async version of cached_autocomplete
         """
-        return cls.trie.find_words(query)
+        await cls.arefresh_trie()
+        digest = blake2b(f"{normalize_tag(query)}|{limit}|{fuzzy}".encode(), digest_size=16).hexdigest()
+        key = AUTOCOMPLETE_CACHE_KEY.format(f"{cls.trie_version}-{cls.trie_weights_generation}-{digest}")
+        results = await cache.aget(key)
+        if results is None:
+            results = cls.search_trie(query, limit=limit, fuzzy=fuzzy)
+            await cache.aset(key, results)
+        return results
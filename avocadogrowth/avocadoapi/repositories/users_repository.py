@@ -6,43 +6,88 @@ to interact with the model directly.
 """
 from django.contrib.auth import get_user_model
 from .base import BaseRepository
+from .identity_map import remember
 from .mentors import MentorRepository
 from .stacks import StackRepository
 
 
 class UserRepository(BaseRepository):
     model = get_user_model()
+    cached_fields = ("email",)
 
     @classmethod
     def create(cls, **kwargs):
         # pylint: disable=missing-function-docstring
-        return cls.model.objects.create_user(**kwargs)
+        return remember(cls.model.objects.create_user(**kwargs))
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        """
+        Async version of create: same checks and password hashing as create_user
+        """
+        user = cls.build(kwargs)
+        await user.asave()
+        return remember(user)
+
+    @classmethod
+    def build(cls, fields):
+        """
+        Returns an unsaved user built as create_user builds it: normalized email, other fields set
+        one by one, hashed password
+        """
+        fields = dict(fields)
+        if "email" not in fields:
+            raise ValueError("Email is required")
+        if "password" not in fields:
+            raise ValueError("Password is required")
+        password = fields.pop("password")
+        user = cls.model(email=cls.model.objects.normalize_email(fields.pop("email")))
+        for key, value in fields.items():
+            setattr(user, key, value)
+        user.set_password(password)
+        return user
 
     @classmethod
     def add_mentor(cls, user, mentor):
         # pylint: disable=missing-function-docstring
         user.mentors.add(mentor)
-        user.save()
 
     @classmethod
     def remove_mentor(cls, user, mentor):
         # pylint: disable=missing-function-docstring
         user.mentors.remove(mentor)
-        user.save()
 
     @classmethod
     def add_learning_stack(cls, user, stack_tag):
         # pylint: disable=missing-function-docstring
-        stack = StackRepository.get(tag=stack_tag)
-        user.learning_stacks.add(stack)
-        user.save()
+        cls.add_learning_stacks(user, [stack_tag])
+
+    @classmethod
+    def add_learning_stacks(cls, user, tags, create_missing=False):
+        """
+        Adds the stacks of the given tags to the learning stacks of user: one query resolves the tags
+        (see StackRepository.get_by_tags), one bulk insert writes the missing links.
+        Returns the stacks.
+        """
+        stacks = StackRepository.get_by_tags(tags, create_missing=create_missing)
+        user.learning_stacks.add(*stacks)
+        return stacks
+
+    @classmethod
+    def set_learning_stacks(cls, user, tags, create_missing=False):
+        """
+        Replaces the learning stacks of user with the stacks of the given tags, deleting and inserting
+        only the links that change. Returns the stacks.
+        """
+        stacks = StackRepository.get_by_tags(tags, create_missing=create_missing)
+        user.learning_stacks.set(stacks)
+        return stacks
 
     @classmethod
     def remove_learning_stack(cls, user, stack):
         # pylint: disable=missing-function-docstring
-        stack = StackRepository.get(tag=stack)
+        stack = StackRepository.get_by_tag(stack)
         user.learning_stacks.remove(stack)
-        user.save()
 
     @classmethod
     def get_learning_stacks(cls, user):
@@ -52,7 +97,12 @@ class UserRepository(BaseRepository):
     @classmethod
     def is_mentor(cls, user):
         # pylint: disable=missing-function-docstring
-        return user.is_mentor()
+        return MentorRepository.get(user=user) is not None
+
+    @classmethod
+    async def ais_mentor(cls, user):
+        # pylint: disable=missing-function-docstring
+        return await MentorRepository.aget(user=user) is not None
 
     @classmethod
     def get_mentors(cls, user):
@@ -63,3 +113,8 @@ class UserRepository(BaseRepository):
     def get_mentor_infos(cls, user):
         # pylint: disable=missing-function-docstring
         return MentorRepository.get(user=user)
+
+    @classmethod
+    async def aget_mentor_infos(cls, user):
+        # pylint: disable=missing-function-docstring
+        return await MentorRepository.aget(user=user)
@@ -0,0 +1,170 @@
+"""
+Signal receivers keeping derived data in sync with the models.
+"""
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Comments, Mentor, Requests, Stacks
+from .repositories.base import defer_to_bulk_delete
+from .repositories.mentors import MentorRepository
+from .repositories.stacks import StackRepository
+
+
+@receiver(pre_save, sender=Stacks)
+def remember_previous_tag(sender, instance, raw, **kwargs):
+    """
+    Keeps the tag stored in the database before the save, to detect renames. Instances loaded from
+    the database already know it (see TrackedModel), others query it.
+    """
+    # pylint: disable=unused-argument
+    if raw or instance.pk is None:
+        instance.previous_tag = None
+        return
+    loaded_values = getattr(instance, "loaded_values", {})
+    if "tag" in loaded_values:
+        instance.previous_tag = loaded_values["tag"]
+        return
+    instance.previous_tag = sender.objects.filter(pk=instance.pk).values_list("tag", flat=True).first()
+
+
+@receiver(post_save, sender=Stacks)
+def insert_stack_in_trie(sender, instance, created, raw, **kwargs):
+    """
+    Publishes new and renamed tags to the autocomplete trie once the transaction is committed.
+    """
+    # pylint: disable=unused-argument
+    if raw:
+        return
+    previous_tag = getattr(instance, "previous_tag", None)
+    tag = instance.tag
+    if not created and previous_tag == tag:
+        return
+
+    def publish():
+        if previous_tag is not None:
+            StackRepository.publish_trie_change("rename", (previous_tag, tag))
+        else:
+            StackRepository.publish_trie_change("insert", tag)
+
+    transaction.on_commit(publish)
+
+
+@receiver(post_delete, sender=Stacks)
+def delete_stack_from_trie(sender, instance, **kwargs):
+    """
+    Publishes deleted tags to the autocomplete trie once the transaction is committed. Tags deleted
+    by bulk_delete are published at once by StackRepository.bulk_changed.
+    """
+    # pylint: disable=unused-argument
+    if defer_to_bulk_delete(sender, instance):
+        return
+    tag = instance.tag
+    transaction.on_commit(lambda: StackRepository.publish_trie_change("delete", tag))
+
+
+@receiver(post_delete, sender=Mentor)
+def unindex_deleted_mentor(sender, instance, **kwargs):
+    """
+    Removes deleted mentors, cascades included, from the mentor index. Mentors deleted by bulk_delete
+    make every process rebuild it (see MentorRepository.bulk_changed).
+    """
+    # pylint: disable=unused-argument
+    if defer_to_bulk_delete(sender, instance):
+        return
+    MentorRepository.unindex_mentor(instance.pk)
+
+
+@receiver(pre_save, sender=Requests)
+def remember_previous_status(sender, instance, raw, **kwargs):
+    """
+    Keeps the mentor and status of a request stored in the database before the save, to move it
+    between the request counters of mentors. Instances loaded from the database already know them
+    (see TrackedModel), others query them.
+    """
+    # pylint: disable=unused-argument
+    instance.previous_counted = None
+    if raw or instance.pk is None:
+        return
+    loaded_values = getattr(instance, "loaded_values", {})
+    if "to_mentor_id" in loaded_values and "status" in loaded_values:
+        instance.previous_counted = (loaded_values["to_mentor_id"], loaded_values["status"])
+        return
+    instance.previous_counted = sender.objects.filter(pk=instance.pk).values_list("to_mentor_id", "status").first()
+
+
+@receiver(post_save, sender=Requests)
+def count_saved_request(sender, instance, created, raw, **kwargs):
+    """
+    Updates the request counters of mentors for created requests and changes of status or mentor.
+    """
+    # pylint: disable=unused-argument
+    if raw:
+        return
+    previous = None if created else getattr(instance, "previous_counted", None)
+    current = (instance.to_mentor_id, instance.status)
+    if previous == current:
+        return
+    if previous is not None and previous[0] != current[0]:
+        MentorRepository.count_request(previous[0], previous_status=previous[1])
+        previous = None
+    MentorRepository.count_request(current[0], status=current[1], previous_status=previous and previous[1])
+
+
+@receiver(post_delete, sender=Requests)
+def count_deleted_request(sender, instance, **kwargs):
+    """
+    Removes deleted requests from the request counters of mentors.
+    """
+    # pylint: disable=unused-argument
+    if defer_to_bulk_delete(sender, instance):
+        return
+    MentorRepository.count_request(instance.to_mentor_id, previous_status=instance.status)
+
+
+@receiver(pre_save, sender=Comments)
+def remember_previous_rating(sender, instance, raw, **kwargs):
+    """
+    Keeps the mentor and rating of a comment stored in the database before the save, to update the
+    ratings of mentors. Instances loaded from the database already know them (see TrackedModel),
+    others query them.
+    """
+    # pylint: disable=unused-argument
+    instance.previous_rated = None
+    if raw or instance.pk is None:
+        return
+    loaded_values = getattr(instance, "loaded_values", {})
+    if "to_user_id" in loaded_values and "rating" in loaded_values:
+        instance.previous_rated = (loaded_values["to_user_id"], loaded_values["rating"])
+        return
+    instance.previous_rated = sender.objects.filter(pk=instance.pk).values_list("to_user_id", "rating").first()
+
+
+@receiver(post_save, sender=Comments)
+def rate_saved_comment(sender, instance, created, raw, **kwargs):
+    """
+    Updates the ratings of mentors for created comments and changes of rating or mentor.
+    """
+    # pylint: disable=unused-argument
+    if raw:
+        return
+    previous = None if created else getattr(instance, "previous_rated", None)
+    current = (instance.to_user_id, instance.rating)
+    if previous == current:
+        return
+    if previous is not None and previous[0] != current[0]:
+        MentorRepository.count_rating(previous[0], previous_rating=previous[1])
+        previous = None
+    MentorRepository.count_rating(current[0], rating=current[1], previous_rating=previous and previous[1])
+
+
+@receiver(post_delete, sender=Comments)
+def rate_deleted_comment(sender, instance, **kwargs):
+    """
+    Removes the ratings of deleted comments from the ratings of mentors.
+    """
+    # pylint: disable=unused-argument
+    if defer_to_bulk_delete(sender, instance):
+        return
+    MentorRepository.count_rating(instance.to_user_id, previous_rating=instance.rating)
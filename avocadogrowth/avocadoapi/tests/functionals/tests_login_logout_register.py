@@ -1,4 +1,7 @@
-from django.test import TestCase, Client
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, Client
 from django.contrib.auth import get_user_model
 
 from avocadoapi.repositories.repository_factory import RepositoryFactory
@@ -27,6 +30,20 @@ class TestLoginLogoutRegister(TestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.content, b'User created successfully')
 
+    def test_register_extra_fields(self):
+        response = self.client.post(
+            "/api/register/",
+            {
+                "email": "test@register.com",
+                "password": "testpassword",
+                "first_name": "Test",
+                "csrfmiddlewaretoken": "token",
+            }
+        )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.user_repo.get(email="test@register.com").first_name, "Test")
+
     def test_register_missing_data(self):
         response = self.client.post(
             "/api/register/",
@@ -116,3 +133,35 @@ class TestLoginLogoutRegister(TestCase):
         response = self.client.post('/api/logout/')
         self.assertEqual(response.status_code, 405)
         self.assertEqual(response.content, b'You are not logged in')
+
+
+class TestAsyncViews(TestCase):
+
+    def setUp(self):
+        self.client = AsyncClient()
+        self.credentials = {
+            "email": "test@test.com",
+            "password": "testpassword"
+        }
+        RepositoryFactory.create_repository("user").create(**self.credentials)
+
+    async def test_register_login_dashboard_logout(self):
+        response = await self.client.post("/api/register/", {"email": "async@test.com", "password": "testpassword"})
+        self.assertEqual(response.status_code, 201)
+        response = await self.client.get("/api/dashboard/")
+        self.assertEqual(response.status_code, 302)
+        response = await self.client.post("/api/login/", {"email": "async@test.com", "password": "testpassword"})
+        self.assertEqual(response.status_code, 302)
+        response = await self.client.get("/api/dashboard/")
+        self.assertEqual(response.content, b"Welcome, async@test.com!")
+        response = await self.client.post("/api/logout/")
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.post("/api/logout/")
+        self.assertEqual(response.status_code, 405)
+
+    def test_benchmark_views(self):
+        output = StringIO()
+        call_command("benchmark_views", requests=10, concurrency=2, stdout=output)
+        assert "async dashboard" in output.getvalue()
+        assert "sync login" in output.getvalue()
+        assert not get_user_model().objects.filter(email="benchmark-views@avocado.test").exists()
@@ -0,0 +1,75 @@
+from django.core.cache import cache
+from django.test import TestCase, Client
+
+from avocadoapi.repositories.repository_factory import RepositoryFactory
+from avocadoapi.repositories.stacks import StackRepository
+
+
+class TestStacksAutocomplete(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.stack_repo = RepositoryFactory.create_repository("stack")
+        for tag in ["python", "pytorch", "java"]:
+            self.stack_repo.create(tag=tag)
+        self.stack_repo.create_trie()
+
+    def test_autocomplete(self):
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "py"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"query": "py", "results": ["python", "pytorch"]})
+        assert response.has_header("ETag")
+        assert "max-age=60" in response["Cache-Control"]
+        assert "public" in response["Cache-Control"]
+
+    def test_autocomplete_limit_and_fuzzy(self):
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "jaav", "limit": 1, "fuzzy": "true"})
+
+        self.assertEqual(response.json()["results"], ["java"])
+
+    def test_autocomplete_invalid_limit(self):
+        for limit in ["abc", "0", "1000"]:
+            response = self.client.get("/api/stacks/autocomplete/", {"q": "py", "limit": limit})
+            self.assertEqual(response.status_code, 400)
+
+    def test_autocomplete_query_too_long(self):
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "p" * 61, "fuzzy": "true"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_autocomplete_method_not_allowed(self):
+        response = self.client.post("/api/stacks/autocomplete/", {"q": "py"})
+
+        self.assertEqual(response.status_code, 405)
+
+    def test_autocomplete_not_modified(self):
+        etag = self.client.get("/api/stacks/autocomplete/", {"q": "py"})["ETag"]
+
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "PY "}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_autocomplete_etag_changes_with_stacks(self):
+        etag = self.client.get("/api/stacks/autocomplete/", {"q": "py"})["ETag"]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stack_repo.create(tag="pyramid")
+
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "py"}, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["results"], ["pyramid", "python", "pytorch"])
+
+    def test_autocomplete_results_are_cached(self):
+        self.client.get("/api/stacks/autocomplete/", {"q": "py"})
+        trie = StackRepository.trie.copy()
+        trie.delete("python")
+        StackRepository.trie = trie
+
+        response = self.client.get("/api/stacks/autocomplete/", {"q": "py"})
+
+        self.assertEqual(response.json()["results"], ["python", "pytorch"])
@@ -1,6 +1,11 @@
-from django.test import TestCase
+import tempfile
 
-from avocadoapi.models import User, Mentor, Comments, Stacks
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_save, pre_save
+from django.test import TestCase, override_settings
+
+from avocadoapi.models import User, Mentor, Comments, Requests, Stacks
 
 user_john = {
     "first_name": "John",
@@ -83,8 +88,8 @@ class UserTestCase(TestCase):
         assert not User.objects.filter(email="john@doe.com").exists()
 
     def test_user_cannot_have_same_email(self):
-        with self.assertRaises(Exception):
-            User.objects.create(**self.user_john)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            User.objects.create(**user_john)
 
 
 class TestMentorModel(TestCase):
@@ -159,6 +164,36 @@ class TestMentorModel(TestCase):
         john = User.objects.get(email="john@doe.com")
         self.assertEqual(john.mentors.count(), 0)
 
+    def test_get_requests(self):
+        john = User.objects.get(email="john@doe.com")
+        jerry = User.objects.get(email="jerry@doe.com")
+        jane = User.objects.get(email="jane@doe.com")
+        first = Requests.objects.create(content="Help", from_user=john, to_mentor=jerry, status="P")
+        second = Requests.objects.create(content="Help", from_user=jane, to_mentor=jerry, status="A")
+        Requests.objects.create(content="Help", from_user=jerry, to_mentor=john, status="P")
+        mentor = Mentor.objects.get(user=jerry)
+        self.assertEqual(list(mentor.get_requests()), [second, first])
+
+    def test_request_counters(self):
+        john = User.objects.get(email="john@doe.com")
+        jerry = User.objects.get(email="jerry@doe.com")
+        request = Requests.objects.create(content="Help", from_user=john, to_mentor=jerry, status="P")
+        Requests.objects.create(content="Help", from_user=john, to_mentor=jerry, status="P")
+        mentor = Mentor.objects.get(user=jerry)
+        self.assertEqual((mentor.pending_requests, mentor.accepted_requests, mentor.rejected_requests), (2, 0, 0))
+        request.status = "A"
+        request.save()
+        request = Requests.objects.get(pk=request.pk)
+        request.content = "Help me"
+        request.save()
+        mentor.refresh_from_db()
+        self.assertEqual((mentor.pending_requests, mentor.accepted_requests, mentor.rejected_requests), (1, 1, 0))
+        request.status = "R"
+        request.save()
+        request.delete()
+        mentor.refresh_from_db()
+        self.assertEqual((mentor.pending_requests, mentor.accepted_requests, mentor.rejected_requests), (1, 0, 0))
+
 
 def setUpComments():
     john = User.objects.get(email="john@doe.com")
@@ -237,6 +272,25 @@ class TestCommentsModel(TestCase):
         Comments.objects.all().delete()
         self.assertEqual(Comments.objects.count(), 0)
 
+    def test_mentor_rating(self):
+        setUpComments()
+        john = User.objects.get(email="john@doe.com")
+        jerry = Mentor.objects.get(user=User.objects.get(email="jerry@doe.com"))
+        self.assertEqual((jerry.rating, jerry.rating_sum, jerry.rating_count), (5, 5, 1))
+        comment = Comments.objects.create(comment="Good", rating=2, from_user=john, to_user=jerry)
+        Comments.objects.create(comment="No rating", from_user=john, to_user=jerry)
+        jerry.refresh_from_db()
+        self.assertEqual((jerry.rating, jerry.rating_count), (3.5, 2))
+        comment.rating = 4
+        comment.save()
+        jerry.refresh_from_db()
+        self.assertEqual((jerry.rating, jerry.rating_count), (4.5, 2))
+        Comments.objects.get(rating=5).delete()
+        comment.delete()
+        jerry.refresh_from_db()
+        self.assertEqual((jerry.rating, jerry.rating_sum, jerry.rating_count), (None, 0, 0))
+        self.assertEqual(jerry.score, None)
+
 
 class TestStacksModel(TestCase):
     def setUp(self):
@@ -317,6 +371,16 @@ class TestStacksModel(TestCase):
         stack = Stacks.objects.get(id=1)
         self.assertEqual(stack.tag, "Python")
 
+    def test_stack_normalized_tag(self):
+        csharp = Stacks(tag="C-Sharp")
+        csharp.save()
+        assert Stacks.objects.get(normalized_tag="c#") == csharp
+        csharp.tag = "Données"
+        csharp.save(update_fields=["tag"])
+        assert Stacks.objects.get(normalized_tag="donnees") == csharp
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Stacks.objects.create(tag="donnees")
+
     def test_stack_retrieving_with_tag(self):
         python = Stacks(tag="Python")
         python.save()
@@ -345,3 +409,96 @@ class TestStacksModel(TestCase):
         java.save()
         Stacks.objects.all().delete()
         self.assertEqual(Stacks.objects.count(), 0)
+
+
+class TestTrackedModel(TestCase):
+
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+
+    def test_dirty_fields(self):
+        user = User.objects.get(email="john@doe.com")
+        self.assertEqual(user.get_dirty_fields(), [])
+        user.first_name = "Johnny"
+        user.urls = {"github": "johnny"}
+        self.assertEqual(user.get_dirty_fields(), ["first_name", "urls"])
+        user.save()
+        self.assertEqual(user.get_dirty_fields(), [])
+        user.urls["gitlab"] = "johnny"
+        self.assertEqual(user.get_dirty_fields(), ["urls"])
+
+    def test_file_upload_is_saved(self):
+        user = User.objects.get(email="john@doe.com")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            user.profile_picture.save("pic.png", ContentFile(b"picture"))
+            self.assertEqual(user.get_dirty_fields(), [])
+            self.assertEqual(User.objects.get(pk=user.pk).profile_picture.name, "profile_pictures/pic.png")
+
+    def test_save_writes_changed_fields_only(self):
+        user = User.objects.get(email="john@doe.com")
+        user.first_name = "Johnny"
+        with self.assertNumQueries(1) as queries:
+            user.save()
+        sql = queries.captured_queries[0]["sql"]
+        assert '"first_name"' in sql and '"updated_at"' in sql
+        assert '"email"' not in sql and '"password"' not in sql
+        self.assertEqual(User.objects.get(email="john@doe.com").first_name, "Johnny")
+
+    def test_save_without_changes(self):
+        mentor = Mentor.objects.get(user__email="jerry@doe.com")
+        updated_at = mentor.updated_at
+        with self.assertNumQueries(0):
+            mentor.save()
+        mentor.stacks.add(Stacks.objects.create(tag="python"))
+        mentor.refresh_from_db()
+        self.assertEqual(mentor.updated_at, updated_at)
+
+    def test_save_without_changes_sends_no_signals(self):
+        saved = []
+
+        def receiver(sender, instance, **kwargs):
+            # pylint: disable=unused-argument
+            saved.append(kwargs["signal"])
+
+        for signal in (pre_save, post_save):
+            signal.connect(receiver, sender=Mentor)
+            self.addCleanup(signal.disconnect, receiver, sender=Mentor)
+        mentor = Mentor.objects.get(user__email="jerry@doe.com")
+        mentor.save()
+        self.assertEqual(saved, [])
+        mentor.save(update_fields=["description"])
+        self.assertEqual(saved, [pre_save, post_save])
+        mentor.description = "Mentor"
+        mentor.save()
+        self.assertEqual(saved, [pre_save, post_save] * 2)
+
+    def test_refresh_from_db_remembers_fields(self):
+        mentor = Mentor.objects.get(user__email="jerry@doe.com")
+        Mentor.objects.filter(pk=mentor.pk).update(description="Updated")
+        mentor.refresh_from_db(fields=["description"])
+        self.assertEqual(mentor.description, "Updated")
+        self.assertEqual(mentor.get_dirty_fields(), [])
+
+    def test_copy_row(self):
+        stack = Stacks.objects.get(pk=Stacks.objects.create(tag="python").pk)
+        stack.pk = None
+        stack.tag = "python3"
+        stack.save()
+        self.assertEqual(sorted(Stacks.objects.values_list("tag", flat=True)), ["python", "python3"])
+        self.assertEqual(stack.get_dirty_fields(), [])
+
+    def test_save_after_delete(self):
+        stack = Stacks.objects.get(pk=Stacks.objects.create(tag="python").pk)
+        stack.delete()
+        stack.save()
+        self.assertEqual(Stacks.objects.get(tag="python").pk, stack.pk)
+
+    def test_stack_rename_without_query(self):
+        stack = Stacks.objects.create(tag="python")
+        stack = Stacks.objects.get(pk=stack.pk)
+        stack.tag = "Python3"
+        with self.assertNumQueries(1):
+            stack.save()
+        self.assertEqual(stack.previous_tag, "python")
+        self.assertEqual(Stacks.objects.get(normalized_tag="python3").tag, "Python3")
@@ -1,6 +1,24 @@
-from django.test import TestCase
-from avocadoapi.models import User, Mentor, Stacks, Requests
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.apps import apps
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models.deletion import Collector
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from avocadoapi.middleware import IdentityMapMiddleware
+from avocadoapi.models import Comments, User, Mentor, Stacks, Requests
+from avocadoapi.repositories.identity_map import identity_map, identity_map_scope
 from avocadoapi.repositories.repository_factory import RepositoryFactory
+from avocadoapi.repositories.row_cache import cached_get, row_key, version_key
+from avocadoapi.repositories.stacks import TRIE_CHANGE_KEY, TRIE_VERSION_KEY, TRIE_WEIGHTS_KEY
 
 user_john = {
     "first_name": "John",
@@ -126,6 +144,9 @@ class TestRepositoryFactory(TestCase):
         request_repo = RepositoryFactory.create_repository("request")
         assert request_repo.model == Requests
 
+        comment_repo = RepositoryFactory.create_repository("comment")
+        assert comment_repo.model == Comments
+
 
 class TestUserRepository(TestCase):
     def setUp(self):
@@ -183,6 +204,38 @@ class TestUserRepository(TestCase):
         user_repo.add_learning_stack(john, "scala")
         assert john.learning_stacks.count() == actual_stacks + 1
 
+    def test_add_learning_stacks(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        john = user_repo.get(email="john@doe.com")
+        tags = ["Python", "Java", "C-Sharp", "golang", "rust", "sql", "php", "ruby", "shell", "python "]
+        with self.assertNumQueries(2):
+            stacks = user_repo.add_learning_stacks(john, tags)
+        assert [stack.tag for stack in stacks][:4] == ["python", "java", "c#", "go"]
+        assert john.learning_stacks.count() == 9
+        with self.assertRaises(ValueError):
+            user_repo.add_learning_stacks(john, ["python", "Elixir"])
+        with self.assertRaises(ValueError):
+            user_repo.add_learning_stack(john, "Elixir")
+        assert john.learning_stacks.count() == 9
+
+    def test_add_learning_stacks_creating_missing(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        john = user_repo.get(email="john@doe.com")
+        with self.captureOnCommitCallbacks(execute=True):
+            stacks = user_repo.add_learning_stacks(john, ["python", "Elixir", "Zig"], create_missing=True)
+        assert [stack.tag for stack in stacks] == ["python", "Elixir", "Zig"]
+        assert all(stack.pk is not None for stack in stacks)
+        assert stack_repo.get_by_tag("zig") == stacks[2]
+        assert stack_repo.autocomplete("eli") == ["Elixir"]
+
+    def test_set_learning_stacks(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        jane = user_repo.get(email="jane@doe.com")
+        user_repo.set_learning_stacks(jane, ["python", "go"])
+        assert sorted(jane.learning_stacks.values_list("tag", flat=True)) == ["go", "python"]
+
     def test_remove_learning_stack(self):
         user_repo = RepositoryFactory.create_repository("user")
         jane = user_repo.get(email="jane@doe.com")
@@ -218,6 +271,131 @@ class TestMentorRepository(TestCase):
         mentor_repo.set_available(mentor_john)
         mentors = mentor_repo.get_mentor_by_stack("javascript")
         assert mentors[0].user == user_repo.get(email="john@doe.com")
+        mentors = mentor_repo.get_mentor_by_stack("CSharp")
+        assert mentors[0].user == user_repo.get(email="john@doe.com")
+
+    def test_get_mentor_by_stack_pages(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        python = Stacks.objects.get(tag="python")
+        for index in range(5):
+            user = User.objects.create(email=f"mentor{index}@doe.com", password="password")
+            mentor = Mentor.objects.create(user=user, rating=index or None, is_available=index != 2)
+            mentor.stacks.add(python)
+        with self.assertNumQueries(1):
+            emails = [mentor.user.email for mentor in mentor_repo.get_mentor_by_stack("python", page_size=2)]
+        assert emails == ["mentor4@doe.com", "mentor3@doe.com"]
+        mentors = mentor_repo.get_mentor_by_stack("python", page=2, page_size=2)
+        assert [mentor.rating for mentor in mentors] == [1, None]
+        assert len(mentor_repo.get_mentor_by_stack("python", page=3, page_size=2)) == 0
+        with self.assertNumQueries(2):
+            mentors = list(mentor_repo.get_mentor_by_stack("python", prefetch_stacks=True))
+            assert all(mentor.stacks.all()[0] == python for mentor in mentors)
+        with self.assertRaises(ValueError):
+            mentor_repo.get_mentor_by_stack("python", page=0)
+
+    def test_get_matching_mentors(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        jane = User.objects.get(email="jane@doe.com")
+        john = Mentor.objects.get(user__email="john@doe.com")
+        jerry = Mentor.objects.get(user__email="jerry@doe.com")
+        assert len(mentor_repo.get_matching_mentors(jane)) == 0
+        for mentor in (john, jerry):
+            mentor_repo.set_available(mentor)
+        # john and jerry share two stacks with jane: javascript/typescript and python/java
+        jerry.stacks.add(*Stacks.objects.filter(tag__in=["python", "java", "go"]))
+        jerry.rating = 4
+        jerry.save()
+        others = []
+        for index in range(3):
+            user = User.objects.create(email=f"mentor{index}@doe.com", password="password")
+            other = Mentor.objects.create(user=user, rating=5, history=index, is_available=True)
+            other.stacks.add(Stacks.objects.get(tag="python"))
+            others.append(other)
+        User.objects.get(email="john@doe.com").mentors.add(others[1])
+        User.objects.get(email="jerry@doe.com").mentors.add(others[1])
+        with self.assertNumQueries(1):
+            mentors = list(mentor_repo.get_matching_mentors(jane))
+        assert mentors == [jerry, john, others[2], others[1], others[0]]
+        assert [mentor.overlap for mentor in mentors] == [2, 2, 1, 1, 1]
+        assert mentors[3].load == 2
+        assert mentor_repo.get_matching_mentors(jane, limit=2)[1] == john
+        assert others[0] not in mentor_repo.get_matching_mentors(others[0].user)
+
+    def test_add_and_set_stacks(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        jerry = Mentor.objects.get(user__email="jerry@doe.com")
+        python, go = Stacks.objects.get(tag="python"), Stacks.objects.get(tag="go")
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(2):
+                mentor_repo.add_stacks(jerry, ["python", "java", "golang"])
+        assert jerry.stacks.count() == 3
+        assert mentor_repo.get_mentor_ids_by_stacks([python, go], available=False) == [jerry.pk]
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.set_stacks(jerry, ["python", "rust"])
+        assert sorted(jerry.stacks.values_list("tag", flat=True)) == ["python", "rust"]
+        assert mentor_repo.get_mentor_ids_by_stacks([go], available=False) == [
+            Mentor.objects.get(user__email="john@doe.com").pk
+        ]
+        assert mentor_repo.get_mentor_ids_by_stacks([python], available=False) == [jerry.pk]
+
+    def test_get_mentors_by_stacks(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        john = Mentor.objects.get(user__email="john@doe.com")
+        jerry = Mentor.objects.get(user__email="jerry@doe.com")
+        go, sql, python = (Stacks.objects.get(tag=tag) for tag in ["go", "sql", "python"])
+        assert mentor_repo.get_mentor_ids_by_stacks([go, sql]) == []
+        assert mentor_repo.get_mentor_ids_by_stacks([go, sql], available=False) == [john.pk]
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.set_available(john)
+            mentor_repo.update(jerry, is_available=True)
+            mentor_repo.add_stack(jerry, go)
+            mentor_repo.add_stack(jerry, python)
+        with self.assertNumQueries(0):
+            assert mentor_repo.get_mentor_ids_by_stacks([go]) == sorted([john.pk, jerry.pk])
+            assert mentor_repo.get_mentor_ids_by_stacks([go.pk, sql.pk]) == [john.pk]
+        assert list(mentor_repo.get_mentors_by_stacks([go, python])) == [jerry]
+        mentor_repo.update(john, rating=4)
+        assert list(mentor_repo.get_mentors_by_stacks([go])) == [john, jerry]
+        mentor_repo.update(jerry, rating=5)
+        assert list(mentor_repo.get_mentors_by_stacks([go])) == [jerry, john]
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.remove_stack(john, sql)
+            mentor_repo.update(jerry, is_available=False)
+        assert mentor_repo.get_mentor_ids_by_stacks([go]) == [john.pk]
+        assert mentor_repo.get_mentor_ids_by_stacks([go, sql]) == []
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.delete(john)
+        assert mentor_repo.get_mentor_ids_by_stacks([go], available=False) == [jerry.pk]
+
+    def test_create_available_mentor(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        go = Stacks.objects.get(tag="go")
+        user = User.objects.create(email="mentor@doe.com", password="password")
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor = mentor_repo.create(user=user, is_available=True)
+            mentor_repo.add_stack(mentor, go)
+        with self.assertNumQueries(0):
+            assert mentor_repo.get_mentor_ids_by_stacks([go]) == [mentor.pk]
+
+    def test_mentor_index_rebuilt_on_foreign_change(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        john = Mentor.objects.get(user__email="john@doe.com")
+        go = Stacks.objects.get(tag="go")
+        # Another process made john available and published the change
+        Mentor.objects.filter(pk=john.pk).update(is_available=True)
+        cache.add("mentors:index:version", 0, timeout=None)
+        cache.incr("mentors:index:version")
+        assert mentor_repo.get_mentor_ids_by_stacks([go]) == [john.pk]
+
+    def test_benchmark_mentor_index(self):
+        output = StringIO()
+        call_command("benchmark_mentor_index", mentors=50, stacks=5, queries=5, stdout=output, stderr=output)
+        assert "different" not in output.getvalue()
+        assert "Bitmap index" in output.getvalue()
 
 
 class TestStackRepository(TestCase):
@@ -233,6 +411,12 @@ class TestStackRepository(TestCase):
         stack_by_repo = stack_repo.get(tag="python")
         assert stack == stack_by_repo
 
+    def test_get_stack_by_tag(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        assert stack_repo.get_by_tag("Python") == Stacks.objects.get(tag="python")
+        assert stack_repo.get_by_tag("C-Sharp") == Stacks.objects.get(tag="c#")
+        assert stack_repo.get_by_tag("cobol") is None
+
     def test_get_all_stacks(self):
         stack_repo = RepositoryFactory.create_repository("stack")
         stacks = stack_repo.all()
@@ -243,10 +427,923 @@ class TestStackRepository(TestCase):
         stack_repo.create_trie()
         assert stack_repo.autocomplete("py") == ["python"]
         assert stack_repo.autocomplete("java") == ["java", "javascript"]
+        assert stack_repo.autocomplete("jx") == []
         assert stack_repo.autocomplete("Data") == [
-            "data",
-            "data science",
-            "data analysis",
-            "data engineering",
-            "data visualization",
+            "Data",
+            "Data Science",
+            "Data Analysis",
+            "Data Engineering",
+            "Data Visualization",
         ]
+
+    def test_stack_trie_returns_stored_tags(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        Stacks.objects.filter(tag="go").update(tag="Golang")
+        Stacks.objects.create(tag="Données")
+        for engine in ("default", "compact"):
+            stack_repo.set_trie_engine(engine)
+            stack_repo.create_trie()
+            assert stack_repo.autocomplete("gol") == ["Golang"]
+            assert stack_repo.autocomplete("go") == ["Golang"]
+            assert stack_repo.autocomplete("go", limit=5) == ["Golang"]
+            assert stack_repo.autocomplete("gola", fuzzy=True) == ["Golang"]
+            assert stack_repo.autocomplete("donne") == ["Données"]
+            assert stack_repo.autocomplete("Donné", limit=1) == ["Données"]
+        stack_repo.set_trie_engine("default")
+
+    def test_stack_trie_compact_engine(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.set_trie_engine("compact")
+        try:
+            stack_repo.create_trie()
+            assert stack_repo.autocomplete("java") == ["java", "javascript"]
+            with self.assertRaises(ValueError):
+                stack_repo.set_trie_engine("unknown")
+        finally:
+            stack_repo.set_trie_engine("default")
+
+    def test_stack_autocomplete_by_popularity(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        popularity = stack_repo.get_popularity()
+        assert popularity["python"] == 1
+        assert popularity["javascript"] == 2
+        assert popularity["haskell"] == 1
+        assert popularity["Data"] == 0
+        stack_repo.set_trie_engine("default")
+        stack_repo.create_trie()
+        assert stack_repo.autocomplete("java", limit=1) == ["javascript"]
+        assert stack_repo.autocomplete("java", limit=5) == ["javascript", "java"]
+
+    def test_stack_autocomplete_fuzzy(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        assert stack_repo.autocomplete("pyhton", fuzzy=True) == ["python"]
+        assert stack_repo.autocomplete("javscript", fuzzy=True) == ["javascript"]
+        assert stack_repo.autocomplete("Dta Sci", fuzzy=True, limit=1) == ["Data Science"]
+        # "C-Sharp" is searched as "c#", with the tolerance of "c#" it is cached under
+        assert stack_repo.cached_autocomplete("C-Sharp", fuzzy=True) == ["c#"]
+        assert stack_repo.cached_autocomplete("c#", fuzzy=True) == ["c#"]
+
+    def test_stack_trie_follows_stack_changes(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        with self.captureOnCommitCallbacks(execute=True):
+            pytorch = Stacks.objects.create(tag="pytorch")
+        assert stack_repo.autocomplete("py") == ["python", "pytorch"]
+        with self.captureOnCommitCallbacks(execute=True):
+            pytorch.tag = "pandas"
+            pytorch.save()
+        assert stack_repo.autocomplete("py") == ["python"]
+        assert stack_repo.autocomplete("pa") == ["pandas"]
+        with self.captureOnCommitCallbacks(execute=True):
+            pytorch.delete()
+        assert stack_repo.autocomplete("pa") == []
+
+    def test_stack_trie_renames_keep_popularity(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        javascript = Stacks.objects.get(tag="javascript")
+        with self.captureOnCommitCallbacks(execute=True):
+            javascript.tag = "javascript es6"
+            javascript.save()
+        assert stack_repo.autocomplete("java", limit=1) == ["javascript es6"]
+
+    @override_settings(STACKS_TRIE_SYNC_INTERVAL=0)
+    def test_stack_trie_popularity_follows_stacks_of_users(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        user_repo = RepositoryFactory.create_repository("user")
+        cache.delete(TRIE_WEIGHTS_KEY)
+        self.addCleanup(cache.delete, TRIE_WEIGHTS_KEY)
+        stack_repo.create_trie()
+        for email in ("john@doe.com", "jerry@doe.com"):
+            mentor_repo.add_stacks(Mentor.objects.get(user__email=email), ["java"])
+        user_repo.add_learning_stack(User.objects.get(email="jerry@doe.com"), "java")
+        key = stack_repo.autocomplete_key("java", limit=1)
+        assert stack_repo.autocomplete("java", limit=1) == ["javascript"]
+        with mock.patch("avocadoapi.repositories.stacks.TRIE_WEIGHTS_CHUNK_SIZE", 4):
+            output = StringIO()
+            call_command("publish_stack_weights", stdout=output)
+        assert f"{len(stack_list)} stack tags" in output.getvalue()
+        assert cache.get(TRIE_WEIGHTS_KEY)[1] == 7
+        # Syncing only starts the reweighting, which runs in its own thread
+        with self.assertNumQueries(0):
+            stack_repo.refresh_trie()
+        stack_repo.weights_thread.join()
+        assert stack_repo.autocomplete("java", limit=1) == ["java"]
+        assert stack_repo.autocomplete_key("java", limit=1) != key
+        thread = stack_repo.weights_thread
+        stack_repo.refresh_trie()
+        assert stack_repo.weights_thread is thread
+
+    @override_settings(STACKS_TRIE_SYNC_INTERVAL=0)
+    def test_stack_trie_weights_expired(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        self.addCleanup(cache.delete, TRIE_WEIGHTS_KEY)
+        stack_repo.create_trie()
+        trie = stack_repo.trie
+        cache.set(TRIE_WEIGHTS_KEY, ("expired", 2))
+        stack_repo.refresh_trie()
+        stack_repo.weights_thread.join()
+        assert stack_repo.trie is trie
+        assert stack_repo.trie_weights_generation == "expired"
+
+    def test_stack_trie_replays_other_processes_changes(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        cache.add(TRIE_VERSION_KEY, 0, timeout=None)
+        version = cache.incr(TRIE_VERSION_KEY)
+        cache.set(TRIE_CHANGE_KEY.format(version), ("insert", "pyspark"))
+        stack_repo.sync_trie()
+        assert stack_repo.trie_version == version
+        assert stack_repo.autocomplete("pys") == ["pyspark"]
+        version = cache.incr(TRIE_VERSION_KEY, 2)
+        stack_repo.sync_trie()
+        assert stack_repo.trie_version == version
+        assert stack_repo.autocomplete("pys") == []
+
+    def test_stack_trie_snapshot(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        cache.set(TRIE_WEIGHTS_KEY, ("f00d", 0))
+        self.addCleanup(cache.delete, TRIE_WEIGHTS_KEY)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stacks.bin")
+            call_command("dump_stacks_trie", path, stdout=StringIO())
+            stack_repo.load_trie_snapshot(path)
+            try:
+                assert stack_repo.trie_weights_generation == "f00d"
+                trie = stack_repo.trie
+                stack_repo.check_trie_weights()
+                assert stack_repo.trie is trie
+                assert trie.snapshot is not None
+                assert stack_repo.autocomplete("java") == ["java", "javascript"]
+                assert stack_repo.autocomplete("java", limit=1) == ["javascript"]
+            finally:
+                stack_repo.set_trie_engine("default")
+
+    def test_normalize_stack_tags_merges_duplicates(self):
+        go = Stacks.objects.get(tag="go")
+        Stacks.objects.filter(pk=go.pk).update(normalized_tag=None)
+        golang = Stacks.objects.create(tag="Golang")
+        mentor = Mentor.objects.get(user__email="john@doe.com")
+        jane = User.objects.get(email="jane@doe.com")
+        mentor.stacks.add(golang)
+        jane.learning_stacks.add(go, golang)
+        output = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("normalize_stack_tags", stdout=output)
+        assert "Merged 1 duplicate stacks" in output.getvalue()
+        assert not Stacks.objects.filter(pk=golang.pk).exists()
+        assert Stacks.objects.get(normalized_tag="go") == go
+        assert mentor.stacks.filter(pk=go.pk).exists()
+        assert list(jane.learning_stacks.filter(normalized_tag="go")) == [go]
+        assert RepositoryFactory.create_repository("stack").autocomplete("go") == ["go"]
+
+    def test_stale_stack_trie_snapshot_is_ignored_at_startup(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.trie_loaded = False
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stacks.bin")
+            with open(path, "wb") as file:
+                file.write(b"AVTRIE01" + bytes(120))
+            with override_settings(STACKS_TRIE_SNAPSHOT=path), self.assertLogs("avocadoapi", "WARNING") as logs:
+                apps.get_app_config("avocadoapi").ready()
+            assert path in logs.output[0]
+            assert not stack_repo.trie_loaded
+            assert stack_repo.autocomplete("java") == ["java", "javascript"]
+            call_command("dump_stacks_trie", path, stdout=StringIO())
+            assert stack_repo.load_trie_snapshot(path)
+            stack_repo.set_trie_engine("default")
+
+
+class TestRequestRepository(TestCase):
+    def setUp(self):
+        setUpUsers()
+        self.john = User.objects.get(email="john@doe.com")
+        self.jerry = User.objects.get(email="jerry@doe.com")
+        self.jane = User.objects.get(email="jane@doe.com")
+        Requests.objects.bulk_create(
+            Requests(content=f"Help {index}", from_user=self.jane, to_mentor=self.john, status="PAR"[index % 3])
+            for index in range(25)
+        )
+        Requests.objects.create(content="Help", from_user=self.jerry, to_mentor=self.john, status="P")
+        Requests.objects.create(content="Help", from_user=self.jane, to_mentor=self.jerry, status="P")
+
+    def test_get_requests_by_mentor(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        mentor = Mentor.objects.create(user=self.john)
+        ids = list(request_repo.get_requests_by_mentor(mentor).values_list("id", flat=True))
+        assert ids == sorted(Requests.objects.filter(to_mentor=self.john).values_list("id", flat=True), reverse=True)
+        assert request_repo.get_requests_by_mentor(self.john, status="A").count() == 8
+        assert request_repo.get_requests_by_user(self.jane, status="P").count() == 10
+
+    def test_inbox_pages(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        expected = list(Requests.objects.filter(to_mentor=self.john).order_by("-created_at", "-id"))
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = request_repo.get_inbox(self.john, cursor=cursor, page_size=10)
+                assert all(request.from_user.email for request in page.items)
+            pages.append(page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        assert [len(items) for items in pages] == [10, 10, 6]
+        assert [request for items in pages for request in items] == expected
+
+    def test_inbox_status_and_outbox(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        page = request_repo.get_inbox(self.john, status="P", page_size=5)
+        assert len(page.items) == 5 and all(request.status == "P" for request in page.items)
+        page = request_repo.get_inbox(self.john, status="P", cursor=page.next_cursor, page_size=5)
+        assert len(page.items) == 5 and page.next_cursor is None
+        page = request_repo.get_outbox(self.jane, page_size=30)
+        assert len(page.items) == 26 and page.next_cursor is None
+        with self.assertNumQueries(0):
+            assert {request.to_mentor.email for request in page.items} == {"john@doe.com", "jerry@doe.com"}
+
+    def test_inbox_uses_index(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        plan = request_repo.get_requests_by_mentor(self.john, status="P").explain()
+        assert "request_inbox_status_idx" in plan
+
+    def test_request_counters(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        request_repo = RepositoryFactory.create_repository("request")
+        john = Mentor.objects.create(user=self.john)
+        jerry = Mentor.objects.create(user=self.jerry)
+        assert mentor_repo.recount_requests() == 2
+        john.refresh_from_db()
+        assert (john.pending_requests, john.accepted_requests, john.rejected_requests) == (10, 8, 8)
+        with self.captureOnCommitCallbacks(execute=True):
+            request_repo.bulk_create(
+                [{"content": "Help", "from_user": self.john, "to_mentor": self.jerry, "status": "A"}]
+            )
+        jerry.refresh_from_db()
+        assert (jerry.pending_requests, jerry.accepted_requests) == (1, 1)
+        request = Requests.objects.filter(to_mentor=self.jerry, status="P").get()
+        request_repo.update(request, to_mentor=self.john)
+        john.refresh_from_db()
+        jerry.refresh_from_db()
+        assert (john.pending_requests, jerry.pending_requests) == (11, 0)
+
+    def test_bulk_operations_recount_their_mentors(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        john = Mentor.objects.create(user=self.john, pending_requests=99)
+        jerry = Mentor.objects.create(user=self.jerry)
+        with self.captureOnCommitCallbacks(execute=True):
+            request_repo.bulk_create(
+                [{"content": "Help", "from_user": self.john, "to_mentor": self.jerry, "status": "P"}]
+            )
+        john.refresh_from_db()
+        jerry.refresh_from_db()
+        assert (john.pending_requests, jerry.pending_requests) == (99, 2)
+        request = Requests.objects.get(from_user=self.john, to_mentor=self.jerry)
+        request.to_mentor = self.john
+        with self.captureOnCommitCallbacks(execute=True):
+            request_repo.bulk_update([request], ["to_mentor"])
+        john.refresh_from_db()
+        jerry.refresh_from_db()
+        assert (john.pending_requests, jerry.pending_requests) == (11, 1)
+
+    def test_new_mentor_counts_the_requests_already_received(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        request_repo = RepositoryFactory.create_repository("request")
+        john = mentor_repo.create(user=self.john)
+        assert (john.pending_requests, john.accepted_requests, john.rejected_requests) == (10, 8, 8)
+        assert (john.rating, john.rating_count) == (None, 0)
+        request_repo.reject(Requests.objects.filter(to_mentor=self.john, status="P").first())
+        john.refresh_from_db()
+        assert (john.pending_requests, john.rejected_requests) == (9, 9)
+        jerry = async_to_sync(mentor_repo.acreate)(user=self.jerry)
+        assert jerry.pending_requests == 1
+
+    def test_bulk_delete_recounts_its_mentors_once(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        john = Mentor.objects.create(user=self.john)
+        RepositoryFactory.create_repository("mentor").recount_requests()
+        ids = list(Requests.objects.filter(to_mentor=self.john).values_list("pk", flat=True))
+        # A savepoint, three queries per batch (load the requests, delete their stacks, delete them),
+        # then a single recount once committed
+        with self.assertNumQueries(2 + 3 * 3 + 1), self.captureOnCommitCallbacks(execute=True):
+            assert request_repo.bulk_delete(ids, batch_size=10) == len(ids)
+        john.refresh_from_db()
+        assert (john.pending_requests, john.accepted_requests, john.rejected_requests) == (0, 0, 0)
+
+    def test_invalid_page(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        with self.assertRaises(ValueError):
+            request_repo.get_inbox(self.john, cursor="not a cursor")
+        with self.assertRaises(ValueError):
+            request_repo.get_outbox(self.jane, page_size=0)
+
+
+class TestMentorRatings(TestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+        self.jane = User.objects.get(email="jane@doe.com")
+        self.john = Mentor.objects.get(user__email="john@doe.com")
+        self.jerry = Mentor.objects.get(user__email="jerry@doe.com")
+        Comments.objects.bulk_create(
+            Comments(comment="Comment", rating=rating, from_user=self.jane, to_user=mentor)
+            for mentor, rating in [(self.john, 5), (self.john, 4), (self.john, None), (self.jerry, 5)]
+        )
+
+    def test_rebuild_ratings(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        output = StringIO()
+        call_command("rebuild_mentor_ratings", stdout=output)
+        assert "2 mentors" in output.getvalue()
+        self.john.refresh_from_db()
+        self.jerry.refresh_from_db()
+        assert (self.john.rating, self.john.rating_sum, self.john.rating_count, self.john.score) == (4.5, 9, 2, None)
+        assert (self.jerry.rating, self.jerry.rating_count) == (5, 1)
+        mentor_repo.update(self.john, is_available=True)
+        mentor_repo.update(self.jerry, is_available=True)
+        assert list(mentor_repo.get_best_rated_mentors()) == [self.jerry, self.john]
+
+    @override_settings(MENTOR_RATING_PRIOR=(3, 2))
+    def test_score(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.rebuild_ratings()
+        self.john.refresh_from_db()
+        self.jerry.refresh_from_db()
+        assert (self.john.score, self.jerry.score) == (3.75, 11 / 3)
+        Comments.objects.create(comment="Comment", rating=1, from_user=self.jane, to_user=self.jerry)
+        self.jerry.refresh_from_db()
+        assert (self.jerry.rating, self.jerry.score) == (3, 3)
+        mentor_repo.update(self.john, is_available=True)
+        mentor_repo.update(self.jerry, is_available=True)
+        assert list(mentor_repo.get_best_rated_mentors(limit=1)) == [self.john]
+
+    def test_best_rated_uses_index(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        plan = mentor_repo.get_best_rated_mentors().explain()
+        assert "USING INDEX mentor_" in plan and "TEMP B-TREE" not in plan
+
+
+class TestCommentRepository(TestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+        setUpStacks()
+        self.jane = User.objects.get(email="jane@doe.com")
+        self.john = Mentor.objects.get(user__email="john@doe.com")
+        self.jerry = Mentor.objects.get(user__email="jerry@doe.com")
+        stacks = list(Stacks.objects.all()[:3])
+        comments = Comments.objects.bulk_create(
+            Comments(comment=f"Comment {index}", rating=index % 5, from_user=self.jane, to_user=self.john)
+            for index in range(120)
+        )
+        Comments.stacks.through.objects.bulk_create(
+            Comments.stacks.through(comments_id=comment.pk, stacks_id=stack.pk)
+            for comment in comments
+            for stack in stacks
+        )
+        Comments.objects.create(comment="Comment", from_user=self.jane, to_user=self.jerry)
+
+    def test_feed_pages(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        expected = list(self.john.get_comments())
+        pages, cursor = [], None
+        while True:
+            with self.assertNumQueries(2):
+                page = comment_repo.get_feed(self.john, cursor=cursor)
+                rendered = [(str(comment), [stack.tag for stack in comment.stacks.all()]) for comment in page.items]
+            assert all(text == "Comment by jane@doe.com to john@doe.com" for text, _ in rendered)
+            assert all(len(tags) == 3 for _, tags in rendered)
+            pages.append(page.items)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        assert [len(items) for items in pages] == [50, 50, 20]
+        assert [comment for items in pages for comment in items] == expected
+
+    def test_feed_of_user(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        user = self.jerry.user
+        with self.assertNumQueries(2):
+            page = comment_repo.get_feed(user, page_size=10)
+            assert [str(comment) for comment in page.items] == ["Comment by jane@doe.com to jerry@doe.com"]
+        assert page.next_cursor is None
+
+    def test_feed_uses_index(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        plan = comment_repo.get_comments_by_mentor(self.john).explain()
+        assert "comment_feed_idx" in plan and "TEMP B-TREE" not in plan
+
+    def test_bulk_create_rebuilds_ratings(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        with self.captureOnCommitCallbacks(execute=True):
+            comment_repo.bulk_create(
+                [{"comment": "Comment", "rating": 4, "from_user": self.jane, "to_user": self.jerry}]
+            )
+        self.jerry.refresh_from_db()
+        assert (self.jerry.rating, self.jerry.rating_count) == (4, 1)
+
+    def test_bulk_operations_rebuild_the_ratings_of_their_mentors(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        Mentor.objects.filter(pk=self.john.pk).update(rating=1, rating_sum=1, rating_count=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            comment_repo.bulk_create(
+                [{"comment": "Comment", "rating": 3, "from_user": self.jane, "to_user": self.jerry}]
+            )
+        self.john.refresh_from_db()
+        self.jerry.refresh_from_db()
+        assert (self.john.rating, self.jerry.rating, self.jerry.rating_count) == (1, 3, 1)
+        comment = Comments.objects.get(to_user=self.jerry, rating=3)
+        comment.to_user = self.john
+        with self.captureOnCommitCallbacks(execute=True):
+            comment_repo.bulk_update([comment], ["to_user"])
+        self.john.refresh_from_db()
+        self.jerry.refresh_from_db()
+        assert (self.john.rating_sum, self.john.rating_count, self.jerry.rating_count) == (243, 121, 0)
+
+    def test_bulk_delete_rebuilds_the_ratings_of_its_mentors_once(self):
+        comment_repo = RepositoryFactory.create_repository("comment")
+        ids = list(Comments.objects.filter(to_user=self.john).values_list("pk", flat=True)[:100])
+        # A savepoint, three queries per batch (load the comments, delete their stacks, delete them),
+        # then a single rebuild once committed
+        with self.assertNumQueries(2 + 2 * 3 + 1), self.captureOnCommitCallbacks(execute=True):
+            comment_repo.bulk_delete(ids, batch_size=50)
+        assert not Comments.objects.filter(pk__in=ids).exists()
+        self.john.refresh_from_db()
+        assert self.john.rating_count == Comments.objects.filter(to_user=self.john, rating__isnull=False).count()
+
+
+class TestRequestTransitions(TestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+        self.jane = User.objects.get(email="jane@doe.com")
+        self.john = User.objects.get(email="john@doe.com")
+        self.request = Requests.objects.create(content="Help", from_user=self.jane, to_mentor=self.john, status="P")
+
+    def test_accept(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        assert request_repo.accept(self.request)
+        assert self.request.status == "A"
+        mentor = Mentor.objects.get(user=self.john)
+        assert (mentor.history, mentor.pending_requests, mentor.accepted_requests) == (1, 0, 1)
+        assert list(self.jane.mentors.all()) == [mentor]
+
+    def test_accept_request_to_user_who_is_not_a_mentor(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        request = Requests.objects.create(content="Help", from_user=self.john, to_mentor=self.jane, status="P")
+        with self.assertRaisesMessage(ValueError, "not a mentor"):
+            request_repo.accept(request)
+        request.refresh_from_db()
+        assert request.status == "P"
+        assert not self.john.mentors.exists()
+        assert request_repo.reject(request)
+
+    def test_reject(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        assert request_repo.reject(self.request)
+        mentor = Mentor.objects.get(user=self.john)
+        assert (mentor.history, mentor.pending_requests, mentor.rejected_requests) == (0, 0, 1)
+        assert not self.jane.mentors.exists()
+
+    def test_only_pending_requests_move(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        stale = Requests.objects.get(pk=self.request.pk)
+        assert request_repo.reject(self.request)
+        assert not request_repo.accept(stale)
+        assert stale.status == "R"
+        assert not request_repo.reject(stale)
+        assert Mentor.objects.get(user=self.john).history == 0
+        with self.assertRaises(ValueError):
+            request_repo.transition(self.request, "X")
+
+
+def transition_waiting_for_locks(request, status):
+    """
+    RequestRepository.transition, retried while the database is locked: the shared in-memory SQLite
+    database of the tests reports lock conflicts at once, where SQLite files and PostgreSQL wait.
+    """
+    request_repo = RepositoryFactory.create_repository("request")
+    for _ in range(1000):
+        try:
+            return request_repo.transition(request, status)
+        except OperationalError as error:
+            if "locked" not in str(error):
+                raise
+            time.sleep(0.001)
+    raise AssertionError("The database stayed locked")
+
+
+class TestConcurrentRequestTransitions(TransactionTestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+        self.jane = User.objects.get(email="jane@doe.com")
+        self.john = User.objects.get(email="john@doe.com")
+
+    def test_one_transition_wins(self):
+        threads_count = 8
+        for _ in range(5):
+            request = Requests.objects.create(content="Help", from_user=self.jane, to_mentor=self.john, status="P")
+            barrier = threading.Barrier(threads_count, timeout=10)
+            results = []
+
+            def answer(index, request_id=request.pk, barrier=barrier, results=results):
+                try:
+                    stale = Requests.objects.get(pk=request_id)
+                    barrier.wait()
+                    results.append((index % 2, transition_waiting_for_locks(stale, "AR"[index % 2])))
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=answer, args=(index,)) for index in range(threads_count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            winners = [index for index, won in results if won]
+            assert len(results) == threads_count and len(winners) == 1
+            request.refresh_from_db()
+            assert request.status == "AR"[winners[0]]
+        mentor = Mentor.objects.get(user=self.john)
+        accepted = Requests.objects.filter(to_mentor=self.john, status="A").count()
+        assert (mentor.history, mentor.accepted_requests) == (accepted, accepted)
+        assert mentor.rejected_requests == 5 - accepted and mentor.pending_requests == 0
+        assert self.jane.mentors.exists() == bool(accepted)
+
+
+class TestBulkOperations(TestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+        setUpStacks()
+
+    def test_bulk_create(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(4):
+                stacks = stack_repo.bulk_create(
+                    [{"tag": f"Bulk {index}"} for index in range(50)] + [Stacks(tag="Django")], batch_size=30
+                )
+        assert len(stacks) == 51
+        assert stack_repo.get_by_tag("bulk  7").tag == "Bulk 7"
+        assert stack_repo.get_by_tag("django").tag == "Django"
+        assert stack_repo.autocomplete("dj") == ["Django"]
+
+    def test_bulk_create_users(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        user_repo.bulk_create([{"email": "bulk@DOE.COM", "password": "password", "first_name": "Bulk"}])
+        user = user_repo.get(email="bulk@doe.com")
+        assert user.first_name == "Bulk"
+        assert user.check_password("password")
+        with self.assertRaises(ValueError):
+            user_repo.bulk_create([{"email": "nopassword@doe.com"}])
+
+    def test_bulk_update(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        stacks = list(stack_repo.filter(tag__in=["ruby", "perl"]).order_by("tag"))
+        stacks[0].tag = "Raku"
+        stacks[1].tag = "Crystal"
+        with self.captureOnCommitCallbacks(execute=True):
+            assert stack_repo.bulk_update(stacks, fields=["tag"]) == 2
+        assert stack_repo.get_by_tag("raku").tag == "Raku"
+        assert stack_repo.autocomplete("rub") == []
+        assert stack_repo.autocomplete("crys") == ["Crystal"]
+
+    def test_bulk_delete(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        stack_repo.create_trie()
+        ids = list(stack_repo.filter(tag__startswith="Data").values_list("pk", flat=True))
+        version = cache.get(TRIE_VERSION_KEY, 0)
+        # The deleted tags are published with a single version bump, not one journal entry each
+        with mock.patch.object(type(stack_repo), "publish_trie_change") as publish_trie_change:
+            with self.captureOnCommitCallbacks(execute=True):
+                assert stack_repo.bulk_delete(ids, batch_size=2) == len(ids)
+        publish_trie_change.assert_not_called()
+        assert cache.get(TRIE_VERSION_KEY) == version + 1
+        assert stack_repo.trie_version == version + 1
+        assert not stack_repo.filter(tag__startswith="Data").exists()
+        assert stack_repo.autocomplete("data") == []
+
+    def test_bulk_delete_mentors(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        john = Mentor.objects.get(user__email="john@doe.com")
+        go = Stacks.objects.get(tag="go")
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.bulk_delete([john.pk])
+        assert mentor_repo.get_mentor_ids_by_stacks([go], available=False) == []
+
+    def test_bulk_changes_rebuild_mentor_index(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        john = Mentor.objects.get(user__email="john@doe.com")
+        go = Stacks.objects.get(tag="go")
+        john.stacks.add(go)
+        john.is_available = True
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor_repo.bulk_update([john], fields=["is_available"])
+        assert mentor_repo.get_mentor_ids_by_stacks([go]) == [john.pk]
+
+    def test_upsert(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        python_id = stack_repo.get(tag="python").pk
+        stack_repo.upsert([{"tag": "python"}, {"tag": "Elixir"}], unique_fields=["tag"], update_fields=["tag"])
+        assert stack_repo.get(tag="python").pk == python_id
+        assert stack_repo.get_by_tag("elixir").tag == "Elixir"
+        assert stack_repo.all().count() == len(stack_list) + 1
+
+    def test_iter_all(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        with self.assertNumQueries(4):
+            tags = [stack.tag for stack in stack_repo.iter_all(chunk_size=10)]
+        assert tags == stack_list
+
+
+class TestIdentityMap(TestCase):
+    def setUp(self):
+        setUpUsers()
+        setUpMentors()
+
+    def test_get_outside_scope(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        with self.assertNumQueries(2):
+            assert user_repo.get(email="john@doe.com") is not user_repo.get(email="john@doe.com")
+
+    def test_get_by_primary_and_unique_keys(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        with identity_map_scope():
+            with self.assertNumQueries(1):
+                john = user_repo.get(email="john@doe.com")
+                assert user_repo.get(email="john@doe.com") is john
+                assert user_repo.get(pk=john.pk) is john
+                assert user_repo.get(id=john.pk) is john
+            with self.assertNumQueries(1):
+                assert user_repo.get(first_name="John") is john
+            assert user_repo.get(email="nobody@doe.com") is None
+
+    def test_is_mentor_then_mentor_infos(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        with identity_map_scope():
+            john = user_repo.get(email="john@doe.com")
+            with self.assertNumQueries(1):
+                assert user_repo.is_mentor(john)
+                mentor = user_repo.get_mentor_infos(john)
+                assert mentor.user is john
+
+    def test_filter_and_foreign_keys(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        request_repo = RepositoryFactory.create_repository("request")
+        john = User.objects.get(email="john@doe.com")
+        jerry = User.objects.get(email="jerry@doe.com")
+        Requests.objects.create(content="Help", from_user=john, to_mentor=jerry, status="P")
+        with identity_map_scope():
+            users = list(user_repo.filter(email__endswith="doe.com").order_by("pk"))
+            with self.assertNumQueries(1):
+                request = request_repo.filter(from_user=users[0]).get()
+                assert str(request) == "Request from john@doe.com to jerry@doe.com"
+            assert user_repo.get(email="jerry@doe.com") is users[1]
+
+    def test_create_update_and_delete(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        with identity_map_scope():
+            stack = stack_repo.create(tag="python")
+            with self.assertNumQueries(0):
+                assert stack_repo.get(tag="python") is stack
+            stack_repo.update(stack, tag="Python3")
+            with self.assertNumQueries(0):
+                assert stack_repo.get(tag="Python3") is stack
+            assert stack_repo.get(tag="python") is None
+            stack_repo.delete(stack)
+            assert stack_repo.get(tag="Python3") is None
+
+    def test_related_objects_of_known_rows(self):
+        request_repo = RepositoryFactory.create_repository("request")
+        comment_repo = RepositoryFactory.create_repository("comment")
+        john = User.objects.get(email="john@doe.com")
+        jerry = User.objects.get(email="jerry@doe.com")
+        mentor = Mentor.objects.get(user=jerry)
+        stack = Stacks.objects.create(tag="python")
+        for index in range(5):
+            Requests.objects.create(content=f"Help {index}", from_user=john, to_mentor=jerry, status="P")
+            Comments.objects.create(comment=f"Comment {index}", from_user=john, to_user=mentor).stacks.add(stack)
+        with identity_map_scope():
+            request = request_repo.get(pk=Requests.objects.first().pk)
+            comment = comment_repo.get(pk=Comments.objects.first().pk)
+            with self.assertNumQueries(1):
+                page = request_repo.get_inbox(jerry)
+                assert request in page.items
+                assert all(request.from_user.email == "john@doe.com" for request in page.items)
+            with self.assertNumQueries(2):
+                page = comment_repo.get_feed(mentor)
+                assert comment in page.items
+                assert all(str(comment) == "Comment by john@doe.com to jerry@doe.com" for comment in page.items)
+                assert all(list(comment.stacks.all()) == [stack] for comment in page.items)
+
+    def test_middleware(self):
+        middleware = IdentityMapMiddleware(lambda request: identity_map.get())
+        assert middleware(RequestFactory().get("/api/")) == {}
+        assert identity_map.get() is None
+
+
+class TestAsyncRepositories(TestCase):
+    def setUp(self):
+        cache.clear()
+        setUpUsers()
+        setUpMentors()
+        setUpStacks()
+        setUpLearningStacks()
+
+    async def test_get_and_filter(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        with identity_map_scope():
+            john = await user_repo.aget(email="john@doe.com")
+            assert await user_repo.aget(pk=john.pk) is john
+            assert await user_repo.aget(first_name="John") is john
+            users = await user_repo.afilter(last_name="Doe")
+            assert john in users and len(users) == 3
+        assert await user_repo.aget(email="nobody@doe.com") is None
+
+    async def test_create_update_and_delete(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        user_repo = RepositoryFactory.create_repository("user")
+        stack = await stack_repo.acreate(tag="Elixir")
+        assert (await stack_repo.aget_by_tag("elixir ")).pk == stack.pk
+        await stack_repo.aupdate(stack, tag="Erlang")
+        assert (await stack_repo.aget(pk=stack.pk)).tag == "Erlang"
+        await stack_repo.adelete(stack)
+        assert await stack_repo.aget(pk=stack.pk) is None
+        user = await user_repo.acreate(email="Bob@Doe.com", password="password")
+        assert user.email == "Bob@doe.com"
+        assert user.check_password("password")
+        assert not await user_repo.ais_mentor(user)
+
+    async def test_acreate_like_create(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        fields = {"password": "password", "first_name": "Bob", "csrfmiddlewaretoken": "token"}
+        async_user = await user_repo.acreate(email="Bob@Doe.com", **fields)
+        sync_user = await sync_to_async(user_repo.create)(email="Alice@Doe.com", **fields)
+        assert (async_user.email, sync_user.email) == ("Bob@doe.com", "Alice@doe.com")
+        assert async_user.first_name == sync_user.first_name == "Bob"
+        assert async_user.check_password("password") and sync_user.check_password("password")
+
+    async def test_mentors(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        john = await user_repo.aget(email="john@doe.com")
+        jane = await user_repo.aget(email="jane@doe.com")
+        assert await user_repo.ais_mentor(john)
+        mentor = await user_repo.aget_mentor_infos(john)
+        await mentor_repo.aupdate(mentor, is_available=True)
+        assert await mentor_repo.aget_mentor_by_stack("JavaScript") == [mentor]
+        assert (await mentor_repo.aget_matching_mentors(jane))[0] == mentor
+
+    async def test_autocomplete(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        await sync_to_async(stack_repo.create_trie)()
+        assert await stack_repo.aautocomplete("jav") == ["java", "javascript"]
+        top = await stack_repo.aautocomplete("jav", limit=1)
+        assert len(top) == 1
+        assert await stack_repo.acached_autocomplete("jav", limit=1) == top
+        assert await stack_repo.acached_autocomplete("pyhton", fuzzy=True) == ["python"]
+
+    def test_update_availability_updates_index(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor_repo.build_index()
+        mentor = Mentor.objects.get(user__email="john@doe.com")
+        python = Stacks.objects.get(tag="python")
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(mentor_repo.aupdate)(mentor, is_available=False)
+        assert mentor_repo.get_mentor_ids_by_stacks([python]) == []
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(mentor_repo.adelete)(mentor)
+        assert mentor_repo.get_mentor_ids_by_stacks([python], available=False) == []
+        user = User.objects.create(email="mentor@doe.com", password="password")
+        with self.captureOnCommitCallbacks(execute=True):
+            mentor = async_to_sync(mentor_repo.acreate)(user=user, is_available=True)
+            mentor_repo.add_stack(mentor, python)
+        assert mentor_repo.get_mentor_ids_by_stacks([python]) == [mentor.pk]
+
+
+class TestRowCache(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        setUpUsers()
+        setUpMentors()
+        setUpStacks()
+
+    def test_get_is_cached(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        john = user_repo.get(email="john@doe.com")
+        with self.assertNumQueries(1):
+            assert user_repo.get(email="john@doe.com") == john
+            assert user_repo.get(pk=john.pk).email == "john@doe.com"
+        with self.assertNumQueries(0):
+            assert user_repo.get(email="john@doe.com") == john
+            assert user_repo.get(pk=str(john.pk)) == john
+        with self.assertNumQueries(1):
+            assert user_repo.get(first_name="John") == john
+
+    def test_cached_fields(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        python = stack_repo.get_by_tag("Python")
+        stack_repo.get(tag="python")
+        john = User.objects.get(email="john@doe.com")
+        mentor = mentor_repo.get(user=john)
+        with self.assertNumQueries(0):
+            assert stack_repo.get(tag="python") == python
+            assert stack_repo.get_by_tag("python ") == python
+            assert mentor_repo.get(user=john) == mentor
+            assert mentor_repo.get(pk=mentor.pk) == mentor
+
+    def test_other_models_are_fast_deleted(self):
+        # Only the models of caching repositories get the invalidation receivers
+        assert Collector(using="default", origin=None).can_fast_delete(Session.objects.all())
+        assert not Collector(using="default", origin=None).can_fast_delete(Stacks.objects.all())
+
+    def test_related_objects_are_not_cached(self):
+        mentor_repo = RepositoryFactory.create_repository("mentor")
+        mentor = mentor_repo.get(user=User.objects.get(email="john@doe.com"))
+        assert mentor.user.first_name == "John"
+        User.objects.filter(email="john@doe.com").update(first_name="Johnny")
+        with self.assertNumQueries(1):
+            assert mentor_repo.get(pk=mentor.pk).user.first_name == "Johnny"
+
+    def test_invalidated_on_save_and_delete(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        john = user_repo.get(email="john@doe.com")
+        user_repo.update(john, email="johnny@doe.com")
+        assert user_repo.get(email="john@doe.com") is None
+        assert user_repo.get(pk=john.pk).email == "johnny@doe.com"
+        assert user_repo.get(email="johnny@doe.com") == john
+        User.objects.get(pk=john.pk).delete()
+        assert user_repo.get(pk=john.pk) is None
+        assert user_repo.get(email="johnny@doe.com") is None
+
+    def test_invalidated_by_bulk_operations(self):
+        stack_repo = RepositoryFactory.create_repository("stack")
+        python = stack_repo.get(tag="python")
+        python.tag = "Python3"
+        stack_repo.bulk_update([python], fields=["tag"])
+        assert stack_repo.get(pk=python.pk).tag == "Python3"
+        assert stack_repo.get(tag="python") is None
+
+    def test_rows_read_before_a_write_are_not_served_after_it(self):
+        user_repo = RepositoryFactory.create_repository("user")
+
+        def query_then_write():
+            old = User.objects.get(email="john@doe.com")
+            user_repo.update(User.objects.get(email="john@doe.com"), bio="new")
+            return old
+
+        assert cached_get(User, "email", "john@doe.com", query_then_write).bio != "new"
+        assert user_repo.get(email="john@doe.com").bio == "new"
+        with self.assertNumQueries(0):
+            assert user_repo.get(email="john@doe.com").bio == "new"
+
+    def test_not_cached_in_transactions(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        with transaction.atomic():
+            user_repo.get(email="john@doe.com")
+        with self.assertNumQueries(1):
+            user_repo.get(email="john@doe.com")
+
+    @override_settings(REPOSITORY_CACHE=None)
+    def test_disabled(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        user_repo.get(email="john@doe.com")
+        with self.assertNumQueries(1):
+            user_repo.get(email="john@doe.com")
+
+    @mock.patch("avocadoapi.repositories.row_cache.STAMPEDE_WAIT", 0.01)
+    def test_stampede_waits_for_the_loading_caller(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        john = User.objects.get(email="john@doe.com")
+        key = row_key(User, 0, "email", "john@doe.com")
+        cache.add(f"{key}:lock", 1)
+        cache.set(version_key(key), "version")
+        timer = threading.Timer(0.05, lambda: cache.set(key, ("version", john)))
+        timer.start()
+        with self.assertNumQueries(0):
+            assert user_repo.get(email="john@doe.com") == john
+        timer.join()
+
+    @mock.patch("avocadoapi.repositories.row_cache.STAMPEDE_WAIT", 0.01)
+    @mock.patch("avocadoapi.repositories.row_cache.STAMPEDE_RETRIES", 2)
+    def test_stampede_falls_back_to_the_database(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        key = row_key(User, 0, "email", "john@doe.com")
+        cache.add(f"{key}:lock", 1)
+        with self.assertNumQueries(1):
+            assert user_repo.get(email="john@doe.com").first_name == "John"
+
+    def test_async_get_is_cached(self):
+        user_repo = RepositoryFactory.create_repository("user")
+        john = async_to_sync(user_repo.aget)(email="john@doe.com")
+        async_to_sync(user_repo.aget)(pk=john.pk)
+        with self.assertNumQueries(0):
+            assert user_repo.get(email="john@doe.com") == john
+            assert async_to_sync(user_repo.aget)(pk=john.pk) == john
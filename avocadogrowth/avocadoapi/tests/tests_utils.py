@@ -1,4 +1,15 @@
+import os
+import sys
+import tempfile
+import threading
+
 from ..utils.trie import Trie
+from ..utils.compact_trie import CompactTrie
+from ..utils.bloom_filter import BloomFilter
+from ..utils.bitmap_index import BitmapIndex, bitmap_from_members, bitmap_members
+from ..utils.trie_snapshot import load_trie, save_trie
+from ..utils.keyset import decode_cursor, encode_cursor
+from ..utils.normalization import normalize_tag
 from django.test import TestCase
 
 
@@ -92,3 +103,374 @@ class TestTrie(TestCase):
         assert auto_python == ["python"]
         assert auto_java == ["java", "javascript"]
         assert auto_c == ["c++", "c#"]
+
+    def test_iter_words(self):
+        trie = Trie()
+        trie.initialize(["python", "java", "javascript", "c++", "c#"])
+        words = trie.iter_words("ja")
+        assert next(words) == "java"
+        assert next(words) == "javascript"
+        assert next(words, None) is None
+        assert list(trie.iter_words("rust")) == []
+        assert trie.find_words("", limit=2) == ["python", "java"]
+
+    def test_autocomplete_no_match(self):
+        trie = Trie()
+        trie.initialize(["python", "java", "javascript", "c++", "c#"])
+        assert trie.find_words("jx") == []
+        assert trie.find_words("pythons") == []
+        assert trie.find_words("z") == []
+        assert trie.find_top_k("jx", 3) == []
+
+    def test_prefix_filter(self):
+        trie = Trie(prefix_filter=True)
+        trie.initialize(["python", "java", "javascript"])
+        for prefix in ["p", "pyth", "python", "j", "javas"]:
+            assert prefix in trie.prefix_filter
+        assert trie.starts_with("jav")
+        assert not trie.starts_with("jx")
+        trie.insert("rust")
+        assert "ru" in trie.prefix_filter
+        assert trie.find_words("ru") == ["rust"]
+        trie.delete("rust")
+        assert trie.find_words("ru") == []
+
+    def test_find_words_deeper_than_recursion_limit(self):
+        trie = Trie()
+        long_word = "a" * (sys.getrecursionlimit() * 2)
+        trie.insert(long_word)
+        trie.insert("ab")
+        assert trie.find_words("a") == [long_word, "ab"]
+
+
+class TestTrieFuzzy(TestCase):
+    words = {"python": 5, "pytorch": 3, "pandas": 8, "java": 4, "javascript": 6, "jade": 1}
+
+    def check_fuzzy(self, trie):
+        assert trie.find_fuzzy("pyhton", 1) == ["python"]
+        assert trie.find_fuzzy("javscript", 1) == ["javascript"]
+        assert trie.find_fuzzy("jave", 1) == ["javascript", "java", "jade"]
+        assert trie.find_fuzzy("jave", 1, limit=2) == ["javascript", "java"]
+        assert trie.find_fuzzy("pyt", 0) == ["python", "pytorch"]
+        assert trie.find_fuzzy("rust", 2) == []
+
+    def test_fuzzy(self):
+        trie = Trie()
+        trie.initialize(list(self.words), weights=self.words)
+        self.check_fuzzy(trie)
+
+    def test_fuzzy_with_top_completions(self):
+        trie = CompactTrie(top_k=5)
+        trie.initialize(list(self.words), weights=self.words)
+        self.check_fuzzy(trie)
+
+
+class TestCompactTrie(TestCase):
+
+    def test_insert_search_delete(self):
+        trie = CompactTrie()
+        trie.initialize(["python", "java", "javascript", "c++", "c#"])
+        assert trie.search("python")
+        assert trie.search("JAVA")
+        assert not trie.search("jav")
+        assert trie.starts_with("jav")
+        assert not trie.starts_with("rust")
+        trie.delete("java")
+        assert not trie.search("java")
+        assert trie.search("javascript")
+        trie.delete("javascript")
+        assert not trie.starts_with("j")
+
+    def test_same_results_as_trie(self):
+        words = ["python", "java", "javascript", "c++", "c#", "data", "data science", "data analysis"]
+        trie = Trie()
+        compact = CompactTrie()
+        trie.initialize(words)
+        compact.initialize(words)
+        for prefix in ["py", "ja", "c", "data", "data s", ""]:
+            assert compact.find_words(prefix) == trie.find_words(prefix)
+
+    def test_deleted_nodes_are_reused(self):
+        trie = CompactTrie()
+        trie.insert("python")
+        size = len(trie)
+        trie.delete("python")
+        assert len(trie) == 1
+        trie.insert("pascal")
+        assert len(trie) == size
+        assert trie.find_words("p") == ["pascal"]
+
+
+class TestTrieTopK(TestCase):
+    words = {"python": 5, "pytorch": 3, "pandas": 8, "php": 1, "perl": 1, "java": 4}
+
+    def check_top_k(self, trie):
+        assert trie.find_top_k("p", 3) == ["pandas", "python", "pytorch"]
+        assert trie.find_top_k("py", 10) == ["python", "pytorch"]
+        assert trie.find_top_k("p", 5) == ["pandas", "python", "pytorch", "perl", "php"]
+        assert trie.find_top_k("rust", 3) == []
+        trie.insert("pytest", 10)
+        assert trie.find_top_k("p", 2) == ["pytest", "pandas"]
+        trie.delete("pandas")
+        assert trie.find_top_k("p", 2) == ["pytest", "python"]
+        trie.insert("python", 0)
+        assert trie.find_top_k("py", 3) == ["pytest", "pytorch", "python"]
+
+    def test_top_k(self):
+        trie = Trie(top_k=5)
+        trie.initialize(list(self.words), weights=self.words)
+        self.check_top_k(trie)
+
+    def test_top_k_compact(self):
+        trie = CompactTrie(top_k=5)
+        trie.initialize(list(self.words), weights=self.words)
+        self.check_top_k(trie)
+
+    def test_set_weights(self):
+        for trie in (Trie(top_k=5), CompactTrie(top_k=5)):
+            trie.initialize(list(self.words), weights=self.words)
+            trie.set_weights({"PHP": 9, "pytorch": 6})
+            assert trie.find_top_k("p", 3) == ["php", "pytorch", "pandas"]
+            assert trie.find_top_k("py", 2) == ["pytorch", "python"]
+
+    def test_top_k_larger_than_cache(self):
+        trie = Trie(top_k=2)
+        trie.initialize(list(self.words), weights=self.words)
+        assert trie.find_top_k("p", 3) == ["pandas", "python", "pytorch"]
+        assert Trie().find_top_k("p", 1) == []
+
+
+class TestBloomFilter(TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        words = [f"tag{index}" for index in range(1000)]
+        for word in words:
+            bloom.add(word)
+        assert all(word in bloom for word in words)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for index in range(1000):
+            bloom.add(f"tag{index}")
+        false_positives = sum(f"other{index}" in bloom for index in range(10000))
+        assert false_positives < 300
+
+
+class TestBitmapIndex(TestCase):
+
+    def test_bitmap_members(self):
+        members = [0, 3, 8, 64, 1000, 100000]
+        assert bitmap_members(bitmap_from_members(members)) == members
+        assert bitmap_from_members([]) == 0
+        assert bitmap_members(0) == []
+
+    def test_intersection(self):
+        index = BitmapIndex.from_pairs([("python", 1), ("python", 2), ("python", 70), ("sql", 2), ("sql", 70)])
+        index.add("go", 2)
+        assert index.members_of(index.intersection(["python", "sql"])) == [2, 70]
+        assert index.members_of(index.intersection(["python", "sql", "go"])) == [2]
+        assert index.members_of(index.intersection(["python", "sql"], index.get("python") & ~index.get("go"))) == [70]
+        assert index.intersection(["python", "unknown"]) == 0
+        assert index.intersection([]) == 0
+
+    def test_discard(self):
+        index = BitmapIndex.from_pairs([("python", 1), ("python", 2), ("sql", 2)])
+        index.discard("python", 1)
+        index.discard("python", 5)
+        assert index.members_of(index.get("python")) == [2]
+        bitmap = index.get("sql")
+        index.discard_member(2)
+        assert index.bitmaps == {}
+        index.add("sql", 3)
+        assert index.members_of(bitmap) == []
+        assert index.members_of(index.get("sql")) == [3]
+
+    def test_bitmaps_follow_the_number_of_members(self):
+        index = BitmapIndex.from_pairs([("python", 10**6), ("python", 10**9)])
+        index.add("sql", 10**12)
+        assert index.get("python").bit_length() == 2
+        assert index.get("sql").bit_length() == 3
+        assert index.members_of(index.get("python") | index.get("sql")) == [10**6, 10**9, 10**12]
+
+
+class TestTrieSnapshot(TestCase):
+    words = {"python": 5, "pytorch": 3, "pandas": 8, "java": 4, "javascript": 6, "c#": 1}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "trie.bin")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check_snapshot(self, trie):
+        trie.initialize(list(self.words), weights=self.words)
+        save_trie(trie, self.path, version=42, generation="f00d")
+        loaded, version, generation = load_trie(self.path)
+        assert version == 42
+        assert generation == "f00d"
+        assert loaded.snapshot is not None
+        for prefix in ["", "p", "py", "ja", "c", "x"]:
+            assert loaded.find_words(prefix) == trie.find_words(prefix)
+            assert loaded.find_top_k(prefix, 3) == trie.find_top_k(prefix, 3)
+        assert loaded.search("c#")
+        assert not loaded.starts_with("rust")
+        assert loaded.weights.get("pandas") == 8
+        return loaded
+
+    def test_snapshot_of_trie(self):
+        self.check_snapshot(Trie(top_k=5, prefix_filter=True))
+
+    def test_snapshot_of_compact_trie(self):
+        self.check_snapshot(CompactTrie(top_k=5, prefix_filter=True))
+
+    def test_snapshot_is_copied_on_change(self):
+        loaded = self.check_snapshot(Trie(top_k=5, prefix_filter=True))
+        loaded.insert("pytest", 10)
+        loaded.delete("pandas")
+        assert loaded.snapshot is None
+        assert loaded.find_top_k("p", 3) == ["pytest", "python", "pytorch"]
+        assert load_trie(self.path)[0].find_top_k("p", 1) == ["pandas"]
+
+    def test_snapshot_is_shared_by_weights(self):
+        loaded = self.check_snapshot(CompactTrie(top_k=5, prefix_filter=True))
+        chars = loaded.chars
+        weighted = loaded.copy()
+        weighted.set_weights({"java": 10})
+        assert weighted.snapshot is not None
+        assert weighted.chars is chars
+        assert weighted.find_top_k("", 2) == ["java", "c#"]
+        assert loaded.find_top_k("", 1) == ["pandas"]
+        changed = weighted.copy()
+        changed.insert("pytest", 20)
+        assert changed.snapshot is None
+        assert changed.find_top_k("", 2) == ["pytest", "java"]
+        assert weighted.find_words("pyte") == []
+        assert weighted.chars is chars
+
+    def test_snapshot_keeps_stored_words(self):
+        trie = Trie(top_k=5, normalize=normalize_tag, variants=lambda tag: [tag.lower()])
+        trie.initialize(["Golang", "Données"])
+        save_trie(trie, self.path)
+        loaded = load_trie(self.path, normalize=normalize_tag, variants=lambda tag: [tag.lower()])[0]
+        assert loaded.find_words("go") == ["Golang"]
+        assert loaded.find_top_k("don", 1) == ["Données"]
+        loaded.delete("Golang")
+        assert loaded.find_words("g") == []
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as file:
+            file.write(bytes(128))
+        with self.assertRaises(ValueError):
+            load_trie(self.path)
+
+    def test_truncated_snapshot(self):
+        trie = CompactTrie(top_k=5)
+        trie.initialize(list(self.words))
+        save_trie(trie, self.path)
+        with open(self.path, "r+b") as file:
+            file.truncate(os.path.getsize(self.path) // 2)
+        with self.assertRaises(ValueError):
+            load_trie(self.path)
+
+
+class TestNormalization(TestCase):
+
+    def test_normalize_tag(self):
+        assert normalize_tag("Python") == "python"
+        assert normalize_tag("Données") == "donnees"
+        assert normalize_tag("  Data   Science ") == "data science"
+        assert normalize_tag("STRASSE") == normalize_tag("Straße")
+        assert normalize_tag("C#") == "c#"
+        assert normalize_tag("C-Sharp") == "c#"
+        assert normalize_tag("CSharp") == "c#"
+        assert normalize_tag("Golang") == "go"
+
+    def test_trie_with_normalization(self):
+        trie = Trie(normalize=normalize_tag)
+        trie.initialize(["Données", "C#", "Data Science"])
+        assert trie.search("donnees")
+        assert trie.search("csharp")
+        assert trie.find_words("DONN") == ["Données"]
+        assert trie.find_words("data  sc") == ["Data Science"]
+
+    def test_trie_with_variants(self):
+        for engine in (Trie, CompactTrie):
+            trie = engine(top_k=5, normalize=normalize_tag, variants=lambda tag: [tag.lower()])
+            trie.initialize(["Golang", "Google", "Rust"], weights={"Golang": 3, "Google": 1})
+            assert trie.find_words("gol") == ["Golang"]
+            assert trie.find_words("go") == ["Golang", "Google"]
+            assert trie.find_top_k("g", 2) == ["Golang", "Google"]
+            assert trie.find_fuzzy("gol", limit=5) == ["Golang", "Google"]
+            trie.delete("Golang")
+            assert trie.find_words("go") == ["Google"]
+            assert not trie.labels.get("golang")
+
+
+class TestTrieCopy(TestCase):
+    words = {"python": 5, "pytorch": 3, "pandas": 8, "java": 4}
+
+    def check_copy(self, trie):
+        trie.initialize(list(self.words), weights=self.words)
+        version = trie.copy()
+        version.insert("pytest", 10)
+        version.delete("pandas")
+        assert version.find_words("p") == ["python", "pytorch", "pytest"]
+        assert version.find_top_k("p", 2) == ["pytest", "python"]
+        assert trie.find_words("p") == ["python", "pytorch", "pandas"]
+        assert trie.find_top_k("p", 2) == ["pandas", "python"]
+        assert not trie.starts_with("pyte")
+        trie.delete("python")
+        assert version.search("python")
+
+    def test_copy(self):
+        self.check_copy(Trie(top_k=5, prefix_filter=True))
+
+    def test_copy_compact(self):
+        self.check_copy(CompactTrie(top_k=5, prefix_filter=True))
+
+    def test_readers_never_see_partial_versions(self):
+        words = [f"tag{index}" for index in range(200)]
+        current = {"trie": Trie(top_k=5)}
+        current["trie"].initialize(words)
+        errors = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                found = current["trie"].find_words("tag")
+                # Every version holds the 200 initial tags, plus all or none of each batch
+                if len(found) not in (200, 300) or len(set(found)) != len(found):
+                    errors.append(len(found))
+
+        def write():
+            for batch in range(20):
+                version = current["trie"].copy()
+                for index in range(100):
+                    if batch % 2:
+                        version.delete(f"tag_new{index}")
+                    else:
+                        version.insert(f"tag_new{index}")
+                current["trie"] = version
+            done.set()
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        write()
+        for reader in readers:
+            reader.join()
+        assert errors == []
+
+
+class TestKeysetCursor(TestCase):
+
+    def test_round_trip(self):
+        cursor = encode_cursor(["2024-05-01T10:00:00+00:00", 42])
+        assert decode_cursor(cursor) == ["2024-05-01T10:00:00+00:00", 42]
+
+    def test_invalid(self):
+        for cursor in ["not a cursor", encode_cursor({"id": 1})[:-2], encode_cursor(42)]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
@@ -6,5 +6,6 @@ urlpatterns = [
     path("register/", views.register, name="register"),
     path("login/", views.login_user, name="login"),
     path("logout/", views.logout_user, name="logout"),
-    path("dashboard/", views.dashboard, name="dashboard")
+    path("dashboard/", views.dashboard, name="dashboard"),
+    path("stacks/autocomplete/", views.autocomplete_stacks, name="stacks_autocomplete")
 ]
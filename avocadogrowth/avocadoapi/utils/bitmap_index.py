@@ -0,0 +1,136 @@
+"""
+Inverted index from keys to bitmaps of integer ids, for fast multi-key intersections.
+"""
+
+import re
+
+# Positions of the set bits of every byte value, and a pattern finding the non zero bytes of a bitmap
+BYTE_MEMBERS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+NON_ZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+def bitmap_from_members(members):
+    """
+    Returns the bitmap of the given ids, built in a single pass.
+    """
+    members = list(members)
+    if not members:
+        return 0
+    bits = bytearray(max(members) // 8 + 1)
+    for member in members:
+        bits[member >> 3] |= 1 << (member & 7)
+    return int.from_bytes(bits, "little")
+
+
+def bitmap_members(bitmap):
+    """
+    Returns the ids whose bit is set in bitmap, in increasing order. Runs of zero bytes are skipped
+    by the regex engine, so sparse bitmaps cost little more than their set bits.
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    members = []
+    for match in NON_ZERO_BYTE.finditer(data):
+        offset = match.start()
+        members.extend(offset * 8 + bit for bit in BYTE_MEMBERS[data[offset]])
+    return members
+
+
+class BitmapIndex:
+    """
+    Maps keys (e.g. stack ids) to the set of members (e.g. mentor ids) associated with them.
+
+    Each member gets an ordinal, its bit in every bitmap: ordinals are dense (0, 1, 2...) whatever
+    the member values, so a bitmap takes one bit per member of the index, not per possible value.
+    Each set is a bitmap stored in a Python int: an intersection of several keys is a few bitwise
+    ANDs over machine words, whatever the number of members. Bitmaps are never changed in place, a
+    change replaces the int of its key, so readers never see a partial update. The ordinals of
+    discarded members are not reused, so a reader holding an older bitmap never maps a bit to
+    another member; they are reclaimed when the index is built again.
+    """
+
+    def __init__(self):
+        self.bitmaps = {}
+        self.ordinals = {}
+        self.members = []
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Returns an index built from (key, member) pairs, with ordinals in increasing member order.
+        """
+        members = {}
+        for key, member in pairs:
+            members.setdefault(key, []).append(member)
+        index = cls()
+        index.members = sorted({member for key_members in members.values() for member in key_members})
+        index.ordinals = {member: ordinal for ordinal, member in enumerate(index.members)}
+        index.bitmaps = {
+            key: bitmap_from_members(index.ordinals[member] for member in key_members)
+            for key, key_members in members.items()
+        }
+        return index
+
+    def ordinal(self, member):
+        """
+        Returns the ordinal of member, giving it the next one if it has none.
+        """
+        ordinal = self.ordinals.get(member)
+        if ordinal is None:
+            ordinal = len(self.members)
+            self.members.append(member)
+            self.ordinals[member] = ordinal
+        return ordinal
+
+    def add(self, key, member):
+        """
+        Associates member with key.
+        """
+        self.bitmaps[key] = self.bitmaps.get(key, 0) | (1 << self.ordinal(member))
+
+    def discard(self, key, member):
+        """
+        Dissociates member from key, if they were associated.
+        """
+        ordinal = self.ordinals.get(member)
+        if ordinal is None:
+            return
+        bitmap = self.bitmaps.get(key, 0) & ~(1 << ordinal)
+        if bitmap:
+            self.bitmaps[key] = bitmap
+        else:
+            self.bitmaps.pop(key, None)
+
+    def discard_member(self, member):
+        """
+        Dissociates member from every key, and retires its ordinal.
+        """
+        ordinal = self.ordinals.get(member)
+        if ordinal is None:
+            return
+        for key in [key for key, bitmap in self.bitmaps.items() if bitmap >> ordinal & 1]:
+            self.discard(key, member)
+        del self.ordinals[member]
+        self.members[ordinal] = None
+
+    def get(self, key):
+        """
+        Returns the bitmap of the members of key.
+        """
+        return self.bitmaps.get(key, 0)
+
+    def intersection(self, keys, bitmap=-1):
+        """
+        Returns the bitmap of the members associated with every key, restricted to bitmap if given.
+        """
+        for key in keys:
+            bitmap &= self.bitmaps.get(key, 0)
+            if not bitmap:
+                return 0
+        return bitmap if bitmap >= 0 else 0
+
+    def members_of(self, bitmap):
+        """
+        Returns the sorted members whose bit is set in bitmap, a bitmap of this index.
+        """
+        members = self.members
+        return sorted(member for member in map(members.__getitem__, bitmap_members(bitmap)) if member is not None)
@@ -0,0 +1,59 @@
+"""
+Bloom filter used to reject unknown trie prefixes without walking the trie.
+"""
+
+import math
+from hashlib import blake2b
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings: "item in bloom_filter" is never False for an added item, and is
+    True for an item never added with a probability close to error_rate while no more than capacity
+    items have been added.
+
+    Positions are derived from a single blake2b digest with double hashing, so a filter built in one
+    process gives the same answers in any other one.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_bits(cls, bits, size, hash_count):
+        """
+        Returns a filter using existing bits, e.g. read from a trie snapshot.
+        """
+        bloom = cls.__new__(cls)
+        bloom.size = size
+        bloom.hash_count = hash_count
+        bloom.bits = bits
+        return bloom
+
+    def copy(self):
+        """
+        Returns an independent, writable copy of the filter.
+        """
+        return BloomFilter.from_bits(bytearray(self.bits), self.size, self.hash_count)
+
+    def _positions(self, item):
+        """
+        Returns the bit positions of the given string.
+        """
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + index * second) % self.size for index in range(self.hash_count)]
+
+    def add(self, item):
+        """
+        Adds a string to the filter.
+        """
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
@@ -0,0 +1,170 @@
+"""
+Array backed trie for large tag sets.
+"""
+
+from array import array
+from copy import copy as shallow_copy
+
+from .trie import Trie
+
+NO_NODE = -1
+
+
+class CompactTrie(Trie):
+    """
+    Trie storing its nodes in flat arrays instead of one ``TrieNode`` object per character.
+
+    Nodes are integer indexes into parallel arrays, using a left-child right-sibling layout:
+    - chars: code point of the edge leading to the node
+    - first_child: index of the first child of the node, or -1
+    - next_sibling: index of the next child of the same parent, or -1
+    - terminal: 1 if a word ends at the node
+
+    This costs 13 bytes per node instead of a Python object and a dict per node, so the nodes take
+    about 20 times less memory than the ones of ``Trie``, while exposing the same API. The top
+    completions (top_k) and the prefix filter are stored as in ``Trie``: with them, as configured by
+    StackRepository, the whole trie is about 5 to 6 times smaller. Children are kept in insertion
+    order, so ``find_words`` returns the same results in the same order as ``Trie``. Slots freed by
+    ``delete`` are reused by later inserts.
+
+    A CompactTrie returned by ``trie_snapshot.load_trie`` reads its arrays from a read-only mapped
+    file (``snapshot``). ``copy`` and ``set_weights`` keep reading them from the file, the weights and
+    top completions they change being private dicts; the first insert, delete or initialize copies
+    the arrays into private memory.
+    """
+
+    def __init__(self, top_k=0, prefix_filter=False, normalize=str.lower, variants=None):
+        self.chars = array("I", [0])
+        self.first_child = array("i", [NO_NODE])
+        self.next_sibling = array("i", [NO_NODE])
+        self.terminal = bytearray(1)
+        self.free_nodes = []
+        self.snapshot = None
+        super().__init__(top_k=top_k, prefix_filter=prefix_filter, normalize=normalize, variants=variants)
+
+    def __len__(self):
+        return len(self.chars) - len(self.free_nodes)
+
+    def _thaw(self):
+        """
+        Copies a trie loaded from a snapshot into private, writable memory.
+        """
+        if self.snapshot is None:
+            return
+        self.chars = array("I", self.chars.tobytes())
+        self.first_child = array("i", self.first_child.tobytes())
+        self.next_sibling = array("i", self.next_sibling.tobytes())
+        self.terminal = bytearray(self.terminal)
+        self.weights = dict(self.weights.items())
+        self.labels = dict(self.labels)
+        self.top_completions = dict(self.top_completions.items())
+        self.free_nodes = []
+        if self.prefix_filter is not None:
+            self.prefix_filter = self.prefix_filter.copy()
+        self.snapshot = None
+
+    def copy(self):
+        """
+        Returns a new version of the trie, with its own copy of the node arrays. Versions of a trie
+        loaded from a snapshot share its read-only arrays until they change them.
+        """
+        if self.snapshot is not None:
+            clone = shallow_copy(self)
+            clone.weights = self.weights.copy()
+            clone.labels = dict(self.labels)
+            clone.top_completions = self.top_completions.copy()
+            return clone
+        clone = super().copy()
+        clone.chars = self.chars[:]
+        clone.first_child = self.first_child[:]
+        clone.next_sibling = self.next_sibling[:]
+        clone.terminal = self.terminal[:]
+        clone.free_nodes = list(self.free_nodes)
+        return clone
+
+    def insert(self, word, weight=None):
+        self._thaw()
+        super().insert(word, weight)
+
+    def delete(self, word):
+        self._thaw()
+        super().delete(word)
+
+    def initialize(self, data, separator=None, weights=None):
+        self._thaw()
+        super().initialize(data, separator, weights)
+
+    def _new_root(self):
+        return 0
+
+    def _new_node(self, code):
+        """
+        Allocates a node for the given code point, reusing a freed slot if there is one.
+        """
+        if self.free_nodes:
+            index = self.free_nodes.pop()
+            self.chars[index] = code
+            self.first_child[index] = NO_NODE
+            self.next_sibling[index] = NO_NODE
+            self.terminal[index] = 0
+            return index
+        self.chars.append(code)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.terminal.append(0)
+        return len(self.chars) - 1
+
+    def _child(self, node, char):
+        code = ord(char)
+        child = self.first_child[node]
+        while child != NO_NODE:
+            if self.chars[child] == code:
+                return child
+            child = self.next_sibling[child]
+        return None
+
+    def _add_child(self, node, char):
+        child = self._new_node(ord(char))
+        last = self.first_child[node]
+        if last == NO_NODE:
+            self.first_child[node] = child
+            return child
+        while self.next_sibling[last] != NO_NODE:
+            last = self.next_sibling[last]
+        self.next_sibling[last] = child
+        return child
+
+    def _remove_child(self, node, char):
+        code = ord(char)
+        previous = NO_NODE
+        child = self.first_child[node]
+        while child != NO_NODE and self.chars[child] != code:
+            previous = child
+            child = self.next_sibling[child]
+        if child == NO_NODE:
+            raise KeyError(char)
+        if previous == NO_NODE:
+            self.first_child[node] = self.next_sibling[child]
+        else:
+            self.next_sibling[previous] = self.next_sibling[child]
+        self.free_nodes.append(child)
+
+    def _children(self, node):
+        children = []
+        child = self.first_child[node]
+        while child != NO_NODE:
+            children.append((chr(self.chars[child]), child))
+            child = self.next_sibling[child]
+        return children
+
+    def _writable(self, parent, char, node):
+        return node
+
+    def _has_children(self, node):
+        return self.first_child[node] != NO_NODE
+
+    def _is_end(self, node):
+        return self.terminal[node] == 1
+
+    def _set_end(self, node, value):
+        self.terminal[node] = 1 if value else 0
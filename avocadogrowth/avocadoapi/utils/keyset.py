@@ -0,0 +1,60 @@
+"""
+Keyset (cursor) pagination: a page is fetched by filtering on the sort key of the last row of the
+previous page instead of skipping rows with OFFSET, so with an index on the filter and sort columns
+every page costs the same, however deep.
+"""
+
+import base64
+import json
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+KeysetPage = namedtuple("KeysetPage", ["items", "next_cursor"])
+
+
+def encode_cursor(values):
+    """
+    Returns the opaque cursor of a sort key, a list of JSON serializable values.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Returns the sort key of a cursor made by encode_cursor, or raises ValueError if it is invalid.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as error:
+        raise ValueError("Invalid cursor") from error
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def keyset_page(queryset, field, page_size, cursor=None):
+    """
+    Returns the KeysetPage of queryset following cursor (the first page if None), newest first:
+    ordered by field (a non null field) descending, then primary key descending to break ties.
+    next_cursor is None on the last page.
+    """
+    if page_size < 1:
+        raise ValueError(f"Page size {page_size} is not positive")
+    model_field = queryset.model._meta.get_field(field)  # pylint: disable=protected-access
+    queryset = queryset.order_by(f"-{field}", "-pk")
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != 2:
+            raise ValueError("Invalid cursor")
+        try:
+            value, pk = model_field.to_python(values[0]), int(values[1])
+        except (ValidationError, ValueError, TypeError) as error:
+            raise ValueError("Invalid cursor") from error
+        queryset = queryset.filter(Q(**{f"{field}__lt": value}) | Q(**{field: value, "pk__lt": pk}))
+    items = list(queryset[: page_size + 1])
+    if len(items) <= page_size:
+        return KeysetPage(items, None)
+    last = items[page_size - 1]
+    return KeysetPage(items[:page_size], encode_cursor([model_field.value_to_string(last), last.pk]))
@@ -0,0 +1,41 @@
+"""
+Normalization of stack tags, shared by the Stacks model, the repositories and the autocomplete trie.
+"""
+
+import unicodedata
+
+from django.conf import settings
+
+# Alternative spellings of a tag, keyed by their normalized form
+TAG_ALIASES = {
+    "c sharp": "c#",
+    "c-sharp": "c#",
+    "csharp": "c#",
+    "f sharp": "f#",
+    "f-sharp": "f#",
+    "fsharp": "f#",
+    "c plus plus": "c++",
+    "cplusplus": "c++",
+    "cpp": "c++",
+    "golang": "go",
+}
+
+
+def fold_tag(tag):
+    """
+    Returns a stack tag case folded, without accents and with single spaces, aliases left as they are
+    ("Golang" -> "golang")
+    """
+    tag = unicodedata.normalize("NFKD", tag.casefold())
+    return " ".join("".join(char for char in tag if not unicodedata.combining(char)).split())
+
+
+def normalize_tag(tag):
+    """
+    Returns the normalized form of a stack tag: folded (see fold_tag) with known aliases replaced
+    ("Données" -> "donnees", "C-Sharp" -> "c#").
+    Extra aliases can be declared in settings.STACKS_TAG_ALIASES.
+    """
+    tag = fold_tag(tag)
+    aliases = getattr(settings, "STACKS_TAG_ALIASES", None) or {}
+    return aliases.get(tag) or TAG_ALIASES.get(tag, tag)
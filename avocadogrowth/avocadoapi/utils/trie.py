@@ -1,8 +1,16 @@
+import heapq
+from copy import copy as shallow_copy
+from itertools import islice
+
+from .bloom_filter import BloomFilter
+
+
 class TrieNode:
     # pylint: disable=too-few-public-methods
-    def __init__(self):
+    def __init__(self, owner=None):
         self.children = {}
         self.is_end_of_word = False
+        self.owner = owner
 
 
 class Trie:
@@ -10,77 +18,268 @@ class Trie:
     Trie data structure implementation.
 
     Supports the following operations:
-    - insert(word: str) -> None: Inserts a word into the trie.
+    - insert(word: str, weight: Optional[float] = None) -> None: Inserts a word into the trie.
     - search(word: str) -> bool: Searches for a word in the trie.
     - starts_with(prefix: str) -> bool: Searches for a prefix in the trie.
     - delete(word: str) -> None: Deletes a word from the trie.
-    - find_words(prefix: str) -> List[str]: Finds all words with a given prefix.
-    - initialize(data: Union[str, List[str]], separator: Optional[str] = None) -> None:
-    Initializes the trie with a list of words or a string of words.
+    - find_words(prefix: str, limit: Optional[int] = None) -> List[str]: Finds all words with a given prefix.
+    - iter_words(prefix: str) -> Iterator[str]: Lazily yields the words with a given prefix.
+    - find_fuzzy(prefix: str, max_distance: int = 1, limit: Optional[int] = None) -> List[str]:
+    Finds the words starting with a prefix within max_distance edits of the given one.
+    - find_top_k(prefix: str, k: int) -> List[str]: Finds the k heaviest words with a given prefix.
+    - initialize(data: Union[str, List[str]], separator: Optional[str] = None, weights: Optional[dict] = None)
+    -> None: Initializes the trie with a list of words or a string of words.
+    - set_weights(weights: dict) -> None: Replaces the find_top_k weights of the words.
+    - copy() -> Trie: Returns a new version of the trie, sharing its nodes until either one changes.
+
+    When created with top_k > 0, every node where a word ends or where the trie branches keeps its
+    top_k best completions, ranked by weight then alphabetically. find_top_k then costs
+    O(len(prefix) + k) whatever the size of the trie. Nodes with a single child share the cache of
+    the next cached node below them, so the caches grow with the number of words, not of nodes.
+
+    Words are stored under a key, the word passed through normalize (str.lower by default), which
+    is also applied to the looked up prefixes. variants, if given, returns extra keys a word is also
+    found under (e.g. its spelling before normalize replaces aliases). The trie returns the words as
+    they were inserted, each once whatever the number of its keys matching: labels maps the keys to
+    their word when they differ.
+
+    When created with prefix_filter=True, a Bloom filter holding every prefix of every word lets
+    lookups of unknown prefixes (typos, junk keystrokes) return without walking the trie. Deleted
+    words leave their prefixes in the filter until the next initialize or rebuild_prefix_filter,
+    which only costs a normal trie walk for them.
+
+    A trie is not safe to change while other threads read it. Instead, writers change a copy() and
+    then publish it by replacing the reference readers use (see StackRepository.sync_trie): readers
+    never lock and keep a consistent version for as long as they hold it. Copies share their nodes,
+    and a node is copied (along with the path from the root to it) the first time a version changes
+    it, so a copy costs O(number of words) for the weights and caches, not O(number of nodes).
+
+    The algorithms only reach the nodes through the ``_new_root``, ``_child``, ``_add_child``,
+    ``_remove_child``, ``_children``, ``_has_children``, ``_is_end``, ``_set_end`` and ``_writable``
+    helpers, so subclasses can change the node storage (see ``CompactTrie``) without changing the
+    behaviour.
     """
 
-    def __init__(self):
-        self.root = TrieNode()
+    def __init__(self, top_k=0, prefix_filter=False, normalize=str.lower, variants=None):
+        self.token = object()
+        self.root = self._new_root()
+        self.normalize = normalize
+        self.variants = variants
+        self.top_k = top_k
+        self.weights = {}
+        self.labels = {}
+        self.top_completions = {}
+        self.prefix_filter = BloomFilter(1024) if prefix_filter else None
+
+    def _new_root(self):
+        """
+        Returns the root node of an empty trie.
+        """
+        return TrieNode(owner=self.token)
+
+    def _child(self, node, char):
+        """
+        Returns the child of node for the given character, or None.
+        """
+        return node.children.get(char)
+
+    def _add_child(self, node, char):
+        """
+        Creates and returns a new child of node for the given character.
+        """
+        child = TrieNode(owner=self.token)
+        node.children[char] = child
+        return child
+
+    def _remove_child(self, node, char):
+        """
+        Removes the child of node for the given character.
+        """
+        del node.children[char]
+
+    def _children(self, node):
+        """
+        Returns the (char, child) pairs of node, in insertion order.
+        """
+        return node.children.items()
+
+    def _has_children(self, node):
+        """
+        Returns True if node has at least one child.
+        """
+        return bool(node.children)
+
+    def _is_end(self, node):
+        """
+        Returns True if a word ends at node.
+        """
+        return node.is_end_of_word
 
-    def insert(self, word):
+    def _set_end(self, node, value):
+        """
+        Marks or unmarks node as the end of a word.
+        """
+        node.is_end_of_word = value
+
+    def _writable(self, parent, char, node):
+        """
+        Returns node if it belongs to this version of the trie. Otherwise, returns a copy of it that
+        replaces it under parent (parent being None for the root), parent having to be writable.
+        """
+        if node.owner is self.token:
+            return node
+        clone = TrieNode(owner=self.token)
+        clone.children = dict(node.children)
+        clone.is_end_of_word = node.is_end_of_word
+        if parent is None:
+            self.root = clone
+        else:
+            parent.children[char] = clone
+        if node in self.top_completions:
+            self.top_completions[clone] = self.top_completions.pop(node)
+        return clone
+
+    def copy(self):
+        """
+        Returns a new version of the trie. Both versions share their nodes, until one of them changes
+        a node and gets its own copy of it.
+        """
+        clone = shallow_copy(self)
+        clone.weights = dict(self.weights)
+        clone.labels = dict(self.labels)
+        clone.top_completions = dict(self.top_completions)
+        if self.prefix_filter is not None:
+            clone.prefix_filter = self.prefix_filter.copy()
+        # Every existing node is now shared, so both versions must copy them before any change
+        self.token = object()
+        clone.token = object()
+        return clone
+
+    def _keys(self, word):
+        """
+        Returns the keys of a word: its normalized form, then its variants.
+        """
+        keys = [self.normalize(word)]
+        if self.variants is not None:
+            keys.extend(variant for variant in self.variants(word) if variant not in keys)
+        return keys
+
+    def _word(self, key):
+        """
+        Returns the word stored under key.
+        """
+        return self.labels.get(key, key)
+
+    def _distinct_keys(self, keys):
+        """
+        Yields the keys whose word was not reached through a previous key.
+        """
+        seen = set()
+        for key in keys:
+            word = self._word(key)
+            if word not in seen:
+                seen.add(word)
+                yield key
+
+    def insert(self, word, weight=None):
         """
         Inserts a word into the trie.
+        The weight, if given, is used to rank the word in find_top_k.
         """
-        node = self.root
-        word = word.lower()
-        for char in word:
-            if char not in node.children:
-                node.children[char] = TrieNode()
-            node = node.children[char]
-        node.is_end_of_word = True
+        for key in self._keys(word):
+            self._insert_key(key, word, weight)
+
+    def _insert_key(self, key, word, weight):
+        """
+        Stores word under key.
+        """
+        node = self._writable(None, None, self.root)
+        path = [node]
+        for char in key:
+            child = self._child(node, char)
+            if child is None:
+                child = self._add_child(node, char)
+                if self.prefix_filter is not None:
+                    self.prefix_filter.add(key[: len(path)])
+            else:
+                child = self._writable(node, char, child)
+            node = child
+            path.append(node)
+        self._set_end(node, True)
+        if word == key:
+            self.labels.pop(key, None)
+        else:
+            self.labels[key] = word
+        if weight is not None:
+            self.weights[key] = weight
+        if self.top_k:
+            self._refresh_path(path, key)
 
     def search(self, word):
         """
         Searches for a word in the trie.
         """
         node = self.root
-        word = word.lower()
+        word = self.normalize(word)
         for char in word:
-            if char not in node.children:
+            node = self._child(node, char)
+            if node is None:
                 return False
-            node = node.children[char]
-        return node.is_end_of_word
+        return self._is_end(node)
 
     def starts_with(self, prefix):
         """
         Searches for a prefix in the trie.
         """
-        node = self.root
-        prefix = prefix.lower()
-        for char in prefix:
-            if char not in node.children:
-                return False
-            node = node.children[char]
-        return True
+        return self._find_node(self.normalize(prefix)) is not None
 
     def delete(self, word):
         """
         Deletes a word from the trie.
         """
-        word = word.lower()
-        self._delete_recursive(self.root, word, 0)
+        for key in self._keys(word):
+            self._delete_key(key)
+
+    def _delete_key(self, key):
+        """
+        Removes key and the word stored under it.
+        """
+        node = self._find_node(key)
+        if node is None or not self._is_end(node):
+            return
+        node = self._writable(None, None, self.root)
+        for char in key:
+            node = self._writable(node, char, self._child(node, char))
+        self._delete_recursive(self.root, key, 0)
+        self.weights.pop(key, None)
+        self.labels.pop(key, None)
+        if self.top_k:
+            node = self.root
+            path = [node]
+            for char in key:
+                node = self._child(node, char)
+                if node is None:
+                    break
+                path.append(node)
+            self._refresh_path(path, key)
 
     def _delete_recursive(self, node, word, index):
         """
         Helper function for deleting a word from the trie.
         """
         if index == len(word):
-            if not node.is_end_of_word:
+            if not self._is_end(node):
                 return
-            node.is_end_of_word = False
+            self._set_end(node, False)
             return
         char = word[index]
-        if char not in node.children:
+        child_node = self._child(node, char)
+        if child_node is None:
             return
-        child_node = node.children[char]
         self._delete_recursive(child_node, word, index + 1)
-        if child_node.children == {} and not child_node.is_end_of_word:
-            del node.children[char]
+        if not self._has_children(child_node) and not self._is_end(child_node):
+            self._remove_child(node, char)
+            self.top_completions.pop(child_node, None)
 
     def _from_str(self, string, separator=" "):
         """
@@ -97,46 +296,236 @@ class Trie:
         for word in words:
             self.insert(word)
 
-    def initialize(self, data, separator=None):
+    def initialize(self, data, separator=None, weights=None):
         """
         Initializes the trie with a list of words or a string of words.
+        weights optionally maps words to their find_top_k weight.
         """
-        if isinstance(data, str):
-            if not separator:
-                self._from_str(data)
+        # The top completions are rebuilt once at the end instead of after every insert
+        top_k, self.top_k = self.top_k, 0
+        try:
+            if isinstance(data, str):
+                if not separator:
+                    self._from_str(data)
+                else:
+                    self._from_str(data, separator)
+            elif isinstance(data, list):
+                self._from_list(data)
             else:
-                self._from_str(data, separator)
-        elif isinstance(data, list):
-            self._from_list(data)
-        else:
-            raise ValueError("Data type not supported")
+                raise ValueError("Data type not supported")
+            for word, weight in (weights or {}).items():
+                for key in self._keys(word):
+                    self.weights[key] = weight
+        finally:
+            self.top_k = top_k
+        if self.top_k:
+            self.rebuild_top_completions()
+        if self.prefix_filter is not None:
+            self.rebuild_prefix_filter()
+
+    def set_weights(self, weights):
+        """
+        Replaces the find_top_k weights of the words with weights, a mapping of words to weights.
+        Words left out weigh 0.
+        """
+        self.weights = {key: weight for word, weight in weights.items() for key in self._keys(word)}
+        self.rebuild_top_completions()
+
+    def find_words(self, prefix, limit=None):
+        """
+        Finds all words with a given prefix, or only the first limit ones.
+        """
+        return list(islice(self.iter_words(prefix), limit))
+
+    def iter_words(self, prefix):
+        """
+        Yields the words with a given prefix one at a time, in the same order as find_words.
+        Stop iterating (or use itertools.islice) to only pay for the results actually consumed.
+        """
+        prefix = self.normalize(prefix)
+        node = self._find_node(prefix)
+        if node is None:
+            return iter(())
+        return map(self._word, self._distinct_keys(self._iter_subtree(node, prefix)))
+
+    def _iter_subtree(self, node, prefix):
+        """
+        Depth first traversal of the keys in the subtree of node with an explicit stack, so long words cannot hit
+        the recursion limit. The characters below node are kept in one shared buffer that is truncated
+        when the traversal goes back up, instead of building a new string at every level.
+        """
+        chars = []
+        stack = [(node, 0, "")]
+        while stack:
+            node, depth, char = stack.pop()
+            del chars[depth:]
+            chars.append(char)
+            if self._is_end(node):
+                yield prefix + "".join(chars)
+            depth = len(chars)
+            for char, child in reversed(self._children(node)):
+                stack.append((child, depth, char))
 
-    def find_words(self, prefix):
+    def _find_node(self, prefix):
         """
-        Finds all words with a given prefix.
+        Returns the node reached by the given prefix, or None if no word starts with it.
+        Stops at the first missing character, or before walking if the prefix filter rejects it.
         """
+        if prefix and self.prefix_filter is not None and prefix not in self.prefix_filter:
+            return None
         node = self.root
-        prefix = prefix.lower()
-        words = []
         for char in prefix:
-            if char not in node.children:
-                break
-            node = node.children[char]
+            node = self._child(node, char)
+            if node is None:
+                return None
+        return node
 
-        if node.is_end_of_word:
-            words.append(prefix)
+    def _rank(self, key):
+        """
+        Sort key for find_top_k: heaviest words first, then alphabetical order of their keys.
+        """
+        return -self.weights.get(key, 0), key
+
+    def _top_of(self, node):
+        """
+        Returns the cached top completions of node, following single child chains down to the next
+        cached node.
+        """
+        while node not in self.top_completions:
+            children = self._children(node)
+            if not children:
+                return ()
+            node = next(iter(children))[1]
+        return self.top_completions[node]
 
-        self._find_words_recursive(node, prefix, words)
-        return words
+    def _refresh_node(self, node, prefix):
+        """
+        Recomputes the top completions of node from its own key and the caches of its children,
+        keeping one key per word.
+        """
+        if not self._is_end(node) and len(self._children(node)) < 2:
+            self.top_completions.pop(node, None)
+            return
+        candidates = [prefix] if self._is_end(node) else []
+        for _, child in self._children(node):
+            candidates.extend(self._top_of(child))
+        ranked = sorted(candidates, key=self._rank)
+        self.top_completions[node] = tuple(islice(self._distinct_keys(ranked), self.top_k))
+
+    def _refresh_path(self, path, word):
+        """
+        Recomputes the top completions of the nodes on path, from the deepest to the root.
+        """
+        for depth in range(len(path) - 1, -1, -1):
+            self._refresh_node(path[depth], word[:depth])
 
-    def _find_words_recursive(self, node, prefix, words):
+    def rebuild_top_completions(self):
         """
-        Helper function for finding all words with a given prefix.
+        Recomputes the top completions of every node in one post-order pass.
         """
-        if node.is_end_of_word and prefix not in words:
-            words.append(prefix)
-        for char, child_node in node.children.items():
-            self._find_words_recursive(child_node, prefix + char, words)
+        self.top_completions = {}
+        if not self.top_k:
+            return
+        stack = [(self.root, "", False)]
+        while stack:
+            node, prefix, expanded = stack.pop()
+            if expanded:
+                self._refresh_node(node, prefix)
+                continue
+            stack.append((node, prefix, True))
+            for char, child in self._children(node):
+                stack.append((child, prefix + char, False))
+
+    def rebuild_prefix_filter(self):
+        """
+        Rebuilds the prefix filter from the current words, sized with room to grow, and drops the
+        prefixes of deleted words.
+        """
+        prefixes = []
+        stack = [(self.root, "")]
+        while stack:
+            node, prefix = stack.pop()
+            for char, child in self._children(node):
+                prefixes.append(prefix + char)
+                stack.append((child, prefix + char))
+        self.prefix_filter = BloomFilter(max(1024, 2 * len(prefixes)))
+        for prefix in prefixes:
+            self.prefix_filter.add(prefix)
+
+    def find_top_k(self, prefix, k):
+        """
+        Finds the k words with the highest weight starting with a given prefix.
+        Served from the cached completions when k <= top_k, otherwise ranks all the matching words.
+        """
+        prefix = self.normalize(prefix)
+        node = self._find_node(prefix)
+        if node is None or k <= 0:
+            return []
+        if k <= self.top_k:
+            return [self._word(key) for key in self._top_of(node)[:k]]
+        keys = heapq.nsmallest(k, self._distinct_keys(self._iter_subtree(node, prefix)), key=self._rank)
+        return [self._word(key) for key in keys]
+
+    def find_fuzzy(self, prefix, max_distance=1, limit=None):
+        """
+        Finds the words having a prefix within max_distance edits (insertion, deletion, substitution or
+        transposition of two adjacent characters) of the given prefix, closest first, then heaviest.
+
+        The trie is walked depth first carrying the row of the edit distance matrix between the
+        prefix and the current node, and a subtree is pruned as soon as every value of its row is
+        above max_distance. Only the cells within max_distance of the diagonal are computed, the
+        others being out of bounds anyway. A word's distance is the smallest one among the matching
+        nodes on its path, which the walk carries down (covered): each node is reached once, and the
+        words below the last matching node are read in one pass over its remaining subtree. When
+        limit <= top_k, a matching node contributes its cached top completions instead.
+        """
+        # Comparisons are inlined instead of calling min() in the inner loop, which runs per child and cell
+        # pylint: disable=too-many-locals,too-many-branches,consider-using-min-builtin
+        prefix = self.normalize(prefix)
+        use_top = limit is not None and limit <= self.top_k
+        out_of_bounds = max_distance + 1
+        distances = {}
+        stack = [(self.root, "", list(range(len(prefix) + 1)), None, "", out_of_bounds)]
+        while stack:
+            node, word, row, previous_row, previous_char, covered = stack.pop()
+            distance = row[-1]
+            if use_top:
+                if distance <= max_distance:
+                    for completion in self._top_of(node)[:limit]:
+                        if distances.get(completion, out_of_bounds) > distance:
+                            distances[completion] = distance
+            else:
+                if covered < distance:
+                    distance = covered
+                if distance <= max_distance and self._is_end(node):
+                    distances[word] = distance
+            covered = distance
+            depth = len(word) + 1
+            first = max(1, depth - max_distance)
+            last = min(len(prefix), depth + max_distance)
+            for char, child in self._children(node):
+                child_row = [min(depth, out_of_bounds)] + [out_of_bounds] * len(prefix)
+                best = left = child_row[first - 1]
+                for index in range(first, last + 1):
+                    value = row[index - 1] + (prefix[index - 1] != char)
+                    if row[index] < value:
+                        value = row[index] + 1
+                    if left < value:
+                        value = left + 1
+                    if index > 1 and prefix[index - 1] == previous_char and prefix[index - 2] == char:
+                        value = min(value, previous_row[index - 2] + 1)
+                    if value > out_of_bounds:
+                        value = out_of_bounds
+                    child_row[index] = left = value
+                    if value < best:
+                        best = value
+                if best <= max_distance:
+                    stack.append((child, word + char, child_row, row, char, covered))
+                elif not use_top and covered <= max_distance:
+                    for completion in self._iter_subtree(child, word + char):
+                        distances[completion] = covered
+        ranked = sorted(distances, key=lambda completion: (distances[completion], self._rank(completion)))
+        return [self._word(key) for key in islice(self._distinct_keys(ranked), limit)]
 
     def __str__(self):
         self._print_recursive(self.root, "")
@@ -145,7 +534,7 @@ class Trie:
         """
         Helper function for printing the trie.
         """
-        if node.is_end_of_word:
-            print(prefix)
-        for char, child_node in node.children.items():
+        if self._is_end(node):
+            print(self._word(prefix))
+        for char, child_node in self._children(node):
             self._print_recursive(child_node, prefix + char)
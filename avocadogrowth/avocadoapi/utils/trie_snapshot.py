@@ -0,0 +1,247 @@
+"""
+Binary snapshots of tries, loaded with mmap so that every process shares one read-only copy.
+
+A snapshot is a header (version, weights generation, sizes) followed by flat sections, each padded
+to 8 bytes:
+- weights (float64 per node): weight of the word ending at the node, 0 otherwise
+- chars, first_child, next_sibling, parent (int32 per node): the CompactTrie layout plus parent links
+- top_offsets (int32 per node + 1) and top_nodes (int32): top completions of node i are the words
+  ending at top_nodes[top_offsets[i]:top_offsets[i + 1]]
+- terminal, cached (uint8 per node): a word ends at the node / the node has top completions
+- bloom (bytes): bits of the prefix filter, if any
+- labels (bytes): JSON object mapping the keys to their word, where they differ
+
+Numbers use the native byte order: a snapshot is meant to be read on the machine that wrote it.
+"""
+
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections import deque
+from copy import copy as shallow_copy
+
+from .bloom_filter import BloomFilter
+from .compact_trie import NO_NODE, CompactTrie
+
+MAGIC = b"AVTRIE03"
+HEADER = struct.Struct("=8sQ32sIIIIQQ")
+
+
+def _padding(size):
+    return -size % 8
+
+
+def _word(chars, parent, node):
+    """
+    Rebuilds the word ending at node by following the parent links up to the root.
+    """
+    letters = []
+    while node > 0:
+        letters.append(chr(chars[node]))
+        node = parent[node]
+    return "".join(reversed(letters))
+
+
+class SnapshotWeights:
+    """
+    Read-only word -> weight mapping over the weights section of a snapshot.
+    """
+
+    def __init__(self, trie, weights, parent):
+        self.trie = trie
+        self.weights = weights
+        self.parent = parent
+
+    def copy(self):
+        """
+        Returns the mapping itself: it is read-only, so copies of the trie can share it.
+        """
+        return self
+
+    def get(self, word, default=0):
+        """
+        Returns the weight of word, or default if the trie does not contain it.
+        """
+        # pylint: disable=protected-access
+        node = self.trie._find_node(word)
+        if node is None or not self.trie._is_end(node):
+            return default
+        return self.weights[node]
+
+    def items(self):
+        """
+        Yields the (word, weight) pairs of the snapshot.
+        """
+        for node, end in enumerate(self.trie.terminal):
+            if end:
+                yield _word(self.trie.chars, self.parent, node), self.weights[node]
+
+
+class SnapshotTopCompletions:
+    """
+    Read-only node -> top completions mapping over the top sections of a snapshot.
+    """
+
+    def __init__(self, trie, offsets, nodes, cached, parent):
+        self.trie = trie
+        self.offsets = offsets
+        self.nodes = nodes
+        self.cached = cached
+        self.parent = parent
+
+    def copy(self):
+        """
+        Returns the mapping itself: it is read-only, so copies of the trie can share it.
+        """
+        return self
+
+    def __contains__(self, node):
+        return self.cached[node] == 1
+
+    def __getitem__(self, node):
+        if not self.cached[node]:
+            raise KeyError(node)
+        start, end = self.offsets[node], self.offsets[node + 1]
+        entries = self.nodes[start:end]
+        return tuple(_word(self.trie.chars, self.parent, entry) for entry in entries)
+
+    def items(self):
+        """
+        Yields the (node, top completions) pairs of the snapshot.
+        """
+        for node, cached in enumerate(self.cached):
+            if cached:
+                yield node, self[node]
+
+
+def save_trie(trie, path, version=0, generation=None):
+    """
+    Writes any Trie (or CompactTrie) to path as a snapshot. version and generation (a string of up to
+    32 bytes, or None) are stored as is and returned by load_trie, e.g. to know which changes happened
+    after the snapshot and which weights it has.
+    The file is written next to path then renamed, so processes mapping the old file are unaffected.
+    """
+    # pylint: disable=protected-access,too-many-locals,too-many-statements
+    nodes = [trie.root]
+    chars = array("I", [0])
+    first_child = array("i", [NO_NODE])
+    next_sibling = array("i", [NO_NODE])
+    parent = array("i", [NO_NODE])
+    terminal = bytearray([1 if trie._is_end(trie.root) else 0])
+    weights = array("d", [trie.weights.get("", 0) if terminal[0] else 0])
+    word_nodes = {"": 0}
+    queue = deque([(trie.root, 0, "")])
+    while queue:
+        node, index, word = queue.popleft()
+        previous = NO_NODE
+        for char, child in trie._children(node):
+            child_index = len(nodes)
+            child_word = word + char
+            end = trie._is_end(child)
+            nodes.append(child)
+            chars.append(ord(char))
+            first_child.append(NO_NODE)
+            next_sibling.append(NO_NODE)
+            parent.append(index)
+            terminal.append(1 if end else 0)
+            weights.append(trie.weights.get(child_word, 0) if end else 0)
+            if end:
+                word_nodes[child_word] = child_index
+            if previous == NO_NODE:
+                first_child[index] = child_index
+            else:
+                next_sibling[previous] = child_index
+            previous = child_index
+            queue.append((child, child_index, child_word))
+
+    cached = bytearray(len(nodes))
+    top_offsets = array("i", [0])
+    top_nodes = array("i")
+    for index, node in enumerate(nodes):
+        if node in trie.top_completions:
+            cached[index] = 1
+            top_nodes.extend(word_nodes[word] for word in trie.top_completions[node])
+        top_offsets.append(len(top_nodes))
+
+    generation = (generation or "").encode()
+    if len(generation) > 32:
+        raise ValueError("The generation of a trie snapshot is at most 32 bytes long")
+    bloom = trie.prefix_filter
+    labels = json.dumps(dict(trie.labels)).encode()
+    header = HEADER.pack(
+        MAGIC,
+        version,
+        generation,
+        len(nodes),
+        trie.top_k,
+        len(top_nodes),
+        bloom.hash_count if bloom is not None else 0,
+        bloom.size if bloom is not None else 0,
+        len(labels),
+    )
+    sections = [weights, chars, first_child, next_sibling, parent, top_offsets, top_nodes, terminal, cached]
+    if bloom is not None:
+        sections.append(bloom.bits)
+    sections.append(labels)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(header + bytes(_padding(len(header))))
+        for section in sections:
+            data = bytes(section)
+            file.write(data + bytes(_padding(len(data))))
+    os.replace(temporary_path, path)
+
+
+def load_trie(path, normalize=str.lower, variants=None):
+    """
+    Maps a snapshot written by save_trie and returns (trie, version, generation), normalize and
+    variants being the functions the saved trie was using. The trie is a CompactTrie reading straight
+    from the mapped file: loading only parses the labels, not the nodes, and the pages are shared by
+    every process mapping the same file. Its copies and set_weights keep sharing the node arrays;
+    its first insert, delete or initialize copies them into private memory.
+    Raises OSError if the file cannot be read, and ValueError or struct.error if it is not a complete
+    snapshot of this version.
+    """
+    # pylint: disable=too-many-locals
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(data)
+    header = HEADER.unpack_from(view)
+    magic, version, generation, node_count, top_k, top_count, hash_count, bloom_size, labels_size = header
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a trie snapshot of this version")
+
+    offset = HEADER.size + _padding(HEADER.size)
+
+    def section(fmt, length):
+        nonlocal offset
+        start = offset
+        offset += length * struct.calcsize(fmt)
+        if offset > len(view):
+            raise ValueError(f"{path} is truncated")
+        result = view[start:offset].cast(fmt)
+        offset += _padding(offset - start)
+        return result
+
+    weights = section("d", node_count)
+    trie = CompactTrie(top_k=top_k, normalize=normalize, variants=variants)
+    trie.chars = section("I", node_count)
+    trie.first_child = section("i", node_count)
+    trie.next_sibling = section("i", node_count)
+    parent = section("i", node_count)
+    top_offsets = section("i", node_count + 1)
+    top_nodes = section("i", top_count)
+    trie.terminal = section("B", node_count)
+    cached = section("B", node_count)
+    if bloom_size:
+        trie.prefix_filter = BloomFilter.from_bits(section("B", (bloom_size + 7) // 8), bloom_size, hash_count)
+    trie.labels = json.loads(bytes(section("B", labels_size)))
+    # The mappings, shared by the copies of the trie, read the nodes through their own reference to
+    # the mapped arrays: the trie and its copies replace theirs with private arrays when they change
+    nodes = shallow_copy(trie)
+    trie.weights = SnapshotWeights(nodes, weights, parent)
+    trie.top_completions = SnapshotTopCompletions(nodes, top_offsets, top_nodes, cached, parent)
+    trie.snapshot = data
+    return trie, version, generation.rstrip(b"\0").decode() or None
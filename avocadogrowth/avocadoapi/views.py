@@ -1,9 +1,18 @@
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponse, response
-from django.contrib.auth import authenticate, alogin, alogout, login, logout
+from django.http import HttpResponse, JsonResponse, response
+from django.contrib.auth import aauthenticate, alogin, alogout
 from django.contrib import messages
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from .repositories.repository_factory import RepositoryFactory
 from .repositories.users_repository import UserRepository
+from .repositories.stacks import AUTOCOMPLETE_TOP_K, StackRepository
+
+# Largest limit accepted by the autocomplete endpoint
+AUTOCOMPLETE_MAX_LIMIT = 50
+# Longest query accepted by the autocomplete endpoint, the max_length of Stacks.normalized_tag
+AUTOCOMPLETE_MAX_QUERY_LENGTH = 60
 
 
 # Create your views here.
@@ -13,7 +22,7 @@ def home(request):
     return HttpResponse("Hello, Django!")
 
 
-def login_post(request):
+async def login_post(request):
     """
     Handle login request
     """
@@ -23,38 +32,39 @@ def login_post(request):
         return HttpResponse("Email is required", status=400)
     if not password:
         return HttpResponse("Password is required", status=400)
-    user = authenticate(request, email=email, password=password)
+    user = await aauthenticate(request, email=email, password=password)
     if user is not None:
-        login(request, user)
+        await alogin(request, user)
         messages.success(request, "Login successful")
         return redirect("dashboard")
     messages.error(request, "Invalid credentials")
     return HttpResponse("Invalid credentials", status=401)
 
 
-def login_user(request):
+async def login_user(request):
     # pylint: disable=missing-function-docstring
     # pylint: disable=unused-argument
     if request.method == "POST":
-        return login_post(request)
+        return await login_post(request)
     if request.method == "GET":
         return HttpResponse("waiting for login", status=204)
     return HttpResponse("Method not allowed", status=405)
 
 
-def logout_user(request):
+async def logout_user(request):
     # pylint: disable=missing-function-docstring
     # pylint: disable=unused-argument
     if request.method != "POST":
         return HttpResponse("Method not allowed", status=405)
-    if not request.user.is_authenticated:
+    user = await request.auser()
+    if not user.is_authenticated:
         return HttpResponse("You are not logged in", status=405)
-    logout(request)
+    await alogout(request)
     messages.success(request, "Logout successful")
     return HttpResponse("Logout successful", status=200)
 
 
-def register(request):
+async def register(request):
     # pylint: disable=missing-function-docstring
     # pylint: disable=unused-argument
     if request.method != "POST":
@@ -75,16 +85,69 @@ def register(request):
         if k not in user_data and v is not None:
             user_data[k] = v
 
-    user_repo.create(**user_data)
+    await user_repo.acreate(**user_data)
     messages.success(request, "User created successfully")
     return HttpResponse("User created successfully", status=201)
 
 
-def dashboard(request):
+async def dashboard(request):
     # pylint: disable=missing-function-docstring
     # pylint: disable=unused-argument
-    if request.user.is_authenticated:
-        return HttpResponse(f"Welcome, {request.user.username if request.user.username else request.user.email}!")
+    user = await request.auser()
+    if user.is_authenticated:
+        return HttpResponse(f"Welcome, {user.username if user.username else user.email}!")
 
     messages.error(request, "Please login to view this page")
     return redirect("login")
+
+
+def autocomplete_params(request):
+    """
+    Returns the (query, limit, fuzzy) parameters of an autocomplete request, query being None when
+    it is longer than AUTOCOMPLETE_MAX_QUERY_LENGTH and limit None when it is not a number between 1
+    and AUTOCOMPLETE_MAX_LIMIT
+    """
+    query = request.GET.get("q", "")
+    if len(query) > AUTOCOMPLETE_MAX_QUERY_LENGTH:
+        query = None
+    fuzzy = request.GET.get("fuzzy", "").lower() in ("1", "true", "yes")
+    try:
+        limit = int(request.GET.get("limit", AUTOCOMPLETE_TOP_K))
+    except ValueError:
+        limit = None
+    if limit is not None and not 1 <= limit <= AUTOCOMPLETE_MAX_LIMIT:
+        limit = None
+    return query, limit, fuzzy
+
+
+def autocomplete_etag(request):
+    """
+    ETag of an autocomplete response: it changes with the query once normalized, and with the trie
+    version, so clients revalidate for free until a stack tag changes.
+    """
+    query, limit, fuzzy = autocomplete_params(request)
+    if query is None or limit is None:
+        return None
+    return StackRepository.autocomplete_key(query, limit, fuzzy)
+
+
+@condition(etag_func=autocomplete_etag)
+def autocomplete_stacks(request):
+    """
+    Returns the stack tags starting with the "q" parameter (at most AUTOCOMPLETE_MAX_QUERY_LENGTH
+    characters) as JSON, most popular first.
+    Optional parameters: "limit" (1 to AUTOCOMPLETE_MAX_LIMIT, default AUTOCOMPLETE_TOP_K) and
+    "fuzzy" (1 or true) to tolerate typos.
+    """
+    if request.method != "GET":
+        return HttpResponse("Method not allowed", status=405)
+    query, limit, fuzzy = autocomplete_params(request)
+    if query is None:
+        return HttpResponse(f"Query must be at most {AUTOCOMPLETE_MAX_QUERY_LENGTH} characters", status=400)
+    if limit is None:
+        return HttpResponse(f"Limit must be between 1 and {AUTOCOMPLETE_MAX_LIMIT}", status=400)
+    stack_repo = RepositoryFactory.create_repository("stack")
+    results = stack_repo.cached_autocomplete(query, limit=limit, fuzzy=fuzzy)
+    json_response = JsonResponse({"query": query, "results": results})
+    patch_cache_control(json_response, public=True, max_age=getattr(settings, "STACKS_AUTOCOMPLETE_MAX_AGE", 60))
+    return json_response
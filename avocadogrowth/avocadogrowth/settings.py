@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +49,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "avocadoapi.middleware.IdentityMapMiddleware",
 ]
 
 ROOT_URLCONF = "avocadogrowth.urls"
@@ -82,6 +84,32 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# The repository cache and the stacks trie journal must be shared by every worker, otherwise
+# invalidations made by one worker never reach the others: the file cache is shared by the workers
+# of a host (use memcached or redis across hosts). Tests use the local memory cache.
+
+TESTING = sys.argv[1:2] == ["test"]
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache",
+    }
+}
+
+if TESTING:
+    CACHES["default"] = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+
+# Repository cache
+# REPOSITORY_CACHE: alias of the cache keeping rows fetched by BaseRepository.get, None to disable it
+# REPOSITORY_CACHE_TIMEOUT: seconds a row stays cached
+
+REPOSITORY_CACHE = "default"
+REPOSITORY_CACHE_TIMEOUT = 300
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -124,3 +152,22 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 AUTH_USER_MODEL = "avocadoapi.User"
+
+# Stacks autocomplete
+# STACKS_TRIE_ENGINE: "default" keeps one object per trie node, "compact" stores the nodes in flat arrays
+# STACKS_TRIE_SYNC_INTERVAL: seconds between two checks of the shared trie version by autocomplete
+# STACKS_TRIE_SNAPSHOT: snapshot written by "manage.py dump_stacks_trie" and mapped at startup if it exists
+# STACKS_AUTOCOMPLETE_MAX_AGE: seconds clients may reuse an autocomplete response before revalidating it
+
+STACKS_TRIE_ENGINE = "default"
+STACKS_TRIE_SYNC_INTERVAL = 1
+STACKS_TRIE_SNAPSHOT = None
+STACKS_AUTOCOMPLETE_MAX_AGE = 60
+
+
+# Mentor ratings
+# MENTOR_RATING_PRIOR: (mean, weight) of the Bayesian average stored in Mentor.score, each mentor's
+# comments being averaged with weight virtual comments rated mean; None leaves score empty.
+# Run "manage.py rebuild_mentor_ratings" after changing it.
+
+MENTOR_RATING_PRIOR = None